@@ -4,26 +4,31 @@ import nibabel as nib
 import numpy as np
 import os
 
+# Parameters for Higuchi's method and the x-side constants of the log-log fit
+K_MAX = 10
+K_VALUES = np.arange(1, K_MAX + 1)
+_LOG_K = np.log(1.0 / K_VALUES)
+_LOG_K_CENTERED = _LOG_K - _LOG_K.mean()
+_LOG_K_SS = np.sum(_LOG_K_CENTERED ** 2)
+
 def extract_fractal_dimension(signal: np.ndarray) -> float:
     """Extract fractal dimension using Higuchi's method."""
     # Normalize the signal
     signal = (signal - np.mean(signal)) / np.std(signal)
     
-    # Parameters for Higuchi's method
-    k_max = 10
-    k_values = np.arange(1, k_max + 1)
     length_values = []
     
     # Calculate length for different k values
-    for k in k_values:
+    for k in K_VALUES:
         length = compute_curve_length(signal, k)
         length_values.append(length)
     
     # Compute fractal dimension from the slope
     if len(length_values) > 1:
         log_length = np.log(length_values)
-        log_k = np.log(1.0 / k_values)
-        fd = -np.polyfit(log_k, log_length, 1)[0]
+        # Closed-form least-squares slope (degree-1 fit)
+        slope = np.sum(_LOG_K_CENTERED * (log_length - log_length.mean())) / _LOG_K_SS
+        fd = -slope
         return max(1.0, fd)  # Ensure value is at least 1
     else:
         return 1.0  # Return 1.0 if calculation fails
@@ -35,14 +40,12 @@ def compute_curve_length(signal: np.ndarray, k: int) -> float:
     
     # Calculate length for each m
     for m in range(k):
-        # Extract subsequence
-        indices = np.arange(0, (n-m-1)//k*k + 1, k)
-        subsequence = signal[indices + m]
+        # Subsequence signal[m], signal[m+k], ... as a strided view
+        subsequence = signal[m::k]
         
-        # Calculate normalized length
-        diff = np.abs(np.diff(subsequence))
-        norm = ((n-1) / (((n-m-1)//k)*k)) * (k/1.0)
-        length += np.sum(diff) * norm
+        # Calculate normalized length; ((n-1) / (n_intervals*k)) * k
+        norm = (n - 1) / (len(subsequence) - 1)
+        length += np.abs(np.diff(subsequence)).sum() * norm
     
     return length / k
 
@@ -55,7 +58,7 @@ def main():
     
     print(f"Loading fMRI data from {args.fmri}")
     img = nib.load(args.fmri)
-    data = img.get_fdata()
+    data = img.get_fdata(dtype=np.float32, caching='unchanged')
     affine = img.affine
     
     # Get dimensions
@@ -68,51 +71,35 @@ def main():
     mask = variance > np.percentile(variance, 10)
     
     # Initialize output
-    fractal_map = np.zeros((nx, ny, nz))
+    fractal_map = np.zeros((nx, ny, nz), dtype=np.float32)
     
-    # Process only a central region if sample mode is on
+    # Restrict the mask to a central region if sample mode is on
     if args.sample:
         print("Processing sample region only (for testing)")
-        x_range = slice(nx//2-5, nx//2+5)
-        y_range = slice(ny//2-5, ny//2+5)
-        z_range = slice(nz//2-2, nz//2+2)
-        
-        masked_indices = []
-        for x in range(nx//2-5, nx//2+5):
-            for y in range(ny//2-5, ny//2+5):
-                for z in range(nz//2-2, nz//2+2):
-                    if mask[x, y, z]:
-                        masked_indices.append((x, y, z))
-    else:
-        # Get all masked voxels
-        masked_indices = np.argwhere(mask)
+        sample_mask = np.zeros_like(mask)
+        sample_mask[nx//2-5:nx//2+5, ny//2-5:ny//2+5, nz//2-2:nz//2+2] = True
+        mask &= sample_mask
     
-    total_voxels = len(masked_indices)
+    # Gather masked time series and skip those with no variance
+    ts_mat = data[mask]
+    valid = np.std(ts_mat, axis=1) > 1e-6
+    total_voxels = len(ts_mat)
     print(f"Processing {total_voxels} voxels")
     
     # Loop through voxels (with progress updates)
-    for i, index in enumerate(masked_indices):
-        if isinstance(index, tuple):
-            x, y, z = index
-        else:
-            x, y, z = index[0], index[1], index[2]
-            
-        if i % max(1, total_voxels // 10) == 0:
+    step = max(1, total_voxels // 10)  # Show 10 steps
+    fd_vals = np.zeros(total_voxels)
+    for i in np.flatnonzero(valid):
+        if i % step == 0:
             print(f"Progress: {100.0 * i / total_voxels:.1f}% ({i}/{total_voxels} voxels)")
         
-        # Get time series
-        ts = data[x, y, z, :]
-        
-        # Skip if time series has no variance
-        if np.std(ts) <= 1e-6:
-            continue
-        
         # Compute fractal dimension
         try:
-            fd = extract_fractal_dimension(ts)
-            fractal_map[x, y, z] = fd
+            fd_vals[i] = extract_fractal_dimension(ts_mat[i])
         except Exception as e:
-            print(f"Error computing fractal dimension at ({x},{y},{z}): {e}")
+            print(f"Error computing fractal dimension for voxel {i}: {e}")
+    
+    fractal_map[mask] = fd_vals
     
     # Save output
     print(f"Saving fractal dimension map to {args.output}")
@@ -5,8 +5,40 @@ import numpy as np
 import nolds
 import os
 from scipy import signal
+from joblib import Parallel, delayed
 
-def compute_hurst(ts, fit_method='RANSAC', nvals=None, bandpass=None, tr=None):
+def design_bandpass(bandpass, tr):
+    """
+    Design the Butterworth bandpass filter used before Hurst estimation.
+    
+    Parameters:
+    -----------
+    bandpass : tuple
+        Bandpass filter frequencies (low, high) in Hz.
+    tr : float
+        Repetition time in seconds.
+        
+    Returns:
+    --------
+    tuple
+        Filter coefficients (b, a)
+    """
+    low_freq, high_freq = bandpass
+    fs = 1/tr  # Sampling frequency in Hz
+    nyquist = fs/2
+    
+    # Check if frequencies are valid
+    if high_freq > nyquist:
+        print(f"Warning: High cutoff frequency {high_freq} exceeds Nyquist frequency {nyquist}. Setting to Nyquist.")
+        high_freq = nyquist
+        
+    # Normalize frequencies to Nyquist
+    low = low_freq / nyquist
+    high = high_freq / nyquist
+    
+    return signal.butter(3, [low, high], btype='band')
+
+def compute_hurst(ts, fit_method='RANSAC', nvals=None):
     """
     Compute Hurst exponent for a time series.
     
@@ -18,35 +50,12 @@ def compute_hurst(ts, fit_method='RANSAC', nvals=None, bandpass=None, tr=None):
         Method for fitting the power law ('RANSAC' or 'poly'). Default is 'RANSAC'.
     nvals : list, optional
         List of subsequence lengths to use for R/S analysis. If None, uses logmid_n.
-    bandpass : tuple, optional
-        Bandpass filter frequencies (low, high) in Hz. If None, no filtering is applied.
-    tr : float, optional
-        Repetition time in seconds, required if bandpass is specified.
         
     Returns:
     --------
     float
         Hurst exponent value
     """
-    # Apply bandpass filtering if specified
-    if bandpass is not None and tr is not None:
-        low_freq, high_freq = bandpass
-        fs = 1/tr  # Sampling frequency in Hz
-        nyquist = fs/2
-        
-        # Check if frequencies are valid
-        if high_freq > nyquist:
-            print(f"Warning: High cutoff frequency {high_freq} exceeds Nyquist frequency {nyquist}. Setting to Nyquist.")
-            high_freq = nyquist
-            
-        # Normalize frequencies to Nyquist
-        low = low_freq / nyquist
-        high = high_freq / nyquist
-        
-        # Apply bandpass filter
-        b, a = signal.butter(3, [low, high], btype='band')
-        ts = signal.filtfilt(b, a, ts)
-    
     try:
         return nolds.hurst_rs(ts, nvals=nvals, fit=fit_method, corrected=True, unbiased=True)
     except Exception:
@@ -65,6 +74,7 @@ def main():
     parser.add_argument("--bandpass", nargs=2, type=float, metavar=('LOW_FREQ', 'HIGH_FREQ'),
                         help="Bandpass filter frequencies in Hz (e.g., 0.01 0.1 for 0.01-0.1 Hz)")
     parser.add_argument("--tr", type=float, help="Repetition time in seconds, required if --bandpass is used")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="Number of parallel jobs (default: all cores)")
     args = parser.parse_args()
 
     # Validate arguments
@@ -73,8 +83,8 @@ def main():
 
     print(f"Loading fMRI data from {args.fmri}")
     img = nib.load(args.fmri)
-    data = img.get_fdata()
-    hurst_map = np.zeros(data.shape[:-1])
+    data = img.get_fdata(dtype=np.float32, caching='unchanged')
+    hurst_map = np.zeros(data.shape[:-1], dtype=np.float32)
     
     # Get dimensions
     nx, ny, nz, nt = data.shape
@@ -91,63 +101,47 @@ def main():
         mask = variance > np.percentile(variance, 10)
     
     # Setup subsequence selection method
-    nvals = None
     if args.subsequence == "binary":
         nvals = nolds.binary_n(nt, min_n=10)
     elif args.subsequence == "logarithmic":
         nvals = nolds.logarithmic_n(10, nt//2, 1.5)
-    # For "logmid", we'll use the default (None) which will use nolds.logmid_n
+    else:
+        # Same defaults nolds.hurst_rs uses, derived once instead of per voxel
+        nvals = nolds.logmid_n(nt, ratio=1/4.0, nsteps=15)
     
-    # Process only a sample region if requested
+    # Restrict the mask to a central region if sample mode is on
     if args.sample:
         print("Processing sample region only (for testing)")
-        # Create a central test region
-        x_range = slice(nx//2-5, nx//2+5)
-        y_range = slice(ny//2-5, ny//2+5)
-        z_range = slice(nz//2-2, nz//2+2)
-        
-        # Get masked indices only in the sample region
-        masked_indices = []
-        for x in range(nx//2-5, nx//2+5):
-            for y in range(ny//2-5, ny//2+5):
-                for z in range(nz//2-2, nz//2+2):
-                    if mask[x, y, z]:
-                        masked_indices.append((x, y, z))
-    else:
-        # Get all masked voxels
-        masked_indices = np.argwhere(mask)
+        sample_mask = np.zeros_like(mask)
+        sample_mask[nx//2-5:nx//2+5, ny//2-5:ny//2+5, nz//2-2:nz//2+2] = True
+        mask &= sample_mask
     
-    # Add progress tracking
-    total_voxels = len(masked_indices)
-    step = max(1, total_voxels // 20)  # Show 20 steps
+    # Gather masked time series and skip those with no variance
+    ts_mat = data[mask]
+    valid = np.std(ts_mat, axis=1) > 0
+    
+    total_voxels = len(ts_mat)
     
     print("Computing Hurst exponent...")
     print(f"Processing {total_voxels} voxels")
     print(f"Using fitting method: {args.fit}")
     print(f"Using subsequence selection: {args.subsequence}")
     
+    # Bandpass filter all voxel time series in a single call
+    ts_valid = ts_mat[valid]
     if args.bandpass:
         print(f"Applying bandpass filter: {args.bandpass[0]}-{args.bandpass[1]} Hz (TR={args.tr}s)")
-        bandpass = (args.bandpass[0], args.bandpass[1])
-    else:
-        bandpass = None
+        b, a = design_bandpass((args.bandpass[0], args.bandpass[1]), args.tr)
+        ts_valid = signal.filtfilt(b, a, ts_valid, axis=-1)
     
-    for i, index in enumerate(masked_indices):
-        if isinstance(index, tuple):
-            x, y, z = index
-        else:
-            x, y, z = index[0], index[1], index[2]
-        
-        if i % step == 0:
-            print(f"Progress: {100*i/total_voxels:.1f}% ({i}/{total_voxels} voxels)")
-        
-        ts = data[x, y, z, :]
-        if np.std(ts) > 0:
-            hurst_map[x, y, z] = compute_hurst(ts, 
-                                              fit_method=args.fit, 
-                                              nvals=nvals, 
-                                              bandpass=bandpass, 
-                                              tr=args.tr)
+    # Voxels are independent, so distribute them over worker processes
+    hurst_vals = np.zeros(total_voxels)
+    hurst_vals[valid] = Parallel(n_jobs=args.n_jobs, batch_size='auto')(
+        delayed(compute_hurst)(ts, fit_method=args.fit, nvals=nvals)
+        for ts in ts_valid
+    )
+    
+    hurst_map[mask] = hurst_vals
 
     print(f"Saving Hurst map to {args.output}")
     os.makedirs(os.path.dirname(args.output), exist_ok=True)
@@ -1,28 +1,42 @@
 #!/usr/bin/env python3
 import argparse
+import glob
 import os
+import shutil
 import tempfile
 import subprocess
-import nibabel as nib
 
 def run_3dRSFC_all(fmri, mask, band_low, band_high, metrics, prefix):
     """
     Run AFNI's 3dRSFC to compute specified metrics.
     metrics: list of strings from ['ALFF','mALFF','fALFF','RSFA'].
+    A prefix ending in .nii.gz makes AFNI write compressed NIfTI directly.
     """
     cmd = [
         "3dRSFC",
         "-input", fmri,
         "-band", str(band_low), str(band_high),
-        "-prefix", prefix
+        "-prefix", prefix,
+        "-overwrite"
     ]
     if mask:
         cmd += ["-mask", mask]
     for m in metrics:
         cmd += ["-"+m]
-    subprocess.run(cmd, check=True)
+    subprocess.run(cmd, check=True, env=dict(os.environ, AFNI_AUTOGZIP="YES"))
     return prefix
 
+def find_metric_output(out_dir, metric):
+    """
+    Return the file 3dRSFC wrote for a metric, preferring NIfTI over AFNI HEAD/BRIK.
+    """
+    matches = glob.glob(os.path.join(out_dir, f"*_{metric}*"))
+    for ext in ('.nii.gz', '.nii', '.HEAD'):
+        for path in matches:
+            if path.endswith(ext):
+                return path
+    raise FileNotFoundError(f"No 3dRSFC output found for {metric} in {out_dir}")
+
 def main():
     parser = argparse.ArgumentParser(
         description='Compute resting‐state metrics via AFNI 3dRSFC'
@@ -63,7 +77,8 @@ def main():
     os.makedirs(args.output, exist_ok=True)
 
     # Run AFNI
-    prefix = tempfile.mktemp(prefix="rsfc_")
+    work_dir = tempfile.mkdtemp(prefix="rsfc_")
+    prefix = os.path.join(work_dir, "rsfc.nii.gz")
     run_3dRSFC_all(
         fmri=args.fmri,
         mask=args.mask,
@@ -75,17 +90,20 @@ def main():
 
     # Save each AFNI output
     for m in metrics:
-        afni_head = f"{prefix}_{m}+orig.HEAD"
-        nii_path   = os.path.join(args.output, f"{m.lower()}.nii.gz")
-        # Convert to NIfTI if needed
-        if not os.path.exists(afni_head.replace('.HEAD','.nii')):
+        afni_out = find_metric_output(work_dir, m)
+        nii_path = os.path.join(args.output, f"{m.lower()}.nii.gz")
+        if afni_out.endswith('.nii.gz'):
+            # AFNI already wrote the final file, just move it into place
+            shutil.move(afni_out, nii_path)
+        else:
+            # Convert straight to the output path
             subprocess.run(
-                ["3dAFNItoNIFTI", afni_head],
+                ["3dAFNItoNIFTI", "-prefix", nii_path, afni_out],
                 check=True
             )
-        img = nib.load(afni_head.replace('.HEAD','.nii'))
-        nib.save(img, nii_path)
         print(f"[+] Saved {m} map to {nii_path}")
 
+    shutil.rmtree(work_dir, ignore_errors=True)
+
 if __name__ == '__main__':
     main()
@@ -1,15 +1,128 @@
 #!/usr/bin/env python3
 import argparse
+import functools
 import nibabel as nib
 import numpy as np
-from scipy import signal
+from scipy import fft, signal
 from scipy.signal import windows
 import os
 import sys
+# Optional FFTW backend (threaded, with plan caching) for the batched FFTs
+from fftw_backend import fft_backend
+
+# Number of voxel time series processed together
+VOXEL_CHUNK_SIZE = 4096
+
+# Largest z-slab of float32 data read into memory at once
+SLAB_TARGET_BYTES = 2 * 1024**3
+
+# Window functions selectable with --window
+WINDOW_FUNCTIONS = {
+    'hamming': windows.hamming,
+    'hanning': windows.hann,
+    'blackman': windows.blackman,
+}
+
+
+@functools.lru_cache(maxsize=16)
+def _band_idx(n_fft, tr, low, high):
+    """Return the rFFT bin indices within [low, high] Hz for an n_fft-point FFT at the given TR."""
+    freqs = fft.rfftfreq(n_fft, d=tr)
+    freq_idx = np.where((freqs >= low) & (freqs <= high))[0]
+    freq_idx.flags.writeable = False
+    return freq_idx
+
+
+@functools.lru_cache(maxsize=16)
+def _window(nt, name):
+    """Return the named window of length nt, or None if no window is applied."""
+    if name not in WINDOW_FUNCTIONS:
+        return None
+    win = WINDOW_FUNCTIONS[name](nt)
+    win.flags.writeable = False
+    return win
+
+
+def detrend_batch(ts_mat, detrend_method='linear'):
+    """
+    Remove trends from many time series at once.
+    
+    Parameters:
+    -----------
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints)
+    detrend_method : str, optional
+        Method for detrending ('linear', 'constant', 'polynomial', or 'none'). Default is 'linear'.
+        
+    Returns:
+    --------
+    numpy.ndarray
+        Detrended time series, same shape as ts_mat
+    """
+    if detrend_method == 'linear':
+        return signal.detrend(ts_mat, axis=1)
+    elif detrend_method == 'constant':
+        return signal.detrend(ts_mat, axis=1, type='constant')
+    elif detrend_method == 'polynomial':
+        # Fit and remove 2nd order polynomial trend with one least-squares solve
+        vander = np.vander(np.arange(ts_mat.shape[1], dtype=np.float64), 3)
+        coeffs = np.linalg.lstsq(vander, ts_mat.T, rcond=None)[0]
+        return ts_mat - (vander @ coeffs).T
+    elif detrend_method == 'none':
+        return ts_mat
+    else:
+        raise ValueError(f"Unknown detrend method: {detrend_method}")
+
+def alff_batch(ts_mat, n_fft, freq_idx, detrend_method='linear', win=None, sos=None):
+    """
+    Compute ALFF and the total (non-DC) FFT amplitude for many time series at once.
+    
+    Parameters:
+    -----------
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints)
+    n_fft : int
+        FFT length (time series are zero-padded to this length)
+    freq_idx : numpy.ndarray
+        Indices of the rFFT bins inside the ALFF band
+    detrend_method : str, optional
+        Method for detrending ('linear', 'constant', 'polynomial', or 'none'). Default is 'linear'.
+    win : numpy.ndarray, optional
+        Window applied to every time series. Default is None (no window).
+    sos : numpy.ndarray, optional
+        Bandpass filter in second-order sections. If given, ALFF is the sum of all non-DC
+        amplitudes of the filtered signal (legacy behaviour). Default is None.
+        
+    Returns:
+    --------
+    tuple of numpy.ndarray
+        ALFF and total amplitude of each row of ts_mat
+    """
+    ts_detrended = detrend_batch(ts_mat, detrend_method)
+    
+    # Apply window function
+    if win is not None:
+        ts_detrended = ts_detrended * win
+    
+    # Compute FFT amplitudes of the detrended signal, using all cores across voxels
+    with fft_backend():
+        fft_total = np.abs(fft.rfft(ts_detrended, n=n_fft, axis=1, workers=-1))
+    total_power = np.sum(fft_total[:, 1:], axis=1)  # Skip DC component (0 frequency)
+    
+    if sos is not None:
+        # Apply bandpass filter and sum all amplitudes of the filtered signal
+        ts_filtered = signal.sosfiltfilt(sos, ts_detrended, axis=1)
+        with fft_backend():
+            fft_vals = np.abs(fft.rfft(ts_filtered, n=n_fft, axis=1, workers=-1))
+        return np.sum(fft_vals[:, 1:], axis=1), total_power
+    
+    # Compute ALFF as the sum of amplitudes in the frequency band
+    return np.sum(fft_total[:, freq_idx], axis=1), total_power
 
 def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_file=None, 
                 detrend_method='linear', window='none', normalize_method='none', 
-                compute_falff=False, falff_highband=(0.08, 0.25), sample=False):
+                compute_falff=False, falff_highband=(0.08, 0.25), sample=False,
+                legacy_filter=False):
     """
     Compute ALFF (Amplitude of Low Frequency Fluctuations) from fMRI data.
     
@@ -39,33 +152,49 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
         Higher frequency band for fALFF computation (default is (0.08, 0.25) Hz).
     sample : bool, optional
         Whether to process only a sample region for testing. Default is False.
+    legacy_filter : bool, optional
+        Bandpass-filter the time series and sum all non-DC FFT amplitudes, instead of
+        summing the unfiltered FFT amplitudes inside the band. Default is False.
     """
     # Load the fMRI data
     print(f"Loading fMRI data from {fmri_file}")
     img = nib.load(fmri_file)
-    data = img.get_fdata()
+    nx, ny, nz, nt = img.shape
+    print(f"Data dimensions: {nx} x {ny} x {nz} x {nt}")
+    
+    # Read the data in z-slabs if the whole float32 series would not fit the memory target
+    zstep = max(1, SLAB_TARGET_BYTES // (nx * ny * nt * 4))
+    if zstep >= nz:
+        # Read through the array proxy as float32; uncompressed files stay memory-mapped
+        data = np.asarray(img.dataobj, dtype=np.float32)
+    else:
+        print(f"Processing data in slabs of {zstep} slices")
+        data = img.dataobj
     affine = img.affine
-    header = img.header
+    # Output maps are written as float32 regardless of the input storage type
+    # (one 3D header, shared by the ALFF and fALFF maps)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape((nx, ny, nz))
 
     # Load the mask if provided
     mask = None
     if mask_file:
         print(f"Loading mask from {mask_file}")
         mask_img = nib.load(mask_file)
-        mask = mask_img.get_fdata().astype(bool)
+        mask = np.asarray(mask_img.dataobj) != 0
     else:
         # Create a simple mask based on variance
         print("No mask provided, creating mask based on signal variance")
-        variance = np.var(data, axis=3)
+        variance = np.empty((nx, ny, nz), dtype=np.float32)
+        for z0 in range(0, nz, zstep):
+            slab = np.asarray(data[:, :, z0:z0 + zstep], dtype=np.float32)
+            variance[:, :, z0:z0 + zstep] = np.var(slab, axis=3)
         mask = variance > np.percentile(variance, 10)
 
-    # Get dimensions
-    nx, ny, nz, nt = data.shape
-    print(f"Data dimensions: {nx} x {ny} x {nz} x {nt}")
-
     # Create empty ALFF map and optional fALFF map
-    alff_map = np.zeros((nx, ny, nz))
-    falff_map = np.zeros((nx, ny, nz)) if compute_falff else None
+    alff_map = np.zeros((nx, ny, nz), dtype=np.float32)
+    falff_map = np.zeros((nx, ny, nz), dtype=np.float32) if compute_falff else None
 
     # Calculate sample frequency and design bandpass filter
     fs = 1.0 / tr  # Sample frequency in Hz
@@ -79,8 +208,15 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
         normalized_high = 1.0
         bandpass_high = nyquist
     
-    # Design bandpass filter for ALFF
-    b, a = signal.butter(3, [normalized_low, normalized_high], btype='band')
+    # Design bandpass filter for ALFF (second-order sections are stable at low cutoffs)
+    sos = None
+    if legacy_filter:
+        sos = signal.butter(3, [normalized_low, normalized_high], btype='band', output='sos')
+    
+    # Frequency bins of the ALFF band
+    # Pad the FFT to a fast (5-smooth) length; the band is still selected in Hz
+    n_fft = fft.next_fast_len(nt, real=True)
+    freq_idx = _band_idx(n_fft, tr, bandpass_low, bandpass_high)
     
     # Handle fALFF computation - fix for potential frequency overlap
     if compute_falff:
@@ -105,7 +241,6 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
                 print("Warning: Invalid fALFF frequency range - disabling fALFF computation")
                 compute_falff = False
             else:
-                b_high, a_high = signal.butter(3, [norm_falff_low, norm_falff_high], btype='band')
                 print(f"Computing fALFF with additional high frequency band {falff_low}-{falff_high} Hz")
 
     print(f"Computing ALFF with bandpass filter {bandpass_low}-{bandpass_high} Hz")
@@ -113,126 +248,94 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
     print(f"Using window function: {window}")
     print(f"Using normalization method: {normalize_method}")
 
-    # Add progress tracking
-    masked_indices = np.argwhere(mask)
-    total_voxels = len(masked_indices)
-    step = max(1, total_voxels // 20)  # Show 20 steps
-    
     # Process only a central region if sample mode is on
     if sample:
         print("Processing sample region only (for testing)")
-        x_range = slice(nx//2-5, nx//2+5)
-        y_range = slice(ny//2-5, ny//2+5)
-        z_range = slice(nz//2-2, nz//2+2)
-        
-        # Filter masked_indices to only include those in the sample region
-        sample_indices = []
-        for idx in masked_indices:
-            if (x_range.start <= idx[0] < x_range.stop and
-                y_range.start <= idx[1] < y_range.stop and
-                z_range.start <= idx[2] < z_range.stop):
-                sample_indices.append(idx)
-        masked_indices = np.array(sample_indices)
-        total_voxels = len(masked_indices)
-        step = max(1, total_voxels // 20) # Recalculate step for sample
-        print(f"Processing {total_voxels} voxels in sample region.")
-        if total_voxels == 0:
+        sample_mask = np.zeros_like(mask)
+        sample_mask[nx//2-5:nx//2+5, ny//2-5:ny//2+5, nz//2-2:nz//2+2] = True
+        mask = mask & sample_mask
+        print(f"Processing {np.sum(mask)} voxels in sample region.")
+        if not np.any(mask):
              print("Warning: No voxels found in the sample region within the mask.")
-             # Optionally handle this case, e.g., save empty maps or exit
              
-    # Loop through masked voxels
-    for i, index in enumerate(masked_indices):
-        if i % step == 0:
-            print(f"Progress: {100*i/total_voxels:.1f}% ({i}/{total_voxels} voxels)")
-            
-        x, y, z = tuple(index)
-        # Get time series for this voxel
-        ts = data[x, y, z, :]
-        
-        # Skip if time series has no variance
-        if np.std(ts) <= 1e-6:
+    # Select window function if specified ('none' or any other value means no window is applied)
+    win = _window(nt, window)
+    
+    total_voxels = int(np.sum(mask))
+    print(f"Processing {total_voxels} voxels")
+    
+    voxel_parts = [np.zeros(0, dtype=np.intp)]
+    alff_parts = [np.zeros(0)]
+    total_parts = [np.zeros(0)]
+    done = 0
+    for z0 in range(0, nz, zstep):
+        slab_mask = mask[:, :, z0:z0 + zstep]
+        if not np.any(slab_mask):
             continue
         
-        # Apply detrending
-        if detrend_method == 'linear':
-            ts_detrended = signal.detrend(ts)
-        elif detrend_method == 'constant':
-            ts_detrended = signal.detrend(ts, type='constant')
-        elif detrend_method == 'polynomial':
-            # Fit and remove 2nd order polynomial trend
-            t = np.arange(len(ts))
-            coeffs = np.polyfit(t, ts, 2)
-            poly_trend = np.polyval(coeffs, t)
-            ts_detrended = ts - poly_trend
-        elif detrend_method == 'none':
-            ts_detrended = ts
-        else:
-            raise ValueError(f"Unknown detrend method: {detrend_method}")
-        
-        # Apply window function if specified
-        if window == 'hamming':
-            ts_detrended = ts_detrended * windows.hamming(len(ts_detrended))
-        elif window == 'hanning':
-            ts_detrended = ts_detrended * windows.hann(len(ts_detrended))
-        elif window == 'blackman':
-            ts_detrended = ts_detrended * windows.blackman(len(ts_detrended))
-        # 'none' or any other value means no window is applied
-        
-        # Apply bandpass filter
-        ts_filtered = signal.filtfilt(b, a, ts_detrended)
+        # Gather the masked time series of this slab into a (n_voxels, nt) matrix
+        slab = np.asarray(data[:, :, z0:z0 + zstep], dtype=np.float32)
+        ts_mat = slab[slab_mask]
         
-        # Compute FFT and get amplitudes for ALFF band
-        fft_vals = np.abs(np.fft.rfft(ts_filtered))
+        # Skip time series with no variance
+        valid = np.std(ts_mat, axis=1) > 1e-6
+        ts_mat = ts_mat[valid]
+        ix, iy, iz = np.nonzero(slab_mask)
+        voxel_parts.append(np.ravel_multi_index((ix[valid], iy[valid], iz[valid] + z0), (nx, ny, nz)))
         
-        # Compute ALFF as the sum of amplitudes in the frequency band
-        alff_map[x, y, z] = np.sum(fft_vals[1:])  # Skip DC component (0 frequency)
+        # Process voxels in chunks so the detrended and FFT intermediates stay small
+        for start in range(0, len(ts_mat), VOXEL_CHUNK_SIZE):
+            alff_chunk, total_chunk = alff_batch(ts_mat[start:start + VOXEL_CHUNK_SIZE], n_fft, freq_idx,
+                                                 detrend_method, win, sos)
+            alff_parts.append(alff_chunk)
+            total_parts.append(total_chunk)
         
-        # Compute fALFF if requested and valid
-        if compute_falff:
-            # For fALFF we need to calculate both ALFF and total power across all frequencies
-            
-            # Option 1: Apply high-frequency bandpass and compute power
-            ts_high = signal.filtfilt(b_high, a_high, ts_detrended)
-            fft_high = np.abs(np.fft.rfft(ts_high))
-            high_power = np.sum(fft_high[1:])
-            
-            # Option 2: More accurately, compute FFT of the original detrended signal
-            # This provides total power across all frequencies
-            fft_total = np.abs(np.fft.rfft(ts_detrended))
-            total_power = np.sum(fft_total[1:])
-            
-            # fALFF is ratio of ALFF to the total power
-            if total_power > 0:
-                falff_map[x, y, z] = alff_map[x, y, z] / total_power
-
-    # Normalize ALFF map based on selected method
-    brain_mask = alff_map > 0
+        done += len(valid)
+        print(f"Progress: {done / total_voxels * 100:.1f}% ({done}/{total_voxels} voxels)")
+    
+    voxel_idx = np.concatenate(voxel_parts)
+    alff_vals = np.concatenate(alff_parts)
+    
+    # Compute fALFF if requested and valid
+    falff_vals = np.zeros_like(alff_vals)
+    if compute_falff:
+        # fALFF is the ratio of ALFF to the total power across all frequencies
+        total_power = np.concatenate(total_parts)
+        np.divide(alff_vals, total_power, out=falff_vals, where=total_power > 0)
+    
+    # Normalize ALFF values based on selected method, before scattering them into the maps
+    brain_mask = alff_vals > 0
     if np.sum(brain_mask) > 0:  # Make sure we have non-zero values
         if normalize_method == 'zscore':
             # Z-score normalization
-            alff_mean = np.mean(alff_map[brain_mask])
-            alff_std = np.std(alff_map[brain_mask])
+            alff_mean = np.mean(alff_vals[brain_mask])
+            alff_std = np.std(alff_vals[brain_mask])
             if alff_std > 0:
-                alff_map[brain_mask] = (alff_map[brain_mask] - alff_mean) / alff_std
+                alff_vals[brain_mask] = (alff_vals[brain_mask] - alff_mean) / alff_std
                 
                 # Also normalize fALFF if computed
                 if compute_falff:
-                    falff_mean = np.mean(falff_map[brain_mask])
-                    falff_std = np.std(falff_map[brain_mask])
+                    falff_mean = np.mean(falff_vals[brain_mask])
+                    falff_std = np.std(falff_vals[brain_mask])
                     if falff_std > 0:
-                        falff_map[brain_mask] = (falff_map[brain_mask] - falff_mean) / falff_std
+                        falff_vals[brain_mask] = (falff_vals[brain_mask] - falff_mean) / falff_std
                         
         elif normalize_method == 'percent':
             # Percent change relative to mean
-            alff_mean = np.mean(alff_map[brain_mask])
+            alff_mean = np.mean(alff_vals[brain_mask])
             if alff_mean > 0:
-                alff_map[brain_mask] = (alff_map[brain_mask] / alff_mean) * 100
+                alff_vals[brain_mask] = (alff_vals[brain_mask] / alff_mean) * 100
                 
                 # Also normalize fALFF if computed
                 if compute_falff:
-                    falff_mean = np.mean(falff_map[brain_mask])
+                    falff_mean = np.mean(falff_vals[brain_mask])
                     if falff_mean > 0:
-                        falff_map[brain_mask] = (falff_map[brain_mask] / falff_mean) * 100
+                        falff_vals[brain_mask] = (falff_vals[brain_mask] / falff_mean) * 100
+
+    # Scatter the per-voxel results back into the volumes
+    alff_map.flat[voxel_idx] = alff_vals
+    if compute_falff:
+        falff_map.flat[voxel_idx] = falff_vals
 
     # Save the ALFF map
     print(f"Saving ALFF map to {output_file}")
@@ -241,7 +344,7 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
-    nib.save(alff_img, output_file)
+    alff_img.to_filename(output_file)
     print("ALFF computation completed successfully")
     
     # Save fALFF map if computed
@@ -256,7 +359,7 @@ def compute_alff(fmri_file, output_file, tr, bandpass_low, bandpass_high, mask_f
         # falff_output = output_file.replace('.nii.gz', '_falff.nii.gz') # Original incorrect naming
         print(f"Saving fALFF map to {falff_output}")
         falff_img = nib.Nifti1Image(falff_map, affine, header)
-        nib.save(falff_img, falff_output)
+        falff_img.to_filename(falff_output)
         print("fALFF computation completed successfully")
         
     return True
@@ -270,6 +373,8 @@ if __name__ == "__main__":
     parser.add_argument('--bandpass_low', type=float, required=True, help='Lower frequency bound for bandpass filter in Hz')
     parser.add_argument('--bandpass_high', type=float, required=True, help='Upper frequency bound for bandpass filter in Hz')
     parser.add_argument('--sample', action='store_true', help='Process only a sample region for testing')
+    parser.add_argument('--legacy_filter', action='store_true',
+                      help='Bandpass-filter time series before the FFT instead of summing the band directly')
     
     # Additional options
     parser.add_argument('--detrend', choices=['linear', 'constant', 'polynomial', 'none'], default='linear',
@@ -298,5 +403,6 @@ if __name__ == "__main__":
         normalize_method=args.normalize,
         compute_falff=args.falff,
         falff_highband=tuple(args.falff_highband),
-        sample=args.sample
+        sample=args.sample,
+        legacy_filter=args.legacy_filter
     ) 
\ No newline at end of file
@@ -4,24 +4,105 @@ Script to organize BIDS data and find appropriate fMRI and mask inputs for featu
 """
 
 import os
+import re
 import argparse
 import sys
 import logging
 from pathlib import Path
 import json
+from collections import defaultdict
+
+try:
+    # Optional fast JSON serializer
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 try:
     from bids import BIDSLayout
+    from bids.layout import BIDSLayoutIndexer
+    from bids.layout import models
+    from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
 except ImportError:
     logging.error("Failed to import pybids. Please install with 'pip install pybids'.")
     sys.exit(1)
 
+# Fixed parts of the layout queries; only space, desc (for the bold files)
+# and the subject/session/task lists vary between calls
+BOLD_FILTERS = {"suffix": "bold", "extension": [".nii", ".nii.gz"]}
+MASK_FILTERS = {"desc": "brain", "suffix": "mask", "extension": [".nii", ".nii.gz"]}
+
+
+def _entity_values(layout, entity):
+    """
+    List the distinct values of a BIDS entity straight from the layout's SQL index.
+    """
+    query = layout.session.query(models.Tag).filter_by(entity_name=entity)
+    values = query.with_entities(models.Tag._value).distinct().all()
+    return sorted(value for (value,) in values)
+
+
+def _scan_inputs(derivatives_options, subject, session, task, space, desc):
+    """
+    Find fMRI and mask files for one subject by listing its func directories
+    with os.scandir, without building a BIDSLayout.
+    
+    Returns a dictionary in the same format as find_inputs, empty if nothing matched.
+    """
+    # Optional entities (e.g. run, res) may sit between the ones we match on
+    other = r"(?:_[A-Za-z]+-[A-Za-z0-9]+)*"
+    prefix = rf"^sub-{re.escape(subject)}(?:_ses-[A-Za-z0-9]+)?_task-{re.escape(task)}{other}_space-{re.escape(space)}{other}"
+    fmri_re = re.compile(rf"{prefix}_desc-{re.escape(desc)}_bold\.nii(?:\.gz)?$")
+    mask_re = re.compile(rf"{prefix}_desc-{MASK_FILTERS['desc']}_mask\.nii(?:\.gz)?$")
+    
+    results = {}
+    for deriv_dir in derivatives_options:
+        subj_dir = deriv_dir / f"sub-{subject}"
+        if not subj_dir.is_dir():
+            continue
+        
+        # Session folders to look in (the subject folder itself if there are none)
+        if session:
+            ses_dirs = [(session, subj_dir / f"ses-{session}")]
+        else:
+            with os.scandir(subj_dir) as entries:
+                ses_dirs = sorted((entry.name[4:], Path(entry.path)) for entry in entries
+                                  if entry.name.startswith("ses-") and entry.is_dir())
+            if not ses_dirs:
+                ses_dirs = [(None, subj_dir)]
+        
+        for ses, ses_dir in ses_dirs:
+            func_dir = ses_dir / "func"
+            if not func_dir.is_dir():
+                continue
+            with os.scandir(func_dir) as entries:
+                names = sorted(entry.name for entry in entries)
+            fmri_files = [name for name in names if fmri_re.match(name)]
+            mask_files = [name for name in names if mask_re.match(name)]
+            
+            if fmri_files and mask_files:
+                subj_key = f"sub-{subject}"
+                if ses:
+                    subj_key += f"_ses-{ses}"
+                results[subj_key] = {
+                    "fmri": str(func_dir / fmri_files[0]),
+                    "mask": str(func_dir / mask_files[0]),
+                    "task": task
+                }
+                logging.info(f"Found fMRI file: {results[subj_key]['fmri']}")
+                logging.info(f"Found mask file: {results[subj_key]['mask']}")
+        
+        if results:
+            break
+    
+    return results
+
 
 def find_inputs(bids_dir, derivatives_dir=None, subject=None, session=None, 
-                task=None, space="MNI152NLin2009cAsym", desc="preproc"):
+                task=None, space="MNI152NLin2009cAsym", desc="preproc", db_path=None):
     """
     Find fMRI and mask files in a BIDS dataset.
     
@@ -41,6 +122,9 @@ def find_inputs(bids_dir, derivatives_dir=None, subject=None, session=None,
         Image space to filter by. Default is 'MNI152NLin2009cAsym'.
     desc : str, optional
         Image description to filter by for fMRI data. Default is 'preproc'.
+    db_path : str, optional
+        Directory for a persistent pybids SQLite index. If it already holds an index,
+        it is reused instead of re-crawling the dataset. Default is None (in-memory index).
         
     Returns:
     --------
@@ -65,12 +149,32 @@ def find_inputs(bids_dir, derivatives_dir=None, subject=None, session=None,
         derivatives_dir / "preprocessing"
     ]
     
+    # A single subject and task only needs a directory listing, not a full layout index
+    if subject and task:
+        results = _scan_inputs(derivatives_options, subject, session, task, space, desc)
+        if results:
+            return results
+        logging.info("Directory scan found no inputs, falling back to a BIDS layout query")
+    
+    # Skip non-data folders, and every other subject when one is requested,
+    # while crawling instead of indexing them and filtering afterwards. An explicit
+    # ignore list replaces pybids' defaults, so they are included (among them the
+    # hidden paths, e.g. pipeline markers and trash directories of temporary work trees)
+    ignore = list(DEFAULT_LOCATIONS_TO_IGNORE) + ["sourcedata", "code", "stimuli"]
+    if subject:
+        ignore.append(re.compile(rf"sub-(?!{re.escape(subject)}(?![A-Za-z0-9]))[A-Za-z0-9]+"))
+        # A subject-restricted index must not be reused for other subjects
+        if db_path:
+            db_path = os.path.join(db_path, f"sub-{subject}")
+    
     layout = None
     for deriv_dir in derivatives_options:
         if deriv_dir.exists():
             try:
                 logging.info(f"Attempting to load BIDS layout from: {deriv_dir}")
-                layout = BIDSLayout(deriv_dir, derivatives=True)
+                layout = BIDSLayout(deriv_dir, derivatives=True,
+                                    indexer=BIDSLayoutIndexer(validate=False, ignore=ignore),
+                                    database_path=db_path, reset_database=False)
                 logging.info(f"Successfully loaded BIDS layout from: {deriv_dir}")
                 break
             except Exception as e:
@@ -93,22 +197,38 @@ def find_inputs(bids_dir, derivatives_dir=None, subject=None, session=None,
     
     # Find all subjects if not specified
     if not subject:
-        subjects = layout.get_subjects()
+        subjects = _entity_values(layout, "subject")
     else:
         subjects = [subject]
     
     # Find all sessions if not specified
     if not session:
-        sessions = layout.get_sessions() or [None]
+        sessions = _entity_values(layout, "session") or [None]
     else:
         sessions = [session]
     
     # Find all tasks if not specified
     if not task:
-        tasks = layout.get_tasks() or ["rest"]
+        tasks = _entity_values(layout, "task") or ["rest"]
     else:
         tasks = [task]
     
+    # Query all fMRI and mask files once and bucket them by (subject, session, task)
+    query = dict(filters, subject=subjects, task=tasks)
+    if sessions != [None]:
+        query["session"] = sessions
+    
+    def _group(files):
+        grouped = defaultdict(list)
+        for bids_file in files:
+            entities = bids_file.entities
+            key = (entities.get("subject"), entities.get("session"), entities.get("task"))
+            grouped[key].append(bids_file.path)
+        return grouped
+    
+    fmri_by_key = _group(layout.get(return_type="object", **BOLD_FILTERS, desc=desc, **query))
+    mask_by_key = _group(layout.get(return_type="object", **MASK_FILTERS, **query))
+    
     # Store results
     results = {}
     
@@ -116,26 +236,8 @@ def find_inputs(bids_dir, derivatives_dir=None, subject=None, session=None,
         logging.info(f"Processing subject: {subj}")
         for ses in sessions:
             for tsk in tasks:
-                # Set up subject-specific filters
-                subj_filters = filters.copy()
-                subj_filters["subject"] = subj
-                if ses:
-                    subj_filters["session"] = ses
-                subj_filters["task"] = tsk
-                
-                # Find preprocessed fMRI files
-                fmri_filters = subj_filters.copy()
-                fmri_filters["desc"] = desc
-                fmri_filters["suffix"] = "bold"
-                
-                fmri_files = layout.get(return_type="file", **fmri_filters)
-                
-                # Find corresponding mask files
-                mask_filters = subj_filters.copy()
-                mask_filters["desc"] = "brain"
-                mask_filters["suffix"] = "mask"
-                
-                mask_files = layout.get(return_type="file", **mask_filters)
+                fmri_files = sorted(fmri_by_key.get((subj, ses, tsk), []))
+                mask_files = sorted(mask_by_key.get((subj, ses, tsk), []))
                 
                 if fmri_files and mask_files:
                     # Use first file if multiple matches
@@ -176,6 +278,7 @@ def main():
     parser.add_argument("--space", default="MNI152NLin2009cAsym", help="Image space to filter by (default: 'MNI152NLin2009cAsym')")
     parser.add_argument("--desc", default="preproc", help="Image description for fMRI data (default: 'preproc')")
     parser.add_argument("--output", default="inputs.json", help="Output JSON file to save inputs (default: 'inputs.json')")
+    parser.add_argument("--db-path", help="Directory for a persistent pybids index, reused across runs (optional)")
     
     args = parser.parse_args()
     
@@ -186,15 +289,20 @@ def main():
         args.session,
         args.task,
         args.space,
-        args.desc
+        args.desc,
+        args.db_path
     )
     
     if inputs:
         logging.info(f"Found {len(inputs)} subjects with matching fMRI and mask files.")
         
         # Save inputs to JSON file
-        with open(args.output, "w") as f:
-            json.dump(inputs, f, indent=2)
+        if orjson is not None:
+            Path(args.output).write_bytes(
+                orjson.dumps(inputs, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+        else:
+            with open(args.output, "w") as f:
+                json.dump(inputs, f, indent=2)
         
         logging.info(f"Saved inputs to {args.output}")
         
@@ -5,7 +5,9 @@ Downloads Yeo et al. 7-network and 17-network masks for RSN analysis.
 """
 
 import os
+import shutil
 import logging
+from functools import lru_cache
 import nibabel as nib
 import numpy as np
 from nilearn.datasets import fetch_atlas_yeo_2011
@@ -15,6 +17,24 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def _fetch_yeo_atlas():
+    """Fetch the Yeo 2011 atlas once per process."""
+    return fetch_atlas_yeo_2011()
+
+def _copy_mask(src, dst):
+    """
+    Copy an atlas image to dst, going through a temporary file so an
+    interrupted copy never leaves a partial mask at dst.
+    """
+    tmp_path = os.path.join(os.path.dirname(dst), ".part_" + os.path.basename(dst))
+    if str(src).endswith(".nii.gz"):
+        # Already gzipped NIfTI: a byte copy gives the same file as load+save
+        shutil.copyfile(src, tmp_path)
+    else:
+        nib.save(nib.load(src), tmp_path)
+    os.replace(tmp_path, dst)
+
 def download_rsn_masks(output_dir="/app/rsn_masks"):
     """
     Download the Yeo et al. 7-network and 17-network masks.
@@ -45,18 +65,16 @@ def download_rsn_masks(output_dir="/app/rsn_masks"):
     try:
         # Fetch the atlases
         logger.info("Fetching Yeo 2011 atlases...")
-        yeo_atlas = fetch_atlas_yeo_2011()
+        yeo_atlas = _fetch_yeo_atlas()
         
         # Save 7-network mask (MNI152 space)
         logger.info(f"Saving 7-network mask to {yeo_7_path}")
         # Copy the atlas to preserve the original
-        mask_7 = nib.load(yeo_atlas['thin_7'])
-        nib.save(mask_7, yeo_7_path)
+        _copy_mask(yeo_atlas['thin_7'], yeo_7_path)
         
         # Save 17-network mask (MNI152 space)
         logger.info(f"Saving 17-network mask to {yeo_17_path}")
-        mask_17 = nib.load(yeo_atlas['thin_17'])
-        nib.save(mask_17, yeo_17_path)
+        _copy_mask(yeo_atlas['thin_17'], yeo_17_path)
         
         logger.info("RSN masks downloaded successfully.")
         return yeo_7_path, yeo_17_path
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Optional FFTW backend (threaded, with plan caching) for the scipy.fft calls of the feature scripts.
+"""
+
+import os
+import contextlib
+import scipy.fft
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+    pyfftw.interfaces.cache.enable()
+    pyfftw.config.NUM_THREADS = os.cpu_count() or 1
+except ImportError:
+    pyfftw = None
+
+
+def fft_backend():
+    """Return a context that routes scipy.fft through pyfftw when it is installed."""
+    if pyfftw is None:
+        return contextlib.nullcontext()
+    return scipy.fft.set_backend(pyfftw.interfaces.scipy_fft)
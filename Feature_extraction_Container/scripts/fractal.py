@@ -6,101 +6,157 @@ Script to compute Fractal Dimension from fMRI data.
 import os
 import argparse
 import time
+import functools
 import numpy as np
 import nibabel as nib
 from scipy import signal
+# Optional FFTW backend (threaded, with plan caching) for the PSD method
+from fftw_backend import fft_backend
 
+try:
+    # Optional compiled kernel for the Higuchi method
+    from fractal_numba import higuchi_fd_batch as _higuchi_fd_batch_numba
+except ImportError:
+    _higuchi_fd_batch_numba = None
 
-def compute_higuchi_fd(ts, kmax=10):
+# Number of voxel time series processed per batch
+VOXEL_CHUNK_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=32)
+def _higuchi_regressor(kmax):
+    """Return the centered log(1/k) regressor and its sum of squares for kmax."""
+    x_reg = np.log(1.0 / np.arange(1, kmax + 1))
+    x_c = x_reg - x_reg.mean()
+    x_c.flags.writeable = False
+    return x_c, x_c @ x_c
+
+
+def higuchi_fd_batch(ts_mat, kmax=10):
     """
-    Compute Higuchi Fractal Dimension of a time series.
+    Compute Higuchi Fractal Dimension for many time series at once.
     
     Parameters:
     -----------
-    ts : numpy.ndarray
-        Input time series
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints)
     kmax : int
         Maximum delay/lag. Default is 10.
         
     Returns:
     --------
-    float
-        Higuchi Fractal Dimension
+    numpy.ndarray
+        Higuchi Fractal Dimension of each row of ts_mat
     """
-    n = len(ts)
-    lk = np.zeros(kmax)
-    x_reg = np.array(range(kmax))
-    y_reg = np.zeros(kmax)
+    ts_mat = np.atleast_2d(ts_mat)
+    n = ts_mat.shape[1]
+    y_reg = np.zeros((ts_mat.shape[0], kmax))
     
     for k in range(1, kmax + 1):
-        lm = np.zeros(k)
+        lk = np.zeros(ts_mat.shape[0])
         
         for m in range(k):
-            # Construct subsequence
-            ll = 0
-            
-            # Number of subsequences
+            # Number of samples in the subsequence starting at m
             n_m = int((n - m) / k)
             
-            for i in range(1, n_m):
-                ll += abs(ts[m + i * k] - ts[m + (i - 1) * k])
-            
-            ll /= k  # Normalize with factor k
-            # Length for subsequence starting at m
-            lm[m] = ll * (n - 1) / (n_m * k)
+            # Curve length of the subsequence, normalized with factor k
+            sub = ts_mat[:, m::k][:, :n_m]
+            ll = np.abs(np.diff(sub, axis=1)).sum(axis=1) / k
+            lk += ll * (n - 1) / (n_m * k)
         
         # Mean length for step k
-        lk[k - 1] = np.mean(lm)
-        y_reg[k - 1] = np.log(lk[k - 1])
+        y_reg[:, k - 1] = np.log(lk / k)
     
-    x_reg = np.log(1.0 / np.array(range(1, kmax + 1)))
-    
-    # Perform linear regression
-    slopes = np.polyfit(x_reg, y_reg, 1)
-    
-    # Return the slope (fractal dimension)
-    return slopes[0]
+    # Closed-form least-squares slope for every row (the fractal dimension)
+    x_c, x_ss = _higuchi_regressor(kmax)
+    y_c = y_reg - y_reg.mean(axis=1, keepdims=True)
+    return (y_c @ x_c) / x_ss
 
 
-def compute_psd_fd(ts):
+def compute_higuchi_fd(ts, kmax=10):
     """
-    Compute Fractal Dimension using Power Spectral Density (PSD) method.
+    Compute Higuchi Fractal Dimension of a time series.
     
     Parameters:
     -----------
     ts : numpy.ndarray
         Input time series
+    kmax : int
+        Maximum delay/lag. Default is 10.
         
     Returns:
     --------
     float
-        Fractal Dimension from PSD slope
+        Higuchi Fractal Dimension
+    """
+    return higuchi_fd_batch(ts, kmax)[0]
+
+
+def psd_fd_batch(ts_mat):
+    """
+    Compute Fractal Dimension using Power Spectral Density (PSD) method
+    for many time series at once.
+    
+    Parameters:
+    -----------
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints)
+        
+    Returns:
+    --------
+    numpy.ndarray
+        Fractal Dimension from PSD slope of each row of ts_mat
     """
+    ts_mat = np.atleast_2d(ts_mat)
+    
     # Remove mean
-    ts = ts - np.mean(ts)
+    ts_mat = ts_mat - np.mean(ts_mat, axis=1, keepdims=True)
     
-    # Compute PSD using Welch's method
-    freqs, psd = signal.welch(ts, nperseg=min(256, len(ts)//4))
+    # Compute PSD of all series in one call using Welch's method
+    with fft_backend():
+        freqs, psd = signal.welch(ts_mat, nperseg=min(256, ts_mat.shape[1]//4), axis=-1)
     
     # Avoid zero frequency and use only positive frequencies
     mask = (freqs > 0)
     freqs = freqs[mask]
-    psd = psd[mask]
+    psd = psd[:, mask]
+    
+    # Ensure enough points for regression
+    if len(freqs) <= 5:
+        return np.full(ts_mat.shape[0], np.nan)
     
-    # Perform linear regression in log-log space
-    if len(freqs) > 5:  # Ensure enough points for regression
-        slopes = np.polyfit(np.log10(freqs), np.log10(psd), 1)
+    # Closed-form least-squares slope in log-log space for every row
+    x_c = np.log10(freqs)
+    x_c = x_c - x_c.mean()
+    y_c = np.log10(psd)
+    y_c = y_c - y_c.mean(axis=1, keepdims=True)
+    slopes = (y_c @ x_c) / (x_c @ x_c)
+    
+    # Calculate fractal dimension from PSD slope
+    # FD = (5 - beta) / 2, where beta is the negative of the slope
+    beta = -slopes
+    return (5 - beta) / 2
+
+
+def compute_psd_fd(ts):
+    """
+    Compute Fractal Dimension using Power Spectral Density (PSD) method.
+    
+    Parameters:
+    -----------
+    ts : numpy.ndarray
+        Input time series
         
-        # Calculate fractal dimension from PSD slope
-        # FD = (5 - beta) / 2, where beta is the negative of the slope
-        beta = -slopes[0]
-        fd = (5 - beta) / 2
-        return fd
-    else:
-        return np.nan
+    Returns:
+    --------
+    float
+        Fractal Dimension from PSD slope
+    """
+    return psd_fd_batch(ts)[0]
 
 
-def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file=None):
+def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file=None,
+                    chunk_size=VOXEL_CHUNK_SIZE):
     """
     Compute Fractal Dimension from fMRI data.
     
@@ -116,6 +172,8 @@ def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file
         Maximum lag parameter for Higuchi method. Default is 10.
     mask_file : str, optional
         Path to a brain mask. If not provided, a mask will be created based on signal variance.
+    chunk_size : int, optional
+        Number of voxels processed per batch. Default is VOXEL_CHUNK_SIZE.
     """
     print("Starting Fractal Dimension calculation...")
     start_time = time.time()
@@ -128,9 +186,11 @@ def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file
     # Load fMRI data
     print(f"Loading fMRI data from {fmri_file}...")
     img = nib.load(fmri_file)
-    data = img.get_fdata()
+    data = img.get_fdata(dtype=np.float32, caching='unchanged')
     affine = img.affine
-    header = img.header
+    # Output maps are written as float32 regardless of the input storage type
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
     
     # Get dimensions
     nx, ny, nz, nt = data.shape
@@ -140,11 +200,11 @@ def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file
     if mask_file:
         print(f"Loading mask from {mask_file}...")
         mask_img = nib.load(mask_file)
-        mask = mask_img.get_fdata() > 0
+        mask = np.asanyarray(mask_img.dataobj) > 0
     else:
         print("Creating mask from fMRI data...")
-        # Simple mask: voxels with non-zero variance
-        mask = np.std(data, axis=3) > 0
+        # Simple mask: voxels with non-zero variance (max > min, single pass)
+        mask = np.ptp(data, axis=3) > 0
     
     # Ensure mask dimensions match
     if mask.shape[:3] != data.shape[:3]:
@@ -152,48 +212,43 @@ def compute_fractal(fmri_file, output_file, method='higuchi', kmax=10, mask_file
     
     # Create Fractal Dimension map
     print(f"Calculating Fractal Dimension using {method} method...")
-    fd_map = np.zeros((nx, ny, nz))
+    fd_map = np.zeros((nx, ny, nz), dtype=np.float32)
     
-    # Set fractal dimension calculation method
-    if method == 'higuchi':
-        fd_func = lambda ts: compute_higuchi_fd(ts, kmax)
-    elif method == 'psd':
-        fd_func = compute_psd_fd
-    else:
+    # Select the fractal dimension kernel
+    if method not in ('higuchi', 'psd'):
         print(f"Unknown method {method}. Using Higuchi method.")
-        fd_func = lambda ts: compute_higuchi_fd(ts, kmax)
-    
-    # Loop through masked voxels
-    total_voxels = np.sum(mask)
-    processed_voxels = 0
-    last_update = 0
-    
-    for x in range(nx):
-        for y in range(ny):
-            for z in range(nz):
-                if mask[x, y, z]:
-                    # Get time series for this voxel
-                    ts = data[x, y, z, :]
-                    
-                    # Skip if time series has no variance
-                    if np.std(ts) <= 1e-6:
-                        continue
-                    
-                    try:
-                        # Calculate fractal dimension
-                        fd_map[x, y, z] = fd_func(ts)
-                    except Exception as e:
-                        # If calculation fails, set to NaN
-                        fd_map[x, y, z] = np.nan
-                        print(f"Error calculating fractal dimension at ({x},{y},{z}): {e}")
-                    
-                    processed_voxels += 1
-                    
-                    # Update progress every 5%
-                    progress = processed_voxels / total_voxels
-                    if progress - last_update >= 0.05:
-                        print(f"Progress: {progress * 100:.1f}% ({processed_voxels}/{total_voxels} voxels)")
-                        last_update = progress
+        method = 'higuchi'
+    
+    if method == 'higuchi' and nt < 2 * kmax:
+        raise ValueError(f"Higuchi FD with kmax={kmax} needs at least {2 * kmax} time points, got {nt}")
+
+    if method == 'psd':
+        fd_func = psd_fd_batch
+    elif _higuchi_fd_batch_numba is not None:
+        fd_func = lambda ts_mat: _higuchi_fd_batch_numba(ts_mat, kmax)
+    else:
+        fd_func = lambda ts_mat: higuchi_fd_batch(ts_mat, kmax)
+    
+    # Process masked voxels in chunks to bound the (n_voxels, nt) working set
+    ix, iy, iz = np.nonzero(mask)
+    total_voxels = len(ix)
+    fd_vals = np.zeros(total_voxels)
+    print(f"Processing {total_voxels} voxels in chunks of {chunk_size}")
+    
+    for start in range(0, total_voxels, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        ts_mat = data[ix[chunk], iy[chunk], iz[chunk]]
+        
+        # Skip time series with no variance
+        valid = np.std(ts_mat, axis=1) > 1e-6
+        if np.any(valid):
+            fd_vals[chunk][valid] = fd_func(ts_mat[valid])
+        
+        done = min(start + chunk_size, total_voxels)
+        print(f"Progress: {done / total_voxels * 100:.1f}% ({done}/{total_voxels} voxels)")
+    
+    # Scatter results back into the volume
+    fd_map[ix, iy, iz] = fd_vals
     
     # Replace NaNs with 0
     fd_map = np.nan_to_num(fd_map)
@@ -1,13 +1,27 @@
 #!/usr/bin/env python3
+import warnings
 import numpy as np
 import nibabel as nib
-from nilearn.input_data import NiftiLabelsMasker, NiftiMapsMasker
+from ts_cache import extract_roi_ts
 import nolds
 from joblib import Parallel, delayed
 
+try:
+    # Optional compiled Higuchi kernels
+    from fractal_numba import higuchi_fd as _higuchi_fd_numba
+    from fractal_numba import higuchi_fd_batch as _higuchi_fd_batch_numba
+except ImportError:
+    _higuchi_fd_numba = None
+    _higuchi_fd_batch_numba = None
+
 def compute_fd(ts, method='hfd', kmax=64):
-    """Return Higuchi or Katz fractal dimension."""
+    """Return Higuchi or Katz fractal dimension (NaN for HFD on a series shorter than 2 * kmax)."""
     if method == 'hfd':
+        if len(ts) < 2 * kmax:
+            warnings.warn(f"HFD with kmax={kmax} needs at least {2 * kmax} time points, got {len(ts)}")
+            return np.nan
+        if _higuchi_fd_numba is not None:
+            return _higuchi_fd_numba(ts, kmax)
         return nolds.hfd(ts, kmax=kmax)
     elif method == 'katz':
         return nolds.katz_fd(ts)
@@ -36,38 +50,54 @@ def fractal_roi_map(fmri_img, atlas_img, use_maps_masker=False,
     min_var : float
         Minimum time‐series variance threshold.
     """
-    # 1) Initialize masker
-    if use_maps_masker:
-        masker = NiftiMapsMasker(maps_img=atlas_img, standardize=True)
-    else:
-        masker = NiftiLabelsMasker(labels_img=atlas_img, standardize=True)
+    # 1-2) Extract ROI time‐series: shape (T, R), reusing a cached
+    # extraction of the same fMRI/atlas pair from another ROI metric
+    ts_data, atlas_labels = extract_roi_ts(fmri_img, atlas_img, use_maps_masker)
 
-    # 2) Extract ROI time‐series
-    ts_data = masker.fit_transform(fmri_img)
-    _, n_rois = ts_data.shape
+    # One C-ordered float32 (R, T) buffer, so each ROI series is contiguous
+    ts_rt = np.ascontiguousarray(ts_data.T, dtype=np.float32)
+    n_rois = ts_rt.shape[0]
 
-    # 3) Parallel FD computation
-    def _process(i):
-        ts = ts_data[:, i]
-        if np.var(ts) < min_var:
-            return np.nan
-        return compute_fd(ts, method=fd_method, kmax=kmax)
+    # 3) FD computation: one compiled batch over all ROIs for HFD if numba
+    # is available, otherwise parallel per-ROI calls, each task getting
+    # only its own ROI series
+    if fd_method == 'hfd' and ts_rt.shape[1] < 2 * kmax:
+        # Too few time points for the lags up to kmax: no HFD value for any ROI
+        warnings.warn(f"HFD with kmax={kmax} needs at least {2 * kmax} time points, "
+                      f"got {ts_rt.shape[1]}; the ROI map is left NaN")
+        fd_vals = np.full(n_rois, np.nan)
+    elif fd_method == 'hfd' and _higuchi_fd_batch_numba is not None:
+        fd_vals = np.full(n_rois, np.nan)
+        valid = np.var(ts_rt, axis=1) >= min_var
+        fd_vals[valid] = _higuchi_fd_batch_numba(ts_rt[valid], kmax)
+    else:
+        def _process(ts):
+            if np.var(ts) < min_var:
+                return np.nan
+            return compute_fd(ts, method=fd_method, kmax=kmax)
 
-    fd_vals = Parallel(n_jobs=n_jobs)(
-        delayed(_process)(i) for i in range(n_rois)
-    )
+        fd_vals = Parallel(n_jobs=n_jobs, backend='loky', max_nbytes='10M')(
+            delayed(_process)(ts_rt[i]) for i in range(n_rois)
+        )
 
     # 4) Build 3D ROI map
     atlas = nib.load(atlas_img)
-    atlas_data = atlas.get_fdata()
-    fd_map = np.zeros_like(atlas_data, dtype=np.float32)
-
-    labels = np.unique(atlas_data)
-    if not use_maps_masker:
-        labels = labels[labels != 0]
 
-    for idx, lab in enumerate(labels):
-        fd_map[atlas_data == lab] = fd_vals[idx]
+    if use_maps_masker:
+        atlas_data = atlas.get_fdata()
+        # Every voxel takes the value of its atlas level, so gather once
+        # instead of zero-filling a map and scattering level by level
+        _, label_idx = np.unique(atlas_data, return_inverse=True)
+        fd_map = np.asarray(fd_vals, dtype=np.float32)[label_idx].reshape(atlas_data.shape)
+    else:
+        # Read the label image as integers instead of a float64 copy
+        atlas_int = np.asanyarray(atlas.dataobj).astype(np.int32, copy=False)
+        # Map every voxel to its position among the sorted label ids, then
+        # gather the ROI values (handles sparse or negative label ids)
+        label_idx = np.searchsorted(atlas_labels, atlas_int)
+        table = np.zeros(len(atlas_labels), dtype=np.float32)
+        table[atlas_labels != 0] = fd_vals
+        fd_map = table[label_idx]
 
     # 5) Return Nifti1Image
     return nib.Nifti1Image(fd_map, affine=atlas.affine, header=atlas.header)
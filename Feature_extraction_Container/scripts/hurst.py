@@ -9,9 +9,36 @@ import time
 import numpy as np
 import nibabel as nib
 import nolds  # For Hurst exponent calculation
+from joblib import Parallel, delayed
 
+try:
+    # Optional compiled batch DFA and R/S kernels
+    from hurst_numba import dfa_batch as _dfa_batch_numba
+    from hurst_numba import hurst_rs_batch as _hurst_rs_batch_numba
+except ImportError:
+    _dfa_batch_numba = _hurst_rs_batch_numba = None
 
-def compute_hurst(fmri_file, output_file, method='dfa', mask_file=None):
+# Number of voxels handed to the worker pool per progress update
+VOXEL_CHUNK_SIZE = 4096
+
+
+def _hurst_or_nan(hurst_func, ts):
+    """Compute the Hurst exponent of one time series, returning NaN if the calculation fails."""
+    try:
+        return hurst_func(ts.astype(np.float64))
+    except Exception:
+        return np.nan
+
+
+def _default_dfa_nvals(n):
+    """Window sizes nolds.dfa uses by default for a series of n samples."""
+    if n > 70:
+        return nolds.logarithmic_n(4, 0.1 * n, 1.2)
+    return [4, 5, 6, 7, 8, 9]
+
+
+def compute_hurst(fmri_file, output_file, method='dfa', mask_file=None, n_jobs=-1,
+                  backend='nolds'):
     """
     Compute Hurst exponent from fMRI data.
     
@@ -25,6 +52,15 @@ def compute_hurst(fmri_file, output_file, method='dfa', mask_file=None):
         Method for Hurst exponent calculation ('dfa' or 'rs'). Default is 'dfa'.
     mask_file : str, optional
         Path to a brain mask. If not provided, a mask will be created based on signal variance.
+    n_jobs : int, optional
+        Number of parallel jobs. Default is -1 (all cores).
+    backend : str, optional
+        'nolds' (per-voxel nolds calls in worker processes) or 'numba' (one
+        compiled multi-threaded batch, using nolds' default window sizes but
+        a least-squares fit of the log-log line instead of nolds' RANSAC fit;
+        the R/S values equal nolds.hurst_rs(ts, fit='poly'), the kernel
+        test_hurst.py validates with). Falls back to nolds when numba is not
+        installed. Default is 'nolds'.
     """
     print("Starting Hurst exponent calculation...")
     start_time = time.time()
@@ -36,37 +72,41 @@ def compute_hurst(fmri_file, output_file, method='dfa', mask_file=None):
     
     # Load fMRI data
     print(f"Loading fMRI data from {fmri_file}...")
-    img = nib.load(fmri_file)
-    data = img.get_fdata()
+    # Stream volumes from the proxy instead of loading the whole 4D series as float64
+    img = nib.load(fmri_file, keep_file_open=True)
+    dobj = img.dataobj
     affine = img.affine
-    header = img.header
     
     # Get dimensions
-    nx, ny, nz, nt = data.shape
+    nx, ny, nz, nt = img.shape
+    
+    # Output maps are 3D float32, whatever the input data type
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape((nx, ny, nz))
     print(f"Data dimensions: {nx} x {ny} x {nz} x {nt}")
     
     # Create or load mask
     if mask_file:
         print(f"Loading mask from {mask_file}...")
         mask_img = nib.load(mask_file)
-        mask = mask_img.get_fdata() > 0
+        mask = np.asanyarray(mask_img.dataobj) > 0
     else:
         print("Creating mask from fMRI data...")
-        # Simple mask: voxels with non-zero variance
-        mask = np.std(data, axis=3) > 0
+        # Simple mask: voxels with non-zero variance, i.e. any sample differing
+        # from the first one (compared one volume at a time)
+        mask = np.zeros((nx, ny, nz), dtype=bool)
+        first = np.asarray(dobj[..., 0])
+        for t in range(1, nt):
+            np.logical_or(mask, np.asarray(dobj[..., t]) != first, out=mask)
     
     # Ensure mask dimensions match
-    if mask.shape[:3] != data.shape[:3]:
+    if mask.shape[:3] != (nx, ny, nz):
         raise ValueError("Mask dimensions do not match fMRI data dimensions")
     
     # Create Hurst exponent map
     print(f"Calculating Hurst exponent using {method} method...")
-    hurst_map = np.zeros((nx, ny, nz))
-    
-    # Loop through masked voxels
-    total_voxels = np.sum(mask)
-    processed_voxels = 0
-    last_update = 0
+    hurst_map = np.zeros((nx, ny, nz), dtype=np.float32)
     
     # Set Hurst calculation method
     if method == 'dfa':
@@ -77,44 +117,70 @@ def compute_hurst(fmri_file, output_file, method='dfa', mask_file=None):
         print(f"Unknown method {method}. Using DFA (detrended fluctuation analysis).")
         hurst_func = nolds.dfa
     
-    for x in range(nx):
-        for y in range(ny):
-            for z in range(nz):
-                if mask[x, y, z]:
-                    # Get time series for this voxel
-                    ts = data[x, y, z, :]
-                    
-                    # Skip if time series has no variance
-                    if np.std(ts) <= 1e-6:
-                        continue
-                    
-                    try:
-                        # Calculate Hurst exponent
-                        hurst_map[x, y, z] = hurst_func(ts)
-                    except Exception as e:
-                        # If calculation fails, set to NaN
-                        hurst_map[x, y, z] = np.nan
-                        print(f"Error calculating Hurst at ({x},{y},{z}): {e}")
-                    
-                    processed_voxels += 1
-                    
-                    # Update progress every 5%
-                    progress = processed_voxels / total_voxels
-                    if progress - last_update >= 0.05:
-                        print(f"Progress: {progress * 100:.1f}% ({processed_voxels}/{total_voxels} voxels)")
-                        last_update = progress
-    
-    # Replace NaNs with 0
-    hurst_map = np.nan_to_num(hurst_map)
-    
-    # Normalize Hurst map for visualization (z-score)
-    brain_mask = (hurst_map > 0) & (hurst_map < 2)  # Valid Hurst range
-    if np.sum(brain_mask) > 0:
-        mean_hurst = np.mean(hurst_map[brain_mask])
-        std_hurst = np.std(hurst_map[brain_mask])
+    use_numba = backend == 'numba'
+    if use_numba and _dfa_batch_numba is None:
+        print("Warning: numba is not installed. Using nolds.")
+        use_numba = False
+    
+    # Gather masked time series volume by volume and skip those with no variance
+    ts_mat = np.empty((int(np.sum(mask)), nt), dtype=np.float32)
+    for t in range(nt):
+        ts_mat[:, t] = np.asarray(dobj[..., t])[mask]
+    valid = np.std(ts_mat, axis=1) > 1e-6
+    total_voxels = int(np.sum(valid))
+    print(f"Processing {total_voxels} voxels")
+    
+    # Voxels are independent, so distribute them over worker processes,
+    # one chunk at a time so progress is reported per chunk, not per voxel
+    valid_ts = ts_mat[valid]
+    valid_vals = np.empty(total_voxels)
+    if use_numba:
+        # The compiled kernel is threaded over voxels itself
+        if hurst_func is nolds.dfa:
+            nvals = _default_dfa_nvals(nt)
+            batch_func = lambda ts_mat: _dfa_batch_numba(ts_mat, nvals)
+        else:
+            batch_func = _hurst_rs_batch_numba
+        for start in range(0, total_voxels, VOXEL_CHUNK_SIZE):
+            stop = min(start + VOXEL_CHUNK_SIZE, total_voxels)
+            try:
+                valid_vals[start:stop] = batch_func(valid_ts[start:stop])
+            except ValueError:
+                # Time series too short for the window sizes
+                valid_vals[start:stop] = np.nan
+            print(f"Progress: {stop / total_voxels * 100:.1f}% ({stop}/{total_voxels} voxels)")
+    else:
+        with Parallel(n_jobs=n_jobs, batch_size='auto') as parallel:
+            for start in range(0, total_voxels, VOXEL_CHUNK_SIZE):
+                stop = min(start + VOXEL_CHUNK_SIZE, total_voxels)
+                valid_vals[start:stop] = parallel(
+                    delayed(_hurst_or_nan)(hurst_func, ts) for ts in valid_ts[start:stop]
+                )
+                print(f"Progress: {stop / total_voxels * 100:.1f}% ({stop}/{total_voxels} voxels)")
+    
+    hurst_vals = np.zeros(len(ts_mat))
+    hurst_vals[valid] = valid_vals
+    
+    n_failed = int(np.sum(np.isnan(hurst_vals)))
+    if n_failed:
+        print(f"Warning: Hurst calculation failed for {n_failed} voxels (set to NaN)")
+    
+    # Replace NaNs with 0 on the masked values only
+    hurst_vals = np.nan_to_num(hurst_vals).astype(np.float32)
+    hurst_map[mask] = hurst_vals
+    
+    # Normalize Hurst map for visualization (z-score), working on the
+    # masked values rather than re-indexing the full map
+    in_range = (hurst_vals > 0) & (hurst_vals < 2)  # Valid Hurst range
+    if np.any(in_range):
+        vals = hurst_vals[in_range]
+        mean_hurst = vals.mean()
+        std_hurst = vals.std()
         if std_hurst > 0:
+            norm_vals = np.zeros_like(hurst_vals)
+            norm_vals[in_range] = (vals - mean_hurst) / std_hurst
             hurst_map_norm = np.zeros_like(hurst_map)
-            hurst_map_norm[brain_mask] = (hurst_map[brain_mask] - mean_hurst) / std_hurst
+            hurst_map_norm[mask] = norm_vals
             
             # Save both raw and normalized maps
             print(f"Saving Hurst exponent map to {output_file}...")
@@ -147,7 +213,10 @@ if __name__ == '__main__':
     parser.add_argument('--method', choices=['dfa', 'rs'], default='dfa',
                       help='Method for Hurst calculation (dfa or rs). Default is dfa.')
     parser.add_argument('--mask', help='Brain mask (optional, will be created if not provided)')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='Number of parallel jobs (default: all cores)')
+    parser.add_argument('--backend', choices=['nolds', 'numba'], default='nolds',
+                      help='Hurst implementation (nolds or numba). Default is nolds.')
     
     args = parser.parse_args()
     
-    compute_hurst(args.fmri, args.output, args.method, args.mask) 
\ No newline at end of file
+    compute_hurst(args.fmri, args.output, args.method, args.mask, args.n_jobs, args.backend) 
\ No newline at end of file
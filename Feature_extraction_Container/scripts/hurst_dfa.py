@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 import numpy as np
 import nibabel as nib
-from nilearn.input_data import NiftiLabelsMasker, NiftiMapsMasker
+from ts_cache import extract_roi_ts
 import nolds
 from joblib import Parallel, delayed
 
-def compute_hurst_dfa(ts, nvals=(4,8,16,32,64)):
+try:
+    # Optional compiled batch DFA kernel
+    from hurst_numba import dfa_batch as _dfa_batch_numba
+except ImportError:
+    _dfa_batch_numba = None
+
+DFA_NVALS = (4, 8, 16, 32, 64)
+
+def compute_hurst_dfa(ts, nvals=DFA_NVALS):
     """DFA‐based Hurst exponent via nolds."""
     return nolds.dfa(ts, overlap=True, nvals=nvals)
 
@@ -27,41 +35,55 @@ def hurst_roi_map(fmri_img, atlas_img, use_maps_masker=False,
     min_var : float
         Minimum time‐series variance threshold.
     """
-    # 1) Initialize masker
-    if use_maps_masker:
-        masker = NiftiMapsMasker(maps_img=atlas_img, standardize=True)
-    else:
-        masker = NiftiLabelsMasker(labels_img=atlas_img, standardize=True)
+    # 1-2) Extract ROI time‐series: shape (T, R), reusing a cached
+    # extraction of the same fMRI/atlas pair from another ROI metric
+    ts_data, atlas_labels = extract_roi_ts(fmri_img, atlas_img, use_maps_masker)
 
-    # 2) Extract ROI time‐series: shape (T, R)
-    ts_data = masker.fit_transform(fmri_img)
-    _, n_rois = ts_data.shape
+    # One C-ordered float32 (R, T) buffer, so each ROI series is contiguous
+    ts_rt = np.ascontiguousarray(ts_data.T, dtype=np.float32)
+    n_rois = ts_rt.shape[0]
 
-    # 3) Parallel Hurst computation
-    def _process(i):
-        ts = ts_data[:, i]
-        if np.var(ts) < min_var:
-            return np.nan
+    # 3) Hurst computation, in one compiled batch if numba is available
+    if _dfa_batch_numba is not None:
+        hurst_vals = np.full(n_rois, np.nan)
+        valid = np.var(ts_rt, axis=1) >= min_var
         try:
-            return compute_hurst_dfa(ts)
-        except Exception:
-            return np.nan
+            hurst_vals[valid] = _dfa_batch_numba(ts_rt[valid], DFA_NVALS)
+        except ValueError:
+            # Time series too short for the DFA window sizes
+            pass
+    else:
+        # Each task gets only its own ROI series rather than a closure over ts_data
+        def _process(ts):
+            if np.var(ts) < min_var:
+                return np.nan
+            try:
+                return compute_hurst_dfa(ts)
+            except Exception:
+                return np.nan
 
-    hurst_vals = Parallel(n_jobs=n_jobs)(
-        delayed(_process)(i) for i in range(n_rois)
-    )
+        hurst_vals = Parallel(n_jobs=n_jobs, backend='loky', max_nbytes='10M')(
+            delayed(_process)(ts_rt[i]) for i in range(n_rois)
+        )
 
     # 4) Load atlas and build ROI‐map
     atlas = nib.load(atlas_img)
-    atlas_data = atlas.get_fdata()
-    roi_map = np.zeros_like(atlas_data, dtype=np.float32)
-
-    labels = np.unique(atlas_data)
-    if not use_maps_masker:
-        labels = labels[labels != 0]
 
-    for idx, lab in enumerate(labels):
-        roi_map[atlas_data == lab] = hurst_vals[idx]
+    if use_maps_masker:
+        atlas_data = atlas.get_fdata()
+        # Every voxel takes the value of its atlas level, so gather once
+        # instead of zero-filling a map and scattering level by level
+        _, label_idx = np.unique(atlas_data, return_inverse=True)
+        roi_map = np.asarray(hurst_vals, dtype=np.float32)[label_idx].reshape(atlas_data.shape)
+    else:
+        # Read the label image as integers instead of a float64 copy
+        atlas_int = np.asanyarray(atlas.dataobj).astype(np.int32, copy=False)
+        # Map every voxel to its position among the sorted label ids, then
+        # gather the ROI values (handles sparse or negative label ids)
+        label_idx = np.searchsorted(atlas_labels, atlas_int)
+        table = np.zeros(len(atlas_labels), dtype=np.float32)
+        table[atlas_labels != 0] = hurst_vals
+        roi_map = table[label_idx]
 
     # 5) Return Nifti1Image
     return nib.Nifti1Image(roi_map, affine=atlas.affine, header=atlas.header)
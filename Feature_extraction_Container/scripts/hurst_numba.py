@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Numba-compiled kernels for computing the DFA and R/S Hurst exponents from fMRI data.
+"""
+
+import math
+import numpy as np
+import numba
+from numba import prange
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _dfa_batch(ts_mat, nvals, log_n, sum_x, sum_xx):
+    n_series, n = ts_mat.shape
+    n_scales = nvals.shape[0]
+    out = np.empty(n_series)
+
+    for v in prange(n_series):
+        # Signal profile (cumulative sum of deviations from the mean)
+        mean = 0.0
+        for i in range(n):
+            mean += ts_mat[v, i]
+        mean /= n
+        walk = np.empty(n)
+        acc = 0.0
+        for i in range(n):
+            acc += ts_mat[v, i] - mean
+            walk[i] = acc
+
+        # Regression sums of log F(n) against log n; the log n sums are
+        # precomputed over all scales, only the dropped scales are subtracted
+        n_keep = n_scales
+        sx = sum_x
+        sxx = sum_xx
+        sy = 0.0
+        sxy = 0.0
+
+        for s in range(n_scales):
+            w = nvals[s]
+            x_mean = (w - 1) / 2.0
+            x_ss = w * (w * w - 1) / 12.0
+
+            # Overlapping windows with step size w/2
+            total = 0.0
+            n_win = 0
+            for start in range(0, n - w, w // 2):
+                y_mean = 0.0
+                for j in range(w):
+                    y_mean += walk[start + j]
+                y_mean /= w
+
+                sxy_w = 0.0
+                syy_w = 0.0
+                for j in range(w):
+                    dy = walk[start + j] - y_mean
+                    sxy_w += (j - x_mean) * dy
+                    syy_w += dy * dy
+
+                # Residual sum of squares around the closed-form linear trend
+                rss = syy_w - sxy_w * sxy_w / x_ss
+                if rss > 0.0:
+                    total += rss / w
+                n_win += 1
+
+            f_n = np.sqrt(total / n_win)
+            if f_n > 0.0:
+                log_f = np.log(f_n)
+                sy += log_f
+                sxy += log_n[s] * log_f
+            else:
+                n_keep -= 1
+                sx -= log_n[s]
+                sxx -= log_n[s] * log_n[s]
+
+        # Closed-form least-squares slope
+        if n_keep < 2:
+            out[v] = np.nan
+        else:
+            out[v] = (n_keep * sxy - sx * sy) / (n_keep * sxx - sx * sx)
+
+    return out
+
+
+def dfa_batch(ts_mat, nvals=(4, 8, 16, 32, 64)):
+    """
+    Compute the DFA Hurst exponent for many time series at once,
+    in parallel over series.
+
+    Uses overlapping windows and a linear trend per window, like
+    nolds.dfa(ts, overlap=True, nvals=nvals), with a least-squares
+    fit of log F(n) against log n.
+
+    Parameters:
+    -----------
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints).
+        float32 input (as read from the BOLD data) is used as is, without a
+        float64 copy; the sums are accumulated in float64.
+    nvals : sequence of int
+        Window sizes. Default is (4, 8, 16, 32, 64).
+
+    Returns:
+    --------
+    numpy.ndarray
+        DFA Hurst exponent of each row of ts_mat
+    """
+    ts_mat = np.ascontiguousarray(np.atleast_2d(ts_mat))
+    nvals = np.asarray(nvals, dtype=np.int64)
+    if len(nvals) < 2:
+        raise ValueError("at least two nvals are needed")
+    if np.min(nvals) < 2:
+        raise ValueError("nvals must be at least two")
+    if np.max(nvals) >= ts_mat.shape[1]:
+        raise ValueError("nvals cannot be larger than the input size")
+    log_n = np.log(nvals.astype(np.float64))
+    return _dfa_batch(ts_mat, nvals, log_n, log_n.sum(), (log_n * log_n).sum())
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _hurst_rs_batch(ts_mat, nvals, log_n, log_expected_rs, sum_x, sum_xx):
+    n_series, n = ts_mat.shape
+    n_scales = nvals.shape[0]
+    out = np.empty(n_series)
+
+    for v in prange(n_series):
+        # Regression sums of log (R/S)_n against log n; the log n sums are
+        # precomputed over all scales, only the dropped scales are subtracted
+        n_keep = n_scales
+        sx = sum_x
+        sxx = sum_xx
+        sy = 0.0
+        sxy = 0.0
+
+        for s in range(n_scales):
+            w = nvals[s]
+            # Non-overlapping subsequences of length w, dropping the tail
+            rs_sum = 0.0
+            n_rs = 0
+            for start in range(0, n - w + 1, w):
+                mean = 0.0
+                for j in range(w):
+                    mean += ts_mat[v, start + j]
+                mean /= w
+
+                # Range of the cumulative deviations and the sum of squares,
+                # accumulated in the same pass
+                dev = ts_mat[v, start] - mean
+                z = dev
+                z_min = z
+                z_max = z
+                ss = dev * dev
+                for j in range(1, w):
+                    dev = ts_mat[v, start + j] - mean
+                    z += dev
+                    ss += dev * dev
+                    if z < z_min:
+                        z_min = z
+                    elif z > z_max:
+                        z_max = z
+
+                # Subsequences with zero range are left out
+                r = z_max - z_min
+                if r != 0.0:
+                    rs_sum += r / np.sqrt(ss / (w - 1))
+                    n_rs += 1
+
+            if n_rs > 0:
+                # Anis-Lloyd-Peters corrected log (R/S)_n
+                log_rs = np.log(rs_sum / n_rs) - log_expected_rs[s]
+                sy += log_rs
+                sxy += log_n[s] * log_rs
+            else:
+                n_keep -= 1
+                sx -= log_n[s]
+                sxx -= log_n[s] * log_n[s]
+
+        # Closed-form least-squares slope
+        if n_keep < 2:
+            out[v] = np.nan
+        else:
+            out[v] = (n_keep * sxy - sx * sy) / (n_keep * sxx - sx * sx) + 0.5
+
+    return out
+
+
+def _expected_rs(n):
+    """Expected (R/S)_n of white noise (Anis-Lloyd-Peters), as in nolds.expected_rs."""
+    front = (n - 0.5) / n
+    i = np.arange(1, n)
+    back = np.sum(np.sqrt((n - i) / i))
+    if n <= 340:
+        middle = math.gamma((n - 1) * 0.5) / math.sqrt(math.pi) / math.gamma(n * 0.5)
+    else:
+        middle = 1.0 / math.sqrt(n * math.pi * 0.5)
+    return front * middle * back
+
+
+def hurst_rs_batch(ts_mat, nvals=None):
+    """
+    Compute the rescaled-range (R/S) Hurst exponent for many time series at
+    once, in parallel over series.
+
+    Uses non-overlapping subsequences, the unbiased standard deviation and the
+    Anis-Lloyd-Peters correction, like nolds.hurst_rs(ts, fit='poly'), with a
+    least-squares fit of log (R/S)_n against log n.
+
+    Parameters:
+    -----------
+    ts_mat : numpy.ndarray
+        2-D array of time series with shape (n_series, n_timepoints).
+        float32 input (as read from the BOLD data) is used as is, without a
+        float64 copy; the sums are accumulated in float64.
+    nvals : sequence of int, optional
+        Subsequence lengths. Default is the nolds default, 15 logarithmically
+        spaced values in the middle 25% of the logarithmic range.
+
+    Returns:
+    --------
+    numpy.ndarray
+        R/S Hurst exponent of each row of ts_mat
+    """
+    ts_mat = np.ascontiguousarray(np.atleast_2d(ts_mat))
+    n = ts_mat.shape[1]
+    if nvals is None:
+        # nolds.logmid_n(n, ratio=1/4.0, nsteps=15)
+        log_max = np.log(n)
+        midrange = log_max * 0.375 + np.arange(15) / 15.0 * log_max * 0.25
+        nvals = np.unique(np.round(np.exp(midrange)).astype(np.int32))
+    nvals = np.asarray(nvals, dtype=np.int64)
+    if np.min(nvals) < 2 or np.max(nvals) > n:
+        raise ValueError("nvals must lie between 2 and the input size")
+    log_n = np.log(nvals.astype(np.float64))
+    log_expected_rs = np.log([_expected_rs(int(w)) for w in nvals])
+    return _hurst_rs_batch(ts_mat, nvals, log_n, log_expected_rs, log_n.sum(), (log_n * log_n).sum())
+
+
+@numba.njit(cache=True)
+def _positive_stats(values):
+    count = 0
+    total = 0.0
+    pos_min = np.inf
+    all_max = -np.inf
+    for i in range(values.shape[0]):
+        v = values[i]
+        if v > all_max:
+            all_max = v
+        if v > 0:
+            count += 1
+            total += v
+            if v < pos_min:
+                pos_min = v
+    return count, total, pos_min, all_max
+
+
+def positive_stats(values):
+    """
+    Summary statistics of a Hurst map in a single pass.
+
+    Parameters:
+    -----------
+    values : numpy.ndarray
+        Map values (any shape)
+
+    Returns:
+    --------
+    tuple
+        (count, sum, min) of the positive values and the max of all values
+    """
+    return _positive_stats(np.ascontiguousarray(values).ravel())
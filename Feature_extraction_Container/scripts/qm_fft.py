@@ -8,11 +8,11 @@ import argparse
 import time
 import logging
 import sys
-import h5py
-import glob
 import numpy as np
 import nibabel as nib
 from pathlib import Path
+from qm_fft_utils import (consolidate_mapbuilder_to_hdf5, consolidate_mapbuilder_to_zarr, read_masked_volumes,
+                          remove_tree_in_background, nufft_device_kwargs, nufft_dtype)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,42 +26,10 @@ except ImportError as e:
     sys.exit(1)
 
 
-def consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_h5_path):
-    """
-    Finds all .npy files in the MapBuilder output directory (data, analysis subdirs)
-    and saves them into a single HDF5 file, preserving relative structure.
-    """
-    logging.info(f"Consolidating results from {mapbuilder_subject_dir} into {output_h5_path}")
-    os.makedirs(os.path.dirname(output_h5_path), exist_ok=True)
-    
-    with h5py.File(output_h5_path, 'w') as hf:
-        search_dirs = [mapbuilder_subject_dir / 'data', mapbuilder_subject_dir / 'analysis']
-        npy_files = []
-        for d in search_dirs:
-            if d.exists():
-                # Recursively find all .npy files
-                npy_files.extend(glob.glob(str(d / '**/*.npy'), recursive=True)) 
-        
-        if not npy_files:
-            logging.warning(f"No .npy files found in {mapbuilder_subject_dir} subdirectories.")
-            return
-            
-        for npy_file in npy_files:
-            try:
-                data = np.load(npy_file)
-                relative_path = os.path.relpath(npy_file, mapbuilder_subject_dir)
-                dataset_path = Path(relative_path).with_suffix('').as_posix() 
-                
-                logging.debug(f"Saving {npy_file} to HDF5 dataset: {dataset_path}")
-                hf.create_dataset(dataset_path, data=data)
-            except Exception as e:
-                logging.error(f"Failed to load or save {npy_file} to HDF5: {e}")
-
-    logging.info("HDF5 consolidation complete.")
-
 
 def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None, 
-                  eps=1e-6, radius=0.6, local_k=5):
+                  eps=1e-6, radius=0.6, local_k=5, dtype='auto', backend='h5',
+                  device='cpu'):
     """
     Compute QM-FFT (Quantum Mechanics-inspired Fast Fourier Transform) features from fMRI data.
     
@@ -70,7 +38,8 @@ def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None,
     fmri_file : str
         Path to the input fMRI data
     output_file : str
-        Path to save the QM-FFT features (HDF5 format)
+        Path to save the QM-FFT features (HDF5 file, or Zarr directory store
+        with backend='zarr')
     mask_file : str, optional
         Path to a brain mask. If not provided, a mask will be created based on signal variance.
     subject_id : str, optional
@@ -81,6 +50,16 @@ def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None,
         K-space mask radius. Default is 0.6.
     local_k : int, optional
         Number of neighbors for local variance. Default is 5.
+    dtype : str, optional
+        Complex precision of the FINUFFT strengths ('complex64', 'complex128'
+        or 'auto'). Default is 'auto': complex64, with single-precision kernels
+        and float32 coordinates, when eps >= 1e-6, otherwise complex128.
+    backend : str, optional
+        Output format, 'h5' (default) or 'zarr'. The Zarr store is written
+        from several threads at once; read it with zarr.open(output_file).
+    device : str, optional
+        'cpu' (default) or 'cuda' to run the NUFFTs with cufinufft. Falls back
+        to the CPU when no GPU, cufinufft or GPU-capable MapBuilder is available.
     """
     print("Starting QM-FFT calculation...")
     start_time = time.time()
@@ -104,46 +83,57 @@ def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None,
     try:
         # Load fMRI data and mask
         print(f"Loading fMRI data from {fmri_file}...")
-        fmri_img = nib.load(fmri_file)
-        fmri_data = fmri_img.get_fdata(dtype=np.float32)
+        # Keep the data on disk and stream volumes from the proxy; only the
+        # in-mask voxels are ever held in memory
+        fmri_img = nib.load(fmri_file, keep_file_open=True)
         affine = fmri_img.affine
         
         # Load or create mask
         if mask_file:
             print(f"Loading mask from {mask_file}...")
             mask_img = nib.load(mask_file)
-            mask_data = mask_img.get_fdata().astype(bool)
+            mask_data = np.asanyarray(mask_img.dataobj) != 0
         else:
             print("Creating mask from fMRI data...")
-            # Simple mask: voxels with non-zero variance
-            mask_data = np.std(fmri_data, axis=3) > 0
+            # Simple mask: voxels with non-zero variance, i.e. any sample differing
+            # from the first one (compared one volume at a time, no arithmetic)
+            dataobj = fmri_img.dataobj
+            first = np.asarray(dataobj[..., 0])
+            mask_data = np.zeros(fmri_img.shape[:3], dtype=bool)
+            for t in range(1, fmri_img.shape[3]):
+                np.logical_or(mask_data, np.asarray(dataobj[..., t]) != first, out=mask_data)
         
         # Ensure mask dimensions match
-        if fmri_data.shape[:3] != mask_data.shape:
+        if fmri_img.shape[:3] != mask_data.shape:
             raise ValueError("Mask dimensions do not match fMRI data dimensions")
         
         # Extract voxel coordinates and time series
         print("Extracting voxel coordinates and time series...")
-        mask_indices = np.array(np.where(mask_data)).T
-        voxel_coords_ijk1 = np.hstack((mask_indices, np.ones((mask_indices.shape[0], 1))))
-        voxel_coords_xyz = nib.affines.apply_affine(affine, voxel_coords_ijk1[:, :3])
+        mask_indices = np.argwhere(mask_data).astype(np.int32, copy=False)
+        # Voxel-to-world transform as one matmul plus shift, in the real
+        # precision matching the strengths (float32 for complex64)
+        strengths_dtype = nufft_dtype(eps) if dtype == 'auto' else np.dtype(dtype)
+        coord_dtype = np.finfo(strengths_dtype).dtype
+        affine_rot = affine[:3, :3].astype(coord_dtype)
+        affine_shift = affine[:3, 3].astype(coord_dtype)
+        # Stored as (3, V) so each axis is a contiguous row
+        voxel_coords_xyz = affine_rot @ mask_indices.T.astype(coord_dtype)
+        voxel_coords_xyz += affine_shift[:, np.newaxis]
         
-        # Extract time series for each voxel in the mask
-        voxel_time_series = fmri_data[mask_indices[:, 0], mask_indices[:, 1], mask_indices[:, 2], :]
-        n_voxels, n_timepoints = voxel_time_series.shape
+        # Extract time series for each voxel in the mask, already transposed to
+        # (T, V) with time as first dimension (required by MapBuilder); the voxel
+        # order matches np.argwhere
+        time_series_tv = read_masked_volumes(fmri_img, mask_data)
+        n_timepoints, n_voxels = time_series_tv.shape
         print(f"Extracted {n_voxels} voxels, {n_timepoints} time points.")
         
-        # Transpose to get time as first dimension (required by MapBuilder)
-        strengths_real = np.ascontiguousarray(voxel_time_series.T)
-        
-        # Create complex array (real values with zero imaginary part)
-        strengths_imag = np.zeros_like(strengths_real)
-        strengths_complex = np.ascontiguousarray(strengths_real + 1j * strengths_imag)
+        # Copy straight into the real part of a single complex allocation
+        strengths_complex = np.empty((n_timepoints, n_voxels), dtype=strengths_dtype)
+        np.copyto(strengths_complex.real, time_series_tv)
+        strengths_complex.imag.fill(0.0)
         
-        # Get spatial coordinates for each voxel
-        x_coords = np.ascontiguousarray(voxel_coords_xyz[:, 0])
-        y_coords = np.ascontiguousarray(voxel_coords_xyz[:, 1])
-        z_coords = np.ascontiguousarray(voxel_coords_xyz[:, 2])
+        # Get spatial coordinates for each voxel (contiguous row views, no copies)
+        x_coords, y_coords, z_coords = voxel_coords_xyz
         
         # Run MapBuilder
         print("Initializing MapBuilder...")
@@ -153,9 +143,12 @@ def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None,
             x=x_coords,
             y=y_coords,
             z=z_coords,
+            # One C-contiguous (T, V) array for all time points, so the
+            # transforms share one set of points (FINUFFT n_trans=T)
             strengths=strengths_complex,
             eps=eps,
-            dtype='complex128'
+            dtype=strengths_dtype.name,
+            **nufft_device_kwargs(device, MapBuilder)
         )
         
         mapbuilder_subject_dir = temp_mapbuilder_base / subject_id
@@ -179,16 +172,18 @@ def compute_qm_fft(fmri_file, output_file, mask_file=None, subject_id=None,
         )
         print(f"MapBuilder processing complete. Consolidating results...")
         
-        # Consolidate results to HDF5
+        # Consolidate results to HDF5 (or Zarr)
         if mapbuilder_subject_dir.exists():
-            consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_file)
+            if backend == 'zarr':
+                consolidate_mapbuilder_to_zarr(mapbuilder_subject_dir, output_file)
+            else:
+                consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_file)
         else:
             raise Exception(f"MapBuilder output directory not found after processing: {mapbuilder_subject_dir}")
         
-        # Optional: Clean up temporary directory
-        # import shutil
-        # print(f"Cleaning up temporary directory: {temp_mapbuilder_base}")
-        # shutil.rmtree(temp_mapbuilder_base)
+        # Clean up temporary directory (in the background)
+        print(f"Cleaning up temporary directory: {temp_mapbuilder_base}")
+        remove_tree_in_background(temp_mapbuilder_base)
         
     except Exception as e:
         print(f"Error during QM-FFT analysis: {e}")
@@ -211,6 +206,12 @@ if __name__ == '__main__':
     parser.add_argument('--eps', type=float, default=1e-6, help='FINUFFT precision (default: 1e-6)')
     parser.add_argument('--radius', type=float, default=0.6, help='K-space mask radius (default: 0.6)')
     parser.add_argument('--local-k', type=int, default=5, help='Number of neighbors for local variance (default: 5)')
+    parser.add_argument('--dtype', choices=['auto', 'complex64', 'complex128'], default='auto',
+                        help='Complex precision of the FINUFFT strengths (default: auto, complex64 when eps >= 1e-6)')
+    parser.add_argument('--backend', choices=['h5', 'zarr'], default='h5',
+                        help='Output format: HDF5 file or Zarr directory store (default: h5)')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Run the NUFFTs on the CPU (FINUFFT) or a CUDA GPU (cufinufft) (default: cpu)')
     
     args = parser.parse_args()
     
@@ -221,5 +222,8 @@ if __name__ == '__main__':
         args.subject_id,
         args.eps,
         args.radius,
-        args.local_k
+        args.local_k,
+        args.dtype,
+        args.backend,
+        args.device
     ) 
\ No newline at end of file
@@ -4,10 +4,15 @@ from pathlib import Path
 import logging
 import sys
 import h5py 
-import glob 
 import os 
 import argparse
-import shutil
+from qm_fft_utils import (consolidate_mapbuilder_to_hdf5, consolidate_mapbuilder_to_zarr, read_masked_volumes,
+                          remove_tree_in_background, nufft_device_kwargs, nufft_dtype)
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
 
 # Add QM_FFT_Feature_Package path to sys.path
 qm_fft_package_path = '/app/QM_FFT_Feature_Package'
@@ -27,7 +32,7 @@ parser.add_argument('--mask', type=str,
                     help="Path to the input brain mask NIfTI file.")
 parser.add_argument('--output_h5', type=str, 
                     default="./feature_extraction/qm_fft_test_result.h5",
-                    help="Path for the output HDF5 features file.")
+                    help="Path for the output HDF5 features file (a Zarr directory store with --backend zarr).")
 parser.add_argument('--subject_id', type=str, default="sub-17017_test",
                     help="Subject ID for the analysis.")
 parser.add_argument('--eps', type=float, default=1e-6,
@@ -36,6 +41,12 @@ parser.add_argument('--radius', type=float, default=0.6,
                     help="K-space mask radius.")
 parser.add_argument('--local_k', type=int, default=5,
                     help="Number of neighbors for local variance.")
+parser.add_argument('--dtype', choices=['auto', 'complex64', 'complex128'], default='auto',
+                    help="Complex precision of the FINUFFT strengths (complex64 uses single-precision kernels; auto picks it when eps >= 1e-6).")
+parser.add_argument('--backend', choices=['h5', 'zarr'], default='h5',
+                    help="Output format: HDF5 file or Zarr directory store (read it with zarr.open).")
+parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                    help="Run the NUFFTs on the CPU (FINUFFT) or a CUDA GPU (cufinufft, falls back to CPU if unavailable).")
 parser.add_argument('--sample', action='store_true',
                     help="Process only a sample number of time points for testing.")
 parser.add_argument('--sample_tp', type=int, default=20,
@@ -50,6 +61,9 @@ subject_id = args.subject_id
 finufft_precision = args.eps
 kspace_masks_radius = args.radius
 local_var_k = args.local_k
+strengths_dtype = nufft_dtype(finufft_precision) if args.dtype == 'auto' else np.dtype(args.dtype)
+output_backend = args.backend
+nufft_device = args.device
 
 # Ensure output directory exists
 output_hdf5_path.parent.mkdir(parents=True, exist_ok=True)
@@ -67,49 +81,92 @@ except ImportError as e:
     logging.error("Ensure the package is installed and accessible (check PYTHONPATH).")
     sys.exit(1)
 
-# --- Function to consolidate MapBuilder results into HDF5 --- 
-def consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_h5_path):
+
+def _normalize_coords(voxel_coords_xyz, max_allowed=3.0):
     """
-    Finds all .npy files in the MapBuilder output directory (data, analysis subdirs)
-    and saves them into a single HDF5 file, preserving relative structure.
+    Scale (3, V) world coordinates in place to [-max_allowed, max_allowed], which
+    lies within FINUFFT's expected [-3pi, 3pi] range, and return them as x, y, z
+    arrays (contiguous row views, no copies).
     """
-    logging.info(f"--> Entering consolidate_mapbuilder_to_hdf5")
-    logging.info(f"Consolidating results from {mapbuilder_subject_dir} into {output_h5_path}")
-    output_h5_path.parent.mkdir(parents=True, exist_ok=True)
+    lo = voxel_coords_xyz.min(axis=1)
+    hi = voxel_coords_xyz.max(axis=1)
+    logging.info("Original coordinate ranges: X=[%.2f, %.2f], Y=[%.2f, %.2f], Z=[%.2f, %.2f]",
+                 lo[0], hi[0], lo[1], hi[1], lo[2], hi[2])
     
-    files_processed_count = 0
-    with h5py.File(output_h5_path, 'w') as hf:
-        search_dirs = [mapbuilder_subject_dir / 'data', mapbuilder_subject_dir / 'analysis']
-        npy_files = []
-        logging.info(f"--> Searching for .npy files in: {search_dirs}")
-        for d in search_dirs:
-            if d.exists():
-                # Recursively find all .npy files
-                found = glob.glob(str(d / '**/*.npy'), recursive=True)
-                logging.info(f"--> Found {len(found)} .npy files in {d}")
-                npy_files.extend(found) 
-        
-        logging.info(f"--> Total .npy files found: {len(npy_files)}")
-        if not npy_files:
-            logging.warning(f"No .npy files found in {mapbuilder_subject_dir} subdirectories.")
-            logging.info("--> Exiting consolidate_mapbuilder_to_hdf5 (no files)")
-            return
-            
-        for npy_file in npy_files:
-            try:
-                logging.debug(f"--> Processing file: {npy_file}")
-                data = np.load(npy_file)
-                relative_path = os.path.relpath(npy_file, mapbuilder_subject_dir)
-                dataset_path = Path(relative_path).with_suffix('').as_posix() 
-                
-                logging.debug(f"Saving {npy_file} to HDF5 dataset: {dataset_path}")
-                hf.create_dataset(dataset_path, data=data)
-                files_processed_count += 1
-            except Exception as e:
-                logging.error(f"Failed to load or save {npy_file} to HDF5: {e}")
+    # Largest absolute coordinate over all three axes, from the ranges above
+    max_coord = float(max(-lo.min(), hi.max()))
+    scale_factor = max_allowed / max_coord if max_coord > 0 else 1.0
+    voxel_coords_xyz *= scale_factor
+    
+    lo, hi = lo * scale_factor, hi * scale_factor
+    logging.info("Normalized coordinate ranges (scale=%.4f): X=[%.2f, %.2f], Y=[%.2f, %.2f], Z=[%.2f, %.2f]",
+                 scale_factor, lo[0], hi[0], lo[1], hi[1], lo[2], hi[2])
+    return voxel_coords_xyz[0], voxel_coords_xyz[1], voxel_coords_xyz[2]
+
+
+def _prepare_inputs(fmri_img, mask, affine, spatial_slice=None, n_tp=None):
+    """
+    Build the MapBuilder inputs from the in-mask voxels with non-zero variance.
+
+    Parameters:
+    -----------
+    fmri_img : nibabel.Nifti1Image
+        4D fMRI image; volumes are streamed from its data proxy
+    mask : numpy.ndarray
+        3D boolean brain mask
+    affine : numpy.ndarray
+        4x4 voxel-to-world affine
+    spatial_slice : tuple of slice, optional
+        Restrict the mask to this region (used by --sample)
+    n_tp : int, optional
+        Keep only the first n_tp time points (used by --sample)
+
+    Returns:
+    --------
+    tuple
+        (strengths, x, y, z, voxel_indices): complex (T, V) strengths, the
+        normalized x, y and z coordinates, and the (V, 3) int32 voxel indices
+    """
+    if spatial_slice is not None:
+        spatial_mask = np.zeros(mask.shape, dtype=bool)
+        spatial_mask[spatial_slice] = True
+        mask = mask & spatial_mask
+    
+    logging.info("Extracting voxel coordinates and time series...")
+    voxel_indices = np.argwhere(mask).astype(np.int32)
+    if voxel_indices.size == 0:
+        raise ValueError("No voxels found in the mask")
+    
+    # Read volume by volume; same voxel order as np.argwhere
+    voxel_time_series = read_masked_volumes(fmri_img, mask).T
+    # Flat voxels add FINUFFT points without contributing signal
+    keep = voxel_time_series.std(axis=1) > 1e-6
+    voxel_indices, voxel_time_series = voxel_indices[keep], voxel_time_series[keep]
+    if not keep.any():
+        raise ValueError("No voxels with non-zero variance in the mask")
+    logging.info(f"Kept {keep.sum()} of {keep.size} mask voxels with non-zero variance.")
+    if n_tp is not None:
+        voxel_time_series = voxel_time_series[:, :n_tp]
+    n_voxels, n_timepoints = voxel_time_series.shape
+    logging.info(f"Extracted {n_voxels} voxels, {n_timepoints} time points.")
+    
+    # Voxel-to-world transform as one matmul plus shift, in the real precision
+    # matching the strengths (float32 for complex64); coordinates are stored as
+    # (3, V) so each axis is a contiguous row
+    coord_dtype = np.finfo(strengths_dtype).dtype
+    voxel_coords_xyz = affine[:3, :3].astype(coord_dtype) @ voxel_indices.T.astype(coord_dtype)
+    voxel_coords_xyz += affine[:3, 3].astype(coord_dtype)[:, np.newaxis]
+    # Normalized to avoid FINUFFT out-of-range errors
+    x_coords, y_coords, z_coords = _normalize_coords(voxel_coords_xyz)
+    
+    # Transpose to get time as first dimension (required by MapBuilder),
+    # copying straight into the real part of a single complex allocation
+    strengths_complex = np.empty((n_timepoints, n_voxels), dtype=strengths_dtype)
+    np.copyto(strengths_complex.real, voxel_time_series.T)
+    strengths_complex.imag.fill(0.0)
+    logging.info(f"Complex strengths shape: {strengths_complex.shape} [time, voxels]")
+    return strengths_complex, x_coords, y_coords, z_coords, voxel_indices
 
-    logging.info(f"--> HDF5 consolidation complete. Processed {files_processed_count} files.")
-    logging.info("--> Exiting consolidate_mapbuilder_to_hdf5 (success)")
 
 # --- Main Analysis Logic ---
 def main():
@@ -131,130 +188,35 @@ def main():
     try:
         # --- Prepare Data --- 
         logging.info("Loading NIfTI data...")
-        fmri_img = nib.load(input_fmri_path)
+        # Stream volumes from the proxy rather than loading the full 4D series
+        fmri_img = nib.load(input_fmri_path, keep_file_open=True)
         mask_img = nib.load(input_mask_path)
         
         # Get the header information for verification
         logging.info(f"fMRI image dimensions: {fmri_img.shape}")
         logging.info(f"fMRI image header: TR={fmri_img.header.get_zooms()[-1] if len(fmri_img.header.get_zooms()) > 3 else 'Not defined'}")
         
-        fmri_data = fmri_img.get_fdata(dtype=np.float32) 
-        mask_data = mask_img.get_fdata().astype(bool)
+        mask_data = np.asanyarray(mask_img.dataobj) != 0
         
-        if fmri_data.shape[:3] != mask_data.shape:
-            raise ValueError(f"Spatial dimensions mismatch: fMRI {fmri_data.shape[:3]} vs Mask {mask_data.shape}")
+        if fmri_img.shape[:3] != mask_data.shape:
+            raise ValueError(f"Spatial dimensions mismatch: fMRI {fmri_img.shape[:3]} vs Mask {mask_data.shape}")
             
-        affine = fmri_img.affine
-        logging.info("Extracting voxel coordinates and time series...")
-        mask_indices = np.array(np.where(mask_data)).T
-        voxel_coords_ijk1 = np.hstack((mask_indices, np.ones((mask_indices.shape[0], 1))))
-        voxel_coords_xyz = nib.affines.apply_affine(affine, voxel_coords_ijk1[:, :3])
-        
-        # --- Sample Time Points if requested ---
+        # --- Sample a small region and the first time points if requested ---
+        spatial_slice, n_tp = None, None
         if args.sample:
-            # Reduce spatial extent for sampling as well
             logging.warning("Applying SPATIAL sampling for testing (--sample active).")
-            nx, ny, nz, _ = fmri_data.shape # Get dimensions
-            x_center, y_center, z_center = nx // 2, ny // 2, nz // 2
-            x_half, y_half, z_half = 1, 1, 1 # Reduced to smallest region (3x3x3 voxels)
-            x_range = slice(x_center - x_half, x_center + x_half + 1)
-            y_range = slice(y_center - y_half, y_center + y_half + 1)
-            z_range = slice(z_center - z_half, z_center + z_half + 1)
-            
-            logging.warning(f"Spatial sample region: X={x_range}, Y={y_range}, Z={z_range}")
-            
-            # Create a spatial mask for the sample region
-            spatial_sample_mask = np.zeros(fmri_data.shape[:3], dtype=bool)
-            spatial_sample_mask[x_range, y_range, z_range] = True
-            
-            # Combine with original mask
-            original_mask = mask_data # Assuming mask_data holds the loaded/calculated mask
-            combined_mask = original_mask & spatial_sample_mask
-            
-            # Re-extract coordinates and time series based on combined mask
-            logging.info("Re-extracting data for spatial sample...")
-            mask_indices = np.array(np.where(combined_mask)).T
-            if mask_indices.shape[0] == 0:
-                logging.error("No voxels found in the combined spatial sample mask! Halting.")
-                sys.exit(1)
-            
-            voxel_coords_ijk1 = np.hstack((mask_indices, np.ones((mask_indices.shape[0], 1))))
-            voxel_coords_xyz = nib.affines.apply_affine(affine, voxel_coords_ijk1[:, :3])
-            voxel_time_series = fmri_data[mask_indices[:, 0], mask_indices[:, 1], mask_indices[:, 2], :]
-            n_voxels, n_timepoints = voxel_time_series.shape # Update n_voxels, n_timepoints
-            logging.info(f"Extracted {n_voxels} voxels (spatially sampled), {n_timepoints} time points.")
-            
-            # Original time point sampling logic (applied AFTER spatial sampling)
+            nx, ny, nz, n_timepoints = fmri_img.shape # Get dimensions
+            half = 1 # Reduced to smallest region (3x3x3 voxels)
+            spatial_slice = tuple(slice(c - half, c + half + 1) for c in (nx // 2, ny // 2, nz // 2))
+            logging.warning(f"Spatial sample region: X={spatial_slice[0]}, Y={spatial_slice[1]}, Z={spatial_slice[2]}")
             if args.sample_tp < n_timepoints:
                 logging.warning(f"--sample active: Using only the first {args.sample_tp} time points out of {n_timepoints}.")
-                voxel_time_series = voxel_time_series[:, :args.sample_tp] # Sample time points
-                n_timepoints = args.sample_tp # Update n_timepoints
-                logging.info(f"Time points sampled down to {n_timepoints}.")
+                n_tp = args.sample_tp
             else:
                 logging.warning(f"--sample active, but requested sample_tp ({args.sample_tp}) >= total timepoints ({n_timepoints}). Using all {n_timepoints} time points.")
-            
-            # Transpose for MapBuilder
-            strengths_real = np.ascontiguousarray(voxel_time_series.T)
-            logging.info(f"Sampled time series shape (after transpose): {strengths_real.shape} [time, voxels]")
-            strengths_imag = np.zeros_like(strengths_real)
-            strengths_complex = np.ascontiguousarray(strengths_real + 1j * strengths_imag)
-            logging.info(f"Sampled complex strengths shape: {strengths_complex.shape}")
-
-            # Update coordinate arrays for the spatially sampled voxels
-            x_coords = np.ascontiguousarray(voxel_coords_xyz[:, 0])
-            y_coords = np.ascontiguousarray(voxel_coords_xyz[:, 1])
-            z_coords = np.ascontiguousarray(voxel_coords_xyz[:, 2])
-            
-            # Normalize coordinates to avoid FINUFFT out-of-range errors
-            logging.info("Original coordinate ranges: X=[{:.2f}, {:.2f}], Y=[{:.2f}, {:.2f}], Z=[{:.2f}, {:.2f}]".format(
-                x_coords.min(), x_coords.max(), y_coords.min(), y_coords.max(), z_coords.min(), z_coords.max()))
-            
-            # Scale coordinates to fit within the expected range for FINUFFT
-            # FINUFFT expects coords in range [-3π, 3π]
-            max_allowed = 3.0  # We'll scale to [-max_allowed, max_allowed] which is within FINUFFT's range
-            max_coord = max(abs(x_coords).max(), abs(y_coords).max(), abs(z_coords).max())
-            scale_factor = max_allowed / max_coord if max_coord > 0 else 1.0
-            
-            x_coords = x_coords * scale_factor
-            y_coords = y_coords * scale_factor
-            z_coords = z_coords * scale_factor
-            
-            logging.info("Normalized coordinate ranges (scale={:.4f}): X=[{:.2f}, {:.2f}], Y=[{:.2f}, {:.2f}], Z=[{:.2f}, {:.2f}]".format(
-                scale_factor, x_coords.min(), x_coords.max(), y_coords.min(), y_coords.max(), z_coords.min(), z_coords.max()))
-            
-            logging.info(f"Sampled coordinate arrays shapes - x: {x_coords.shape}, y: {y_coords.shape}, z: {z_coords.shape}")
-
-        else: # If not args.sample, run original data prep
-            # Original data prep logic remains here...
-            # Extract time series for each voxel in the mask (original full mask)
-            voxel_time_series = fmri_data[mask_indices[:, 0], mask_indices[:, 1], mask_indices[:, 2], :]
-            n_voxels, n_timepoints = voxel_time_series.shape
-            # Transpose to get time as first dimension (required by MapBuilder)
-            strengths_real = np.ascontiguousarray(voxel_time_series.T)
-            strengths_imag = np.zeros_like(strengths_real)
-            strengths_complex = np.ascontiguousarray(strengths_real + 1j * strengths_imag)
-            # Get spatial coordinates for each voxel (original full mask)
-            x_coords = np.ascontiguousarray(voxel_coords_xyz[:, 0])
-            y_coords = np.ascontiguousarray(voxel_coords_xyz[:, 1])
-            z_coords = np.ascontiguousarray(voxel_coords_xyz[:, 2])
-            
-            # Normalize coordinates to avoid FINUFFT out-of-range errors (same as in sampling branch)
-            logging.info("Original coordinate ranges: X=[{:.2f}, {:.2f}], Y=[{:.2f}, {:.2f}], Z=[{:.2f}, {:.2f}]".format(
-                x_coords.min(), x_coords.max(), y_coords.min(), y_coords.max(), z_coords.min(), z_coords.max()))
-            
-            # Scale coordinates to fit within the expected range for FINUFFT
-            # FINUFFT expects coords in range [-3π, 3π]
-            max_allowed = 3.0  # We'll scale to [-max_allowed, max_allowed] which is within FINUFFT's range
-            max_coord = max(abs(x_coords).max(), abs(y_coords).max(), abs(z_coords).max())
-            scale_factor = max_allowed / max_coord if max_coord > 0 else 1.0
-            
-            x_coords = x_coords * scale_factor
-            y_coords = y_coords * scale_factor
-            z_coords = z_coords * scale_factor
-            
-            logging.info("Normalized coordinate ranges (scale={:.4f}): X=[{:.2f}, {:.2f}], Y=[{:.2f}, {:.2f}], Z=[{:.2f}, {:.2f}]".format(
-                scale_factor, x_coords.min(), x_coords.max(), y_coords.min(), y_coords.max(), z_coords.min(), z_coords.max()))
-            # -------- End of original data prep ---------
+        
+        strengths_complex, x_coords, y_coords, z_coords, voxel_indices = _prepare_inputs(
+            fmri_img, mask_data, fmri_img.affine, spatial_slice=spatial_slice, n_tp=n_tp)
 
         # --- Run MapBuilder --- 
         logging.info("Initializing MapBuilder...")
@@ -266,9 +228,12 @@ def main():
             x=x_coords, # Use potentially sampled coords
             y=y_coords,
             z=z_coords,
+            # One C-contiguous (T, V) array for all time points, so the
+            # transforms share one set of points (FINUFFT n_trans=T)
             strengths=strengths_complex, # Use potentially sampled strengths
             eps=finufft_precision,      
-            dtype='complex128' # Ensure complex type is explicitly set
+            dtype=strengths_dtype.name, # Ensure complex type is explicitly set
+            **nufft_device_kwargs(nufft_device, MapBuilder)
         )
         
         mapbuilder_subject_dir = temp_mapbuilder_base / subject_id # Construct the expected output path
@@ -287,20 +252,29 @@ def main():
         )
         logging.info(f"MapBuilder intermediate processing complete. Results in: {mapbuilder_subject_dir}")
 
-        # --- Consolidate Results to HDF5 --- 
+        # --- Consolidate Results to HDF5 (or Zarr) --- 
         logging.info("--> Checking if MapBuilder output directory exists...")
-        if mapbuilder_subject_dir.exists():
+        if mapbuilder_subject_dir.exists() and output_backend == 'zarr':
+             logging.info(f"--> Directory found. Calling consolidate_mapbuilder_to_zarr.")
+             consolidate_mapbuilder_to_zarr(mapbuilder_subject_dir, output_hdf5_path, verbose=True)
+             logging.info("--> Returned from consolidate_mapbuilder_to_zarr.")
+             # Record which voxels were analysed so results can be mapped back to the volume
+             zarr.open_group(str(output_hdf5_path), mode='a').create_dataset('voxel_indices', data=voxel_indices)
+        elif mapbuilder_subject_dir.exists():
              logging.info(f"--> Directory found. Calling consolidate_mapbuilder_to_hdf5.")
-             consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_hdf5_path)
+             consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_hdf5_path, verbose=True)
              logging.info("--> Returned from consolidate_mapbuilder_to_hdf5.")
+             # Record which voxels were analysed so results can be mapped back to the volume
+             with h5py.File(output_hdf5_path, 'a') as hf:
+                 hf.create_dataset('voxel_indices', data=voxel_indices)
         else:
              logging.error(f"MapBuilder output directory not found after processing: {mapbuilder_subject_dir}")
              sys.exit(1)
         
-        # --- Optional: Clean up temporary directory ---
+        # --- Optional: Clean up temporary directory (in the background) ---
         if mapbuilder_subject_dir and mapbuilder_subject_dir.exists():
              logging.info(f"Cleaning up temporary directory: {mapbuilder_subject_dir.parent}")
-             shutil.rmtree(mapbuilder_subject_dir.parent)
+             remove_tree_in_background(mapbuilder_subject_dir.parent)
 
     except Exception as e:
         logging.exception(f"Error during Standalone QM FFT Analysis for subject {subject_id}: {e}")
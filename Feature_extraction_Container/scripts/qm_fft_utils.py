@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Input/output (including the consolidation of MapBuilder results) and NUFFT device helpers shared by the QM-FFT feature scripts (qm_fft.py and qm_fft_test.py).
+"""
+
+import os
+import inspect
+import logging
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import h5py
+import numpy as np
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+try:
+    import cufinufft
+    import cupy
+except ImportError:
+    cufinufft = None
+
+# Target HDF5 chunk size (matches the default 1 MB chunk cache slot)
+HDF5_CHUNK_BYTES = 1 << 20
+# Background .npy readers used during consolidation, and how far they may
+# run ahead of the HDF5 writer; larger files are memory-mapped instead
+NPY_READ_WORKERS = 4
+NPY_READ_AHEAD = 8
+NPY_PREFETCH_MAX_BYTES = 64 * 1024**2
+
+
+def hdf5_chunk_shape(shape, itemsize, target_bytes=HDF5_CHUNK_BYTES):
+    """
+    Chunk shape of roughly target_bytes for a dataset, matched to how the
+    results are read back: 2D (T, V) arrays keep whole time columns, so one
+    chunk read returns complete voxel time series, and 3D maps use blocks of
+    at most 32 voxels per side. Otherwise (or if a single time column does not
+    fit) the largest dimension is halved until a chunk fits.
+    """
+    if len(shape) == 2 and shape[0] * itemsize <= target_bytes:
+        return (shape[0], max(1, min(shape[1], target_bytes // (shape[0] * itemsize))))
+    if len(shape) == 3:
+        return tuple(min(n, 32) for n in shape)
+    chunks = list(shape)
+    while np.prod(chunks) * itemsize > target_bytes and max(chunks) > 1:
+        i = int(np.argmax(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
+
+
+def load_npy(npy_file):
+    """
+    Load a .npy file into memory, or memory-map it if it is larger than
+    NPY_PREFETCH_MAX_BYTES so prefetching cannot blow up resident memory.
+    """
+    if os.path.getsize(npy_file) > NPY_PREFETCH_MAX_BYTES:
+        return np.load(npy_file, mmap_mode='r')
+    return np.load(npy_file)
+
+
+def prefetch_npy(paths, max_workers=NPY_READ_WORKERS, lookahead=NPY_READ_AHEAD):
+    """
+    Read .npy files on a thread pool, at most `lookahead` files ahead of the
+    consumer, yielding (path, future) pairs in the original order. Reads
+    overlap the (single-threaded) HDF5 writes in the caller.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(load_npy, path)))
+            if len(pending) >= lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def iter_npy(root):
+    """
+    Yield the paths of all .npy files under root, walking it with os.scandir
+    (no pattern matching and no extra stat calls per entry).
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_npy(entry.path)
+            elif entry.name.endswith('.npy') and entry.is_file():
+                yield entry.path
+
+
+def write_npy_to_zarr(group, npy_file, dataset_path):
+    """Load one .npy file and write it into its pre-created Zarr array."""
+    data = load_npy(npy_file)
+    if data.size:
+        group[dataset_path][...] = data
+
+
+def read_masked_volumes(fmri_img, mask):
+    """
+    Read the in-mask voxels of a 4D image one volume at a time, without loading
+    the full series. Returns a C-contiguous float32 array of shape (T, V), i.e.
+    the transposed (V, T) voxel time series in np.nonzero voxel order.
+    """
+    dataobj = fmri_img.dataobj
+    n_timepoints = fmri_img.shape[3]
+    ts_tv = np.empty((n_timepoints, int(np.count_nonzero(mask))), dtype=np.float32)
+    for t in range(n_timepoints):
+        ts_tv[t] = np.asarray(dataobj[..., t])[mask]
+    return ts_tv
+
+
+def _find_mapbuilder_npy(mapbuilder_subject_dir, verbose=False):
+    """List the .npy files of the MapBuilder data and analysis subdirectories."""
+    search_dirs = [mapbuilder_subject_dir / 'data', mapbuilder_subject_dir / 'analysis']
+    npy_files = []
+    if verbose:
+        logging.info(f"--> Searching for .npy files in: {search_dirs}")
+    for d in search_dirs:
+        if d.exists():
+            # Recursively find all .npy files
+            found = list(iter_npy(d))
+            if verbose:
+                logging.info("--> Found %d .npy files in %s", len(found), d)
+            npy_files.extend(found)
+    if verbose:
+        logging.info(f"--> Total .npy files found: {len(npy_files)}")
+    return npy_files
+
+
+def consolidate_mapbuilder_to_hdf5(mapbuilder_subject_dir, output_h5_path, verbose=False):
+    """
+    Finds all .npy files in the MapBuilder output directory (data, analysis subdirs)
+    and saves them into a single HDF5 file, preserving relative structure.
+    With verbose, every step is also logged (the '-->' messages of qm_fft_test.py).
+    """
+    mapbuilder_subject_dir = Path(mapbuilder_subject_dir)
+    if verbose:
+        logging.info("--> Entering consolidate_mapbuilder_to_hdf5")
+    logging.info(f"Consolidating results from {mapbuilder_subject_dir} into {output_h5_path}")
+    Path(output_h5_path).parent.mkdir(parents=True, exist_ok=True)
+    
+    files_processed_count = 0
+    with h5py.File(output_h5_path, 'w', rdcc_nbytes=64 * 1024**2, rdcc_nslots=100003) as hf:
+        npy_files = _find_mapbuilder_npy(mapbuilder_subject_dir, verbose)
+        if not npy_files:
+            logging.warning(f"No .npy files found in {mapbuilder_subject_dir} subdirectories.")
+            if verbose:
+                logging.info("--> Exiting consolidate_mapbuilder_to_hdf5 (no files)")
+            return
+            
+        # Create every dataset up front from the .npy headers (memory-mapping
+        # reads only the header), so HDF5 metadata is written before any raw data
+        dataset_paths = {}
+        for npy_file in npy_files:
+            try:
+                header = np.load(npy_file, mmap_mode='r')
+                relative_path = os.path.relpath(npy_file, mapbuilder_subject_dir)
+                dataset_path = Path(relative_path).with_suffix('').as_posix() 
+                
+                if header.ndim == 0 or header.size == 0:
+                    # Scalar and empty datasets cannot be chunked or compressed
+                    hf.create_dataset(dataset_path, shape=header.shape, dtype=header.dtype,
+                                      track_times=False)
+                else:
+                    hf.create_dataset(dataset_path, shape=header.shape, dtype=header.dtype,
+                                      chunks=hdf5_chunk_shape(header.shape, header.dtype.itemsize),
+                                      compression='lzf', shuffle=True, track_times=False)
+                dataset_paths[npy_file] = dataset_path
+            except Exception as e:
+                logging.error("Failed to load or save %s to HDF5: %s", npy_file, e)
+        
+        # Then stream the raw data into the pre-created datasets; the debug level
+        # is checked once so the per-file messages cost nothing when it is off
+        debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for npy_file, loaded in prefetch_npy(list(dataset_paths)):
+            dataset_path = dataset_paths[npy_file]
+            try:
+                data = loaded.result()
+                if debug_enabled:
+                    if verbose:
+                        logging.debug("--> Processing file: %s", npy_file)
+                    logging.debug("Saving %s to HDF5 dataset: %s", npy_file, dataset_path)
+                if data.size:
+                    hf[dataset_path][()] = data
+                files_processed_count += 1
+            except Exception as e:
+                logging.error("Failed to load or save %s to HDF5: %s", npy_file, e)
+                # Do not leave an unwritten dataset behind
+                del hf[dataset_path]
+
+    logging.info(f"HDF5 consolidation complete. Processed {files_processed_count} files.")
+    if verbose:
+        logging.info("--> Exiting consolidate_mapbuilder_to_hdf5 (success)")
+
+
+def consolidate_mapbuilder_to_zarr(mapbuilder_subject_dir, output_zarr_path, max_workers=NPY_READ_WORKERS,
+                                   verbose=False):
+    """
+    Same as consolidate_mapbuilder_to_hdf5, but writes a Zarr directory store
+    with Blosc-LZ4 compressed chunks instead. Every array lives in its own
+    chunk files, so the .npy files are loaded, compressed and written
+    concurrently on a thread pool. Read the result with zarr.open(path).
+    """
+    if zarr is None:
+        raise ImportError("zarr is required for the Zarr output backend")
+    mapbuilder_subject_dir = Path(mapbuilder_subject_dir)
+    logging.info(f"Consolidating results from {mapbuilder_subject_dir} into {output_zarr_path}")
+    Path(output_zarr_path).parent.mkdir(parents=True, exist_ok=True)
+    
+    npy_files = _find_mapbuilder_npy(mapbuilder_subject_dir, verbose)
+    if not npy_files:
+        logging.warning(f"No .npy files found in {mapbuilder_subject_dir} subdirectories.")
+        return
+    
+    group = zarr.open_group(str(output_zarr_path), mode='w')
+    compressor = zarr.Blosc(cname='lz4', clevel=3, shuffle=zarr.Blosc.SHUFFLE)
+    
+    # Create the arrays (and their parent groups) serially from the .npy
+    # headers, so the worker threads below only ever touch distinct chunk keys
+    dataset_paths = {}
+    for npy_file in npy_files:
+        try:
+            header = np.load(npy_file, mmap_mode='r')
+            relative_path = os.path.relpath(npy_file, mapbuilder_subject_dir)
+            dataset_path = Path(relative_path).with_suffix('').as_posix()
+            chunks = hdf5_chunk_shape(header.shape, header.dtype.itemsize) if header.size else True
+            group.create_dataset(dataset_path, shape=header.shape, dtype=header.dtype,
+                                 chunks=chunks, compressor=compressor)
+            dataset_paths[npy_file] = dataset_path
+        except Exception as e:
+            logging.error("Failed to load or save %s to Zarr: %s", npy_file, e)
+    
+    files_processed_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(write_npy_to_zarr, group, npy_file, dataset_path): npy_file
+                   for npy_file, dataset_path in dataset_paths.items()}
+        for future, npy_file in futures.items():
+            try:
+                future.result()
+                files_processed_count += 1
+            except Exception as e:
+                logging.error("Failed to load or save %s to Zarr: %s", npy_file, e)
+                # Do not leave an unwritten array behind
+                del group[dataset_paths[npy_file]]
+    
+    logging.info(f"Zarr consolidation complete. Processed {files_processed_count} files.")
+
+
+def remove_tree_in_background(path):
+    """
+    Move a directory out of the way with a single (atomic) rename to a hidden
+    sibling and delete it on a background thread, so the caller does not wait
+    for thousands of file unlinks. The thread is not a daemon: the interpreter
+    finishes the removal before exiting instead of leaving the tree behind.
+    """
+    path = Path(path)
+    trash = path.parent / f".{path.name}.trash-{os.getpid()}"
+    os.rename(path, trash)
+    thread = threading.Thread(target=shutil.rmtree, args=(trash,),
+                              kwargs={'ignore_errors': True})
+    thread.start()
+    return thread
+
+
+def nufft_device_kwargs(device, map_builder_cls):
+    """
+    Extra MapBuilder keyword arguments selecting the NUFFT device. The GPU
+    (cufinufft) path is only requested when cufinufft and cupy import, a CUDA
+    device is visible and the installed MapBuilder (map_builder_cls) accepts a
+    `device` argument; otherwise MapBuilder keeps its CPU FINUFFT path.
+    """
+    if device != 'cuda':
+        return {}
+    if cufinufft is None:
+        logging.warning("cufinufft/cupy not available, falling back to CPU FINUFFT.")
+        return {}
+    try:
+        n_devices = cupy.cuda.runtime.getDeviceCount()
+    except cupy.cuda.runtime.CUDARuntimeError:
+        n_devices = 0
+    if n_devices == 0:
+        logging.warning("No CUDA device found, falling back to CPU FINUFFT.")
+        return {}
+    if 'device' not in inspect.signature(map_builder_cls.__init__).parameters:
+        logging.warning("Installed MapBuilder has no GPU support, falling back to CPU FINUFFT.")
+        return {}
+    return {'device': 'cuda'}
+
+
+def nufft_dtype(eps):
+    """
+    Complex strength dtype for a FINUFFT precision: single precision
+    (complex64 strengths, float32 coordinates) reaches eps >= 1e-6, tighter
+    tolerances need double precision.
+    """
+    return np.dtype(np.complex64) if eps >= 1e-6 else np.dtype(np.complex128)
@@ -5,6 +5,7 @@ Script to compute Regional Homogeneity (ReHo) from fMRI data using AFNI's 3dReHo
 
 import os
 import sys
+import shutil
 import subprocess
 import argparse
 import nibabel as nib
@@ -12,7 +13,7 @@ import numpy as np
 import time
 from pathlib import Path
 
-def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None):
+def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None, quiet=False):
     """
     Compute Regional Homogeneity (ReHo) from fMRI data using AFNI's 3dReHo.
     
@@ -26,18 +27,18 @@ def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None):
         Size of the neighborhood for ReHo calculation (27, 19, or 7). Default is 27.
     mask_file : str, optional
         Path to a brain mask. If not provided, a mask will be created based on signal variance.
+    quiet : bool, optional
+        Discard 3dReHo's own output instead of echoing it. Default is False.
     """
     start_time = time.time()
     
-    # Create output directory if it doesn't exist
+    # Create output directory if it doesn't exist (race-free when several
+    # subjects write to the same directory)
     output_dir = os.path.dirname(output_file)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     # Check if AFNI is installed and 3dReHo is available
-    try:
-        subprocess.run(['which', '3dReHo'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError:
+    if shutil.which('3dReHo') is None:
         print("Error: AFNI's 3dReHo command not found. Please ensure AFNI is installed.")
         sys.exit(1)
     
@@ -45,12 +46,8 @@ def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None):
     temp_mask = None
     if not mask_file:
         print("No mask provided, creating a mask based on signal variance")
-        # Create a directory for the mask if it doesn't exist
-        mask_dir = os.path.dirname(output_file)
-        if not os.path.exists(mask_dir):
-            os.makedirs(mask_dir)
-            
-        temp_mask = os.path.join(mask_dir, "temp_mask.nii.gz")
+        # Written uncompressed, as it is only read back once by 3dReHo
+        temp_mask = os.path.join(output_dir, f"{Path(output_file).name.split('.')[0]}_temp_mask.nii")
         create_mask_from_variance(fmri_file, temp_mask)
         mask_file = temp_mask
         print(f"Created temporary mask file: {mask_file}")
@@ -73,25 +70,32 @@ def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None):
         '-prefix', output_file,
         '-inset', fmri_file,
         '-mask', mask_file,
-        '-nneigh', str(cluster_size)
+        '-nneigh', str(cluster_size),
+        '-overwrite'
     ]
     
     print(f"Running: {' '.join(cmd)}")
     
-    try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"ReHo computation complete. Output saved to: {output_file}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error computing ReHo: {e}")
-        print(f"Command stdout: {e.stdout.decode() if e.stdout else ''}")
-        print(f"Command stderr: {e.stderr.decode() if e.stderr else ''}")
-        if temp_mask and os.path.exists(temp_mask):
-            os.remove(temp_mask)
+    if quiet:
+        # AFNI's output goes straight to /dev/null, never through Python
+        returncode = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    else:
+        # Stream the AFNI log as it is produced instead of buffering it in memory
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              text=True, errors='replace', bufsize=1) as proc:
+            for line in proc.stdout:
+                print(line, end='')
+        returncode = proc.returncode
+    if returncode != 0:
+        print(f"Error computing ReHo: 3dReHo exited with status {returncode}")
+        if temp_mask:
+            Path(temp_mask).unlink(missing_ok=True)
         sys.exit(1)
+    print(f"ReHo computation complete. Output saved to: {output_file}")
     
     # Clean up temporary files
-    if temp_mask and os.path.exists(temp_mask):
-        os.remove(temp_mask)
+    if temp_mask:
+        Path(temp_mask).unlink(missing_ok=True)
         print(f"Removed temporary mask file: {temp_mask}")
     
     elapsed_time = time.time() - start_time
@@ -100,6 +104,44 @@ def compute_reho(fmri_file, output_file, cluster_size=27, mask_file=None):
     return output_file
 
 
+def _temporal_variance(img):
+    """
+    Voxelwise variance over time of a 4D image, computed one volume at a time
+    (Welford's online algorithm) so the full 4D array is never loaded into
+    memory; the update runs in place so no temporaries are allocated per
+    volume. Volumes are read as float32 (exact for the usual integer and
+    float32 storage); only the 3D accumulators are kept in double precision.
+    """
+    dataobj = img.dataobj
+    mean = np.zeros(dataobj.shape[:3])
+    m2 = np.zeros_like(mean)
+    delta = np.empty_like(mean)
+    step = np.empty_like(mean)
+    for t in range(dataobj.shape[3]):
+        vol = np.asarray(dataobj[..., t], dtype=np.float32)
+        np.subtract(vol, mean, out=delta)
+        np.divide(delta, t + 1, out=step)
+        mean += step
+        np.subtract(vol, mean, out=step)
+        step *= delta
+        m2 += step
+    return m2 / dataobj.shape[3]
+
+
+def _save_mask(mask, img, mask_file):
+    """
+    Save a boolean or 0/1 mask with a fresh 3D uint8 header (no scaling or time
+    fields carried over from the 4D input img), keeping img's spatial codes.
+    """
+    mask_header = nib.Nifti1Header()
+    mask_header.set_data_dtype(np.uint8)
+    mask_header.set_xyzt_units(img.header.get_xyzt_units()[0])
+    mask_img = nib.Nifti1Image(np.asarray(mask).astype(np.uint8, copy=False), img.affine, mask_header)
+    mask_img.set_sform(img.affine, code=int(img.header['sform_code']))
+    mask_img.set_qform(img.affine, code=int(img.header['qform_code']))
+    nib.save(mask_img, mask_file)
+
+
 def create_mask_from_variance(fmri_file, mask_file):
     """
     Create a brain mask based on variance in fMRI data.
@@ -114,19 +156,17 @@ def create_mask_from_variance(fmri_file, mask_file):
     print(f"Creating mask from fMRI data variance: {fmri_file}")
     
     # Load the fMRI data
-    img = nib.load(fmri_file)
-    data = img.get_fdata()
+    img = nib.load(fmri_file, keep_file_open=True)
     
-    # Calculate variance along time axis
-    variance = np.var(data, axis=3)
+    variance = _temporal_variance(img)
     
-    # Create mask based on variance threshold (10th percentile)
-    threshold = np.percentile(variance[variance > 0], 10)
+    # Create mask based on variance threshold (10th percentile). np.percentile
+    # only partitions around the two neighbouring order statistics, and may do
+    # so in place since the positive variances are already a fresh copy
+    threshold = np.percentile(variance[variance > 0], 10, overwrite_input=True)
     mask = variance > threshold
     
-    # Save the mask
-    mask_img = nib.Nifti1Image(mask.astype(np.int8), img.affine, img.header)
-    nib.save(mask_img, mask_file)
+    _save_mask(mask, img, mask_file)
     
     print(f"Created mask with {np.sum(mask)} voxels")
     return mask_file
@@ -139,7 +179,8 @@ if __name__ == '__main__':
     parser.add_argument('--cluster-size', type=int, default=27, choices=[7, 19, 27],
                         help='Cluster size (7, 19, or 27). Default is 27.')
     parser.add_argument('--mask', help='Brain mask (optional, will be created if not provided)')
+    parser.add_argument('--quiet', action='store_true', help="Discard 3dReHo's progress output")
     
     args = parser.parse_args()
     
-    compute_reho(args.fmri, args.output, args.cluster_size, args.mask) 
\ No newline at end of file
+    compute_reho(args.fmri, args.output, args.cluster_size, args.mask, args.quiet) 
\ No newline at end of file
@@ -5,13 +5,15 @@ Script to compute Regional Homogeneity (ReHo) from fMRI data using AFNI's 3dReHo
 
 import os
 import sys
+import shutil
 import subprocess
 import argparse
 import nibabel as nib
 import numpy as np
 from pathlib import Path
+from reho import _temporal_variance, _save_mask
 
-def compute_reho(fmri_file, output_file, mask_file=None, neighborhood_size=27):
+def compute_reho(fmri_file, output_file, mask_file=None, neighborhood_size=27, python_mask=False):
     """
     Compute Regional Homogeneity (ReHo) from fMRI data.
     
@@ -25,30 +27,30 @@ def compute_reho(fmri_file, output_file, mask_file=None, neighborhood_size=27):
         Path to a brain mask. If not provided, a mask will be created based on signal variance.
     neighborhood_size : int, optional
         Size of the neighborhood for ReHo calculation (27, 19, or 7). Default is 27.
+    python_mask : bool, optional
+        Create the missing mask from signal variance in Python instead of with AFNI's
+        3dAutomask. Default is False.
     """
-    # Create output directory if it doesn't exist
+    # Create output directory if it doesn't exist (race-free when several
+    # subjects write to the same directory)
     output_dir = os.path.dirname(output_file)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     # Check if AFNI is installed and 3dReHo is available
-    try:
-        subprocess.run(['which', '3dReHo'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError:
+    if shutil.which('3dReHo') is None:
         print("Error: AFNI's 3dReHo command not found. Please ensure AFNI is installed.")
         sys.exit(1)
     
     # Create a temporary mask if not provided
     temp_mask = None
     if not mask_file:
-        print("No mask provided, creating a mask based on signal variance")
-        # Create a directory for the mask if it doesn't exist
-        mask_dir = os.path.dirname(output_file)
-        if not os.path.exists(mask_dir):
-            os.makedirs(mask_dir)
-            
-        temp_mask = os.path.join(mask_dir, "temp_mask.nii.gz")
-        create_mask_from_variance(fmri_file, temp_mask)
+        temp_mask = os.path.join(output_dir, f"{Path(output_file).name.split('.')[0]}_temp_mask.nii.gz")
+        if python_mask:
+            print("No mask provided, creating a mask based on signal variance")
+            create_mask_from_variance(fmri_file, temp_mask)
+        else:
+            print("No mask provided, creating a mask with AFNI's 3dAutomask")
+            create_automask(fmri_file, temp_mask)
         mask_file = temp_mask
         print(f"Created temporary mask file: {mask_file}")
     
@@ -91,6 +93,25 @@ def compute_reho(fmri_file, output_file, mask_file=None, neighborhood_size=27):
         os.remove(temp_mask)
         print(f"Removed temporary mask file: {temp_mask}")
 
+def create_automask(fmri_file, mask_file):
+    """
+    Create a brain mask with AFNI's 3dAutomask.
+    
+    Parameters:
+    -----------
+    fmri_file : str
+        Path to the input fMRI data
+    mask_file : str
+        Path to save the mask
+    """
+    cmd = ['3dAutomask', '-prefix', mask_file, '-overwrite', fmri_file]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(f"Error creating mask with 3dAutomask: {e}")
+        print(f"Command stderr: {e.stderr.decode() if e.stderr else ''}")
+        sys.exit(1)
+
 def create_mask_from_variance(fmri_file, mask_file, threshold=0.05):
     """
     Create a brain mask based on signal variance.
@@ -107,20 +128,15 @@ def create_mask_from_variance(fmri_file, mask_file, threshold=0.05):
     """
     try:
         # Load the fMRI data
-        img = nib.load(fmri_file)
-        data = img.get_fdata()
+        img = nib.load(fmri_file, keep_file_open=True)
         
-        # Calculate variance over time
-        variance = np.var(data, axis=3)
+        variance = _temporal_variance(img)
         
-        # Create mask by thresholding variance
-        # We normalize the variance first to make the threshold more robust
-        normalized_variance = variance / np.max(variance)
-        mask = (normalized_variance > threshold).astype(np.int16)
+        # Create mask by thresholding variance relative to its maximum,
+        # which makes the threshold more robust (same as normalizing the variance first)
+        mask = (variance > threshold * np.max(variance)).astype(np.uint8)
         
-        # Save the mask
-        mask_img = nib.Nifti1Image(mask, img.affine, img.header)
-        nib.save(mask_img, mask_file)
+        _save_mask(mask, img, mask_file)
         
     except Exception as e:
         print(f"Error creating mask from variance: {e}")
@@ -133,10 +149,12 @@ def main():
     parser.add_argument('--mask', help='Brain mask (optional, will be created if not provided)')
     parser.add_argument('--neighborhood', type=int, default=27, choices=[7, 19, 27],
                         help='Neighborhood size (7, 19, or 27). Default is 27.')
+    parser.add_argument('--python-mask', action='store_true',
+                        help='Create the missing mask from signal variance in Python instead of 3dAutomask')
     
     args = parser.parse_args()
     
-    compute_reho(args.fmri, args.output, args.mask, args.neighborhood)
+    compute_reho(args.fmri, args.output, args.mask, args.neighborhood, args.python_mask)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -6,15 +6,14 @@ Uses Yeo et al. 7-network and 17-network masks for network parcellation.
 
 import os
 import sys
+import hashlib
 import logging
 import argparse
 import numpy as np
 import nibabel as nib
 import pandas as pd
 from pathlib import Path
-from nilearn import input_data
 from nilearn import image
-from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker
 import h5py
 
 # Import RSN mask download function
@@ -24,7 +23,117 @@ from download_rsn_masks import download_rsn_masks
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def extract_rsn_activity(fmri_file, output_dir, mask_file=None, subject_id=None, sample=False, sample_tp=100):
+# Atlas label volumes already resampled onto an fMRI grid, keyed by atlas path
+# and grid, so subjects in the same space (e.g. a --batch run) share one resampling
+_ATLAS_CACHE = {}
+
+def _resampled_atlas_file(atlas_file, fmri_img):
+    """
+    Path of the on-disk copy of an atlas resampled onto the fMRI grid, next to
+    the atlas and named after a fingerprint of the grid and the atlas file.
+    """
+    st = os.stat(atlas_file)
+    fingerprint = hashlib.sha1(repr((fmri_img.shape[:3], st.st_size, st.st_mtime_ns)).encode()
+                               + np.asarray(fmri_img.affine, dtype=np.float64).tobytes()).hexdigest()[:16]
+    atlas_path = Path(atlas_file)
+    return atlas_path.with_name(f"{atlas_path.name.split('.')[0]}_resampled_to_{fingerprint}.nii.gz")
+
+
+def _load_labels_on_fmri_grid(atlas_file, fmri_img):
+    """
+    Integer label volume of an atlas on the fMRI grid. The atlas is used as
+    stored if it is already on that grid; otherwise it is resampled (nearest
+    neighbour) once and the result is kept on disk for later runs.
+    """
+    shape = fmri_img.shape[:3]
+    atlas_img = nib.load(atlas_file)
+    if atlas_img.shape[:3] == shape and np.allclose(atlas_img.affine, fmri_img.affine):
+        return np.asarray(atlas_img.dataobj).reshape(shape).astype(np.int32)
+    
+    resampled_file = _resampled_atlas_file(atlas_file, fmri_img)
+    if resampled_file.exists():
+        logger.info(f"Using resampled atlas {resampled_file}")
+        return np.asarray(nib.load(resampled_file).dataobj).reshape(shape).astype(np.int32)
+    
+    atlas_img = image.resample_to_img(atlas_img, fmri_img, interpolation='nearest')
+    labels = np.asarray(atlas_img.dataobj).reshape(shape).astype(np.int32)
+    # Written under a temporary name and renamed, so concurrent runs never
+    # read a partial file; a read-only atlas directory only skips the disk cache
+    tmp_file = resampled_file.with_name(f".{os.getpid()}.{resampled_file.name}")
+    try:
+        nib.save(nib.Nifti1Image(labels, fmri_img.affine), tmp_file)
+        os.replace(tmp_file, resampled_file)
+    except OSError as e:
+        tmp_file.unlink(missing_ok=True)
+        logger.warning(f"Could not cache resampled atlas {resampled_file}: {e}")
+    return labels
+
+
+def _labels_on_fmri_grid(atlas_file, fmri_img, mask_data=None):
+    """
+    Integer label volume of an atlas on the fMRI grid, with voxels outside
+    the brain mask set to background (0).
+    """
+    key = (str(atlas_file), fmri_img.shape[:3], fmri_img.affine.tobytes())
+    labels = _ATLAS_CACHE.get(key)
+    if labels is None:
+        labels = _load_labels_on_fmri_grid(atlas_file, fmri_img)
+        _ATLAS_CACHE[key] = labels
+    if mask_data is not None:
+        # New array, the cached labels stay unmasked
+        labels = np.where(mask_data, labels, 0)
+    return labels
+
+
+def _network_time_series(fmri_img, label_volumes, n_networks, n_timepoints):
+    """
+    Mean time series of the networks of several atlases, computed in a single
+    pass over the fMRI volumes, then z-scored over time like
+    NiftiLabelsMasker(standardize=True).
+
+    Parameters:
+    -----------
+    fmri_img : nibabel.Nifti1Image
+        4D fMRI image; volumes are streamed from its data proxy
+    label_volumes : list of numpy.ndarray
+        Label volumes on the fMRI grid, networks numbered 1..n
+    n_networks : list of int
+        Number of networks in each label volume
+    n_timepoints : int
+        Number of time points to use (from the start of the series)
+
+    Returns:
+    --------
+    list of numpy.ndarray
+        One (n_timepoints, n) time series array per label volume
+    """
+    # Per atlas: in-network voxels, their 0-based network index and the
+    # voxel count of every network
+    atlases = []
+    for labels, n in zip(label_volumes, n_networks):
+        inside = (labels > 0) & (labels <= n)
+        network_idx = labels[inside] - 1
+        atlases.append((inside, network_idx, np.bincount(network_idx, minlength=n)))
+    
+    time_series = [np.empty((n_timepoints, n)) for n in n_networks]
+    dataobj = fmri_img.dataobj
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for t in range(n_timepoints):
+            vol = np.asarray(dataobj[..., t], dtype=np.float64)
+            for (inside, network_idx, counts), ts, n in zip(atlases, time_series, n_networks):
+                # Segment sum of the in-network voxels, divided by the voxel counts
+                ts[t] = np.bincount(network_idx, weights=vol[inside], minlength=n) / counts
+    
+    for ts in time_series:
+        ts -= ts.mean(axis=0)
+        std = ts.std(axis=0)
+        std[std < np.finfo(np.float64).eps] = 1.0
+        ts /= std
+    return time_series
+
+
+def extract_rsn_activity(fmri_file, output_dir, mask_file=None, subject_id=None, sample=False, sample_tp=100,
+                         write_csv=False):
     """
     Extract resting state network (RSN) activity from fMRI data.
     
@@ -42,6 +151,9 @@ def extract_rsn_activity(fmri_file, output_dir, mask_file=None, subject_id=None,
         If True, only a sample of time points will be used for testing purposes.
     sample_tp : int, optional
         Number of time points to use when sample is True.
+    write_csv : bool, optional
+        Also write the 7- and 17-network time series as CSV files. Default is
+        False (HDF5 only); the CSV paths are returned as None then.
     """
     logger.info(f"Starting RSN activity extraction for: {fmri_file}")
     
@@ -57,93 +169,72 @@ def extract_rsn_activity(fmri_file, output_dir, mask_file=None, subject_id=None,
     rsn_masks_dir = "/app/rsn_masks"
     yeo_7_path, yeo_17_path = download_rsn_masks(rsn_masks_dir)
     
-    # Load fMRI data
+    # Load fMRI data (volumes are streamed from the file below)
     logger.info(f"Loading fMRI data from {fmri_file}")
-    fmri_img = nib.load(fmri_file)
+    fmri_img = nib.load(fmri_file, keep_file_open=True)
+    n_timepoints = fmri_img.shape[3]
     
     # Apply sample if requested
     if sample:
         logger.warning(f"Applying temporal sampling for testing: using first {sample_tp} time points.")
-        # Extract data and limit time points
-        fmri_data = fmri_img.get_fdata()
-        original_shape = fmri_data.shape
-        
-        if original_shape[3] > sample_tp:
-            fmri_data = fmri_data[..., :sample_tp]
-            # Create new NIfTI with sampled data, preserving header info
-            fmri_img = nib.Nifti1Image(fmri_data, fmri_img.affine, fmri_img.header)
-            logger.info(f"Sampled fMRI data to shape: {fmri_data.shape}")
+        if n_timepoints > sample_tp:
+            n_timepoints = sample_tp
+            logger.info(f"Sampled fMRI data to shape: {fmri_img.shape[:3] + (n_timepoints,)}")
     
     # Load mask if provided
-    mask_img = None
+    mask_data = None
     if mask_file:
         logger.info(f"Loading mask from {mask_file}")
-        mask_img = nib.load(mask_file)
+        mask_img = image.resample_to_img(mask_file, fmri_img, interpolation='nearest')
+        mask_data = np.asarray(mask_img.dataobj).reshape(fmri_img.shape[:3]) > 0
     
     # Define output paths
     yeo_7_output_csv = os.path.join(output_dir, f"{subject_id}_rsn_7networks.csv")
     yeo_17_output_csv = os.path.join(output_dir, f"{subject_id}_rsn_17networks.csv")
     output_h5 = os.path.join(output_dir, f"{subject_id}_rsn_activity.h5")
     
-    logger.info("Processing 7-network parcellation...")
-    # Extract time series for each of the 7 networks
-    yeo_7_masker = NiftiLabelsMasker(
-        labels_img=yeo_7_path,
-        mask_img=mask_img,
-        standardize=True,
-        memory='nilearn_cache',
-        verbose=1
-    )
-    
-    # Extract time series
-    yeo_7_time_series = yeo_7_masker.fit_transform(fmri_img)
+    # Extract the time series of the 7 and 17 networks together, in one pass
+    # over the fMRI volumes
+    logger.info("Processing 7-network and 17-network parcellations...")
+    yeo_7_labels = _labels_on_fmri_grid(yeo_7_path, fmri_img, mask_data)
+    yeo_17_labels = _labels_on_fmri_grid(yeo_17_path, fmri_img, mask_data)
+    yeo_7_time_series, yeo_17_time_series = _network_time_series(
+        fmri_img, [yeo_7_labels, yeo_17_labels], [7, 17], n_timepoints)
     
-    # Create DataFrame with network labels
+    # Network labels
     network_7_labels = [
         'Visual', 'Somatomotor', 'Dorsal Attention',
         'Ventral Attention', 'Limbic', 'Frontoparietal', 'Default'
     ]
-    yeo_7_df = pd.DataFrame(yeo_7_time_series, columns=network_7_labels)
-    
-    # Save to CSV
-    logger.info(f"Saving 7-network time series to {yeo_7_output_csv}")
-    yeo_7_df.to_csv(yeo_7_output_csv, index=False)
-    
-    logger.info("Processing 17-network parcellation...")
-    # Extract time series for each of the 17 networks
-    yeo_17_masker = NiftiLabelsMasker(
-        labels_img=yeo_17_path,
-        mask_img=mask_img,
-        standardize=True,
-        memory='nilearn_cache',
-        verbose=1
-    )
-    
-    # Extract time series
-    yeo_17_time_series = yeo_17_masker.fit_transform(fmri_img)
-    
-    # Create DataFrame with network labels
     network_17_labels = [f'Network {i+1}' for i in range(17)]
-    yeo_17_df = pd.DataFrame(yeo_17_time_series, columns=network_17_labels)
     
-    # Save to CSV
-    logger.info(f"Saving 17-network time series to {yeo_17_output_csv}")
-    yeo_17_df.to_csv(yeo_17_output_csv, index=False)
+    # Save to CSV (text serialization, only when requested)
+    if write_csv:
+        logger.info(f"Saving 7-network time series to {yeo_7_output_csv}")
+        pd.DataFrame(yeo_7_time_series, columns=network_7_labels).to_csv(
+            yeo_7_output_csv, index=False, float_format='%.6g')
+        logger.info(f"Saving 17-network time series to {yeo_17_output_csv}")
+        pd.DataFrame(yeo_17_time_series, columns=network_17_labels).to_csv(
+            yeo_17_output_csv, index=False, float_format='%.6g')
+    else:
+        yeo_7_output_csv = yeo_17_output_csv = None
     
     # Save both sets of time series to a single HDF5 file
     logger.info(f"Saving all time series to HDF5: {output_h5}")
     with h5py.File(output_h5, 'w') as f:
-        # Create groups
-        networks_7 = f.create_group('networks_7')
-        networks_17 = f.create_group('networks_17')
-        
-        # Save 7-network time series
-        for i, label in enumerate(network_7_labels):
-            networks_7.create_dataset(label, data=yeo_7_time_series[:, i])
-        
-        # Save 17-network time series
-        for i, label in enumerate(network_17_labels):
-            networks_17.create_dataset(label, data=yeo_17_time_series[:, i])
+        # One compressed (time points, networks) dataset per parcellation, with
+        # the network names as a column attribute. Chunks span all networks and
+        # a run of time points (at least 64 KiB, so a typical run is a single
+        # chunk), so time windows are read without decompressing the whole run.
+        # No timestamps are stored, so the same input gives the same file
+        for group, time_series, labels in (('networks_7', yeo_7_time_series, network_7_labels),
+                                           ('networks_17', yeo_17_time_series, network_17_labels)):
+            n_tp, n_networks = time_series.shape
+            rows = max(256, (64 << 10) // (n_networks * time_series.itemsize))
+            ds = f.create_dataset(f'{group}/ts', data=time_series,
+                                  chunks=(max(1, min(n_tp, rows)), n_networks),
+                                  compression='lzf', shuffle=True, track_times=False)
+            ds.attrs['labels'] = np.array(labels, dtype='S')
         
         # Add metadata
         f.attrs['subject_id'] = subject_id
@@ -160,22 +251,43 @@ def extract_rsn_activity(fmri_file, output_dir, mask_file=None, subject_id=None,
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Extract resting state network (RSN) activity from fMRI data.')
-    parser.add_argument('--fmri', required=True, help='Input fMRI file')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--fmri', help='Input fMRI file')
+    inputs.add_argument('--batch', help='Text file listing one fMRI file per line, optionally followed by its mask; '
+                                         'all subjects are processed in this process, sharing the resampled atlases')
     parser.add_argument('--output-dir', required=True, help='Output directory for RSN activity results')
     parser.add_argument('--mask', help='Brain mask (optional)')
     parser.add_argument('--subject-id', help='Subject ID (optional, extracted from filename if not provided)')
     parser.add_argument('--sample', action='store_true', help='Use only a sample of time points for testing')
     parser.add_argument('--sample-tp', type=int, default=100, help='Number of time points to use when sampling')
+    parser.add_argument('--no-csv', action='store_true', help='Only write the HDF5 file, not the CSV files')
     
     args = parser.parse_args()
     
+    if args.batch:
+        # (fmri, mask) pairs; subject IDs come from the file names
+        with open(args.batch) as f:
+            jobs = [line.split() for line in f if line.strip() and not line.lstrip().startswith('#')]
+        for job in jobs:
+            extract_rsn_activity(
+                job[0],
+                args.output_dir,
+                job[1] if len(job) > 1 else args.mask,
+                None,
+                args.sample,
+                args.sample_tp,
+                write_csv=not args.no_csv
+            )
+        return
+    
     extract_rsn_activity(
         args.fmri,
         args.output_dir,
         args.mask,
         args.subject_id,
         args.sample,
-        args.sample_tp
+        args.sample_tp,
+        write_csv=not args.no_csv
     )
 
 if __name__ == '__main__':
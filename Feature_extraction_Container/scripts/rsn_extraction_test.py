@@ -30,6 +30,7 @@ def main():
     parser.add_argument('--subject_id', help='Subject ID (optional, extracted from filename if not provided)')
     parser.add_argument('--sample', action='store_true', help='Use only a sample of time points for testing')
     parser.add_argument('--sample_tp', type=int, default=100, help='Number of time points to use when sampling')
+    parser.add_argument('--no_csv', action='store_true', help='Only write the HDF5 file, not the CSV files')
     
     args = parser.parse_args()
     
@@ -61,11 +62,13 @@ def main():
             args.mask,
             subject_id,
             args.sample,
-            args.sample_tp
+            args.sample_tp,
+            write_csv=not args.no_csv
         )
         logging.info(f"RSN extraction completed. Results saved to:")
-        logging.info(f"  - 7-Network CSV: {yeo_7_csv}")
-        logging.info(f"  - 17-Network CSV: {yeo_17_csv}")
+        if yeo_7_csv:
+            logging.info(f"  - 7-Network CSV: {yeo_7_csv}")
+            logging.info(f"  - 17-Network CSV: {yeo_17_csv}")
         logging.info(f"  - HDF5 file: {h5_file}")
     except Exception as e:
         logging.error(f"RSN extraction failed: {e}")
@@ -1,19 +1,98 @@
 #!/usr/bin/env python3
 import argparse
+import multiprocessing
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+import numpy as np
+from joblib import Parallel, delayed
+
 from alff import compute_alff
-from reho import compute_reho
+from reho import compute_reho, create_mask_from_variance
 from hurst import compute_hurst
 from fractal import compute_fractal
 from qm_fft import compute_qm_fft
 
+# Thread-pool settings that native libraries read when they are first loaded
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMBA_NUM_THREADS')
+
+# OpenMP thread placement, used when a single worker has all cores to itself
+# (every process would otherwise pin its threads to the same first cores)
+OMP_BINDING = {'OMP_PROC_BIND': 'close', 'OMP_PLACES': 'cores'}
+
+
+def _run_in_processes(tasks, n_workers, threads_per_worker, bind_threads=False):
+    """
+    Run independent feature tasks in a pool of fresh worker processes.
+
+    Each worker's native thread pools are limited to threads_per_worker
+    threads. The limits are exported before the (spawned) workers start, so they
+    apply when numpy, numba etc. are imported there, and are restored afterwards.
+
+    Parameters:
+    -----------
+    tasks : dict
+        Maps a feature name to a (function, args, kwargs) tuple.
+    n_workers : int
+        Number of worker processes.
+    threads_per_worker : int
+        Thread limit for each worker's native thread pools.
+    bind_threads : bool, optional
+        Also keep OpenMP threads (e.g. AFNI's) on neighbouring cores, unless
+        OMP_PROC_BIND/OMP_PLACES are already set. Default is False.
+    """
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS + tuple(OMP_BINDING)}
+    os.environ.update({var: str(threads_per_worker) for var in THREAD_ENV_VARS})
+    if bind_threads:
+        for var, value in OMP_BINDING.items():
+            os.environ.setdefault(var, value)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(func, *args, **kwargs): name
+                       for name, (func, args, kwargs) in tasks.items()}
+            for future in as_completed(futures):
+                future.result()
+                print(f"\n=== {futures[future]} finished ===")
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _warm_numba_kernels(fractal_kmax=10):
+    """
+    Compile the numba DFA, R/S and Higuchi kernels once in this process. They are
+    cached on disk, so the feature workers load them instead of each paying
+    the compilation time.
+    
+    Returns:
+    --------
+    bool
+        True if numba is available.
+    """
+    try:
+        from hurst_numba import dfa_batch, hurst_rs_batch
+        from fractal_numba import higuchi_fd_batch
+    except ImportError:
+        return False
+    # Same argument types as in compute_hurst and compute_fractal
+    ts = np.random.default_rng(0).standard_normal((2, max(64, 2 * fractal_kmax))).astype(np.float32)
+    dfa_batch(ts, [4, 8])
+    hurst_rs_batch(ts)
+    higuchi_fd_batch(ts, fractal_kmax)
+    return True
+
+
 def run_all_features(input_file, output_dir, tr=2.0, mask_file=None, 
                     reho_cluster_size=27, alff_low=0.01, alff_high=0.08,
                     hurst_method='dfa', fractal_method='higuchi', fractal_kmax=10,
-                    qm_fft_eps=1e-6, qm_fft_radius=0.6, qm_fft_local_k=5):
+                    qm_fft_eps=1e-6, qm_fft_radius=0.6, qm_fft_local_k=5, n_workers=5, n_cpus=None,
+                    use_numba=False):
     """
     Run all feature extraction methods on the input fMRI file.
     
@@ -45,6 +124,17 @@ def run_all_features(input_file, output_dir, tr=2.0, mask_file=None,
         K-space mask radius for QM-FFT. Default is 0.6.
     qm_fft_local_k : int, optional
         Number of neighbors for local variance in QM-FFT. Default is 5.
+    n_workers : int, optional
+        Number of features computed at the same time, each in its own process.
+        Default is 5 (all features concurrently).
+    n_cpus : int, optional
+        Number of CPU cores shared by the feature workers. Default is all cores.
+        With a single worker using all cores, OpenMP threads are also bound to them.
+    use_numba : bool, optional
+        Compute the Hurst exponent with the compiled numba kernels instead of
+        nolds. The kernels are compiled before the workers start. Without numba
+        installed, Hurst falls back to nolds and fractal to its NumPy kernel.
+        Default is False.
     """
     start_time = time.time()
     
@@ -68,56 +158,41 @@ def run_all_features(input_file, output_dir, tr=2.0, mask_file=None,
     
     print(f"=== Running feature extraction on {input_file} ===")
     
-    # Run ReHo
-    print("\n=== Running ReHo ===")
-    compute_reho(
-        input_file, 
-        reho_output, 
-        cluster_size=reho_cluster_size, 
-        mask_file=mask_file
-    )
+    # Create the variance mask once and share it, instead of every feature
+    # deriving its own from the 4D data (uncompressed, as it is only read back)
+    temp_mask = None
+    if not mask_file:
+        temp_mask = os.path.join(output_dir, f"{base_name}_temp_mask.nii")
+        mask_file = create_mask_from_variance(input_file, temp_mask)
     
-    # Run ALFF
-    print("\n=== Running ALFF ===")
-    compute_alff(
-        input_file,
-        alff_output,
-        tr=tr,
-        bandpass_low=alff_low,
-        bandpass_high=alff_high,
-        mask_file=mask_file
-    )
+    if use_numba and not _warm_numba_kernels(fractal_kmax):
+        print("Warning: numba is not installed; using nolds for the Hurst exponent")
     
-    # Run Hurst exponent
-    print("\n=== Running Hurst exponent calculation ===")
-    compute_hurst(
-        input_file,
-        hurst_output,
-        method=hurst_method,
-        mask_file=mask_file
-    )
-    
-    # Run Fractal dimension
-    print("\n=== Running Fractal dimension calculation ===")
-    compute_fractal(
-        input_file,
-        fractal_output,
-        method=fractal_method,
-        kmax=fractal_kmax,
-        mask_file=mask_file
-    )
-    
-    # Run QM-FFT
-    print("\n=== Running QM-FFT analysis ===")
-    compute_qm_fft(
-        input_file,
-        qm_fft_output,
-        mask_file=mask_file,
-        subject_id=subject_id,
-        eps=qm_fft_eps,
-        radius=qm_fft_radius,
-        local_k=qm_fft_local_k
-    )
+    # The features only share the (read-only) input, so they run concurrently,
+    # each with an equal share of the CPU cores
+    total_cpus = os.cpu_count() or 1
+    threads_per_worker = max(1, (n_cpus or total_cpus) // n_workers)
+    bind_threads = n_workers == 1 and threads_per_worker >= total_cpus
+    tasks = {
+        'ReHo': (compute_reho, (input_file, reho_output),
+                 dict(cluster_size=reho_cluster_size, mask_file=mask_file)),
+        'ALFF': (compute_alff, (input_file, alff_output),
+                 dict(tr=tr, bandpass_low=alff_low, bandpass_high=alff_high, mask_file=mask_file)),
+        'Hurst exponent': (compute_hurst, (input_file, hurst_output),
+                           dict(method=hurst_method, mask_file=mask_file, n_jobs=threads_per_worker,
+                                backend='numba' if use_numba else 'nolds')),
+        'Fractal dimension': (compute_fractal, (input_file, fractal_output),
+                              dict(method=fractal_method, kmax=fractal_kmax, mask_file=mask_file)),
+        'QM-FFT': (compute_qm_fft, (input_file, qm_fft_output),
+                   dict(mask_file=mask_file, subject_id=subject_id, eps=qm_fft_eps,
+                        radius=qm_fft_radius, local_k=qm_fft_local_k)),
+    }
+    print(f"\n=== Running {', '.join(tasks)} with {n_workers} worker processes ===")
+    try:
+        _run_in_processes(tasks, n_workers, threads_per_worker, bind_threads)
+    finally:
+        if temp_mask:
+            Path(temp_mask).unlink(missing_ok=True)
     
     # Summary
     elapsed_time = time.time() - start_time
@@ -137,9 +212,70 @@ def run_all_features(input_file, output_dir, tr=2.0, mask_file=None,
     }
 
 
+def _run_subject(input_file, output_dir, n_cpus, **kwargs):
+    """
+    Run all features for one subject of a manifest, inside a joblib worker.
+    
+    The worker's own BLAS pools are limited to one thread; the feature
+    processes it starts share the n_cpus cores assigned to the subject.
+    """
+    # Spawned children inherit the parent's start method, which is 'loky' in
+    # a joblib worker and unknown to the standard library
+    multiprocessing.set_start_method('spawn', force=True)
+    os.environ['OPENBLAS_NUM_THREADS'] = '1'
+    os.environ['MKL_NUM_THREADS'] = '1'
+    return run_all_features(input_file, output_dir, n_cpus=n_cpus, **kwargs)
+
+
+def run_manifest(manifest_file, output_dir, n_jobs=1, mask_file=None, n_cpus=None, **kwargs):
+    """
+    Run all feature extraction methods on every subject listed in a manifest,
+    several subjects at a time.
+    
+    Parameters:
+    -----------
+    manifest_file : str
+        Text file with one fMRI file per line, optionally followed by its mask.
+        Empty lines and lines starting with # are ignored.
+    output_dir : str
+        Directory to save output files (named after each input file).
+    n_jobs : int, optional
+        Number of subjects processed at the same time. Default is 1.
+    mask_file : str, optional
+        Mask used for subjects that have none in the manifest. If None, a mask
+        is created from each subject's fMRI data.
+    n_cpus : int, optional
+        Number of CPU cores shared by all subjects. Default is all cores.
+    **kwargs
+        Further parameters passed to run_all_features.
+    
+    Returns:
+    --------
+    list
+        The output paths of each subject, in manifest order.
+    """
+    with open(manifest_file) as f:
+        jobs = [line.split() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    
+    # Each subject gets an equal share of the cores for its feature workers
+    n_jobs = max(1, min(n_jobs, len(jobs)))
+    n_cpus = max(1, (n_cpus or os.cpu_count() or 1) // n_jobs)
+    print(f"=== Running {len(jobs)} subjects, {n_jobs} at a time ===")
+    if kwargs.get('use_numba'):
+        # Compile once here rather than in several subjects at the same time
+        _warm_numba_kernels(kwargs.get('fractal_kmax', 10))
+    return Parallel(n_jobs=n_jobs, backend='loky', prefer='processes')(
+        delayed(_run_subject)(job[0], output_dir, n_cpus,
+                              mask_file=job[1] if len(job) > 1 else mask_file, **kwargs)
+        for job in jobs
+    )
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract multiple features from fMRI data')
-    parser.add_argument('--input', required=True, help='Path to input fMRI file')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', help='Path to input fMRI file')
+    inputs.add_argument('--manifest', help='Text file listing one fMRI file per line, optionally followed by its mask')
     parser.add_argument('--output-dir', required=True, help='Directory to save output files')
     parser.add_argument('--tr', type=float, default=2.0, help='Repetition time in seconds (default: 2.0)')
     parser.add_argument('--mask', help='Path to mask file (optional)')
@@ -169,12 +305,18 @@ if __name__ == '__main__':
                       help='K-space mask radius for QM-FFT (default: 0.6)')
     parser.add_argument('--qm-fft-local-k', type=int, default=5,
                       help='Number of neighbors for local variance in QM-FFT (default: 5)')
+    parser.add_argument('--n-workers', type=int, default=5,
+                      help='Number of features computed concurrently (default: 5)')
+    parser.add_argument('--threads', type=int,
+                      help='Number of CPU cores to use, shared by all workers (default: all cores)')
+    parser.add_argument('--numba', action='store_true',
+                      help='Use the compiled numba kernels for the Hurst exponent (falls back to nolds without numba)')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                      help='Number of manifest subjects processed concurrently (default: 1)')
     
     args = parser.parse_args()
     
-    run_all_features(
-        args.input,
-        args.output_dir,
+    feature_args = dict(
         tr=args.tr,
         mask_file=args.mask,
         reho_cluster_size=args.reho_cluster_size,
@@ -185,5 +327,12 @@ if __name__ == '__main__':
         fractal_kmax=args.fractal_kmax,
         qm_fft_eps=args.qm_fft_eps,
         qm_fft_radius=args.qm_fft_radius,
-        qm_fft_local_k=args.qm_fft_local_k
-    ) 
\ No newline at end of file
+        qm_fft_local_k=args.qm_fft_local_k,
+        n_workers=args.n_workers,
+        n_cpus=args.threads,
+        use_numba=args.numba
+    )
+    if args.manifest:
+        run_manifest(args.manifest, args.output_dir, n_jobs=args.n_jobs, **feature_args)
+    else:
+        run_all_features(args.input, args.output_dir, **feature_args)
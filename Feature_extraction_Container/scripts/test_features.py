@@ -65,6 +65,16 @@ def main():
         
         results = {}
         
+        # Several selected features share one variance mask instead of each
+        # deriving its own from the 4D data
+        mask_file = args.mask
+        temp_mask = None
+        n_selected = sum([args.run_reho, args.run_alff, args.run_hurst, args.run_fractal, args.run_qm_fft])
+        if not mask_file and n_selected > 1:
+            from reho import create_mask_from_variance
+            temp_mask = os.path.join(args.output_dir, f"{base_name}_temp_mask.nii")
+            mask_file = create_mask_from_variance(args.sample_data, temp_mask)
+        
         if args.run_reho:
             from reho import compute_reho
             print("\n=== Running ReHo ===")
@@ -73,7 +83,7 @@ def main():
                 args.sample_data, 
                 reho_output, 
                 cluster_size=args.reho_cluster_size, 
-                mask_file=args.mask
+                mask_file=mask_file
             )
             results['reho'] = reho_output
             
@@ -87,7 +97,7 @@ def main():
                 tr=args.tr,
                 bandpass_low=args.alff_low,
                 bandpass_high=args.alff_high,
-                mask_file=args.mask
+                mask_file=mask_file
             )
             results['alff'] = alff_output
             
@@ -98,7 +108,7 @@ def main():
             compute_hurst(
                 args.sample_data,
                 hurst_output,
-                mask_file=args.mask
+                mask_file=mask_file
             )
             results['hurst'] = hurst_output
             
@@ -109,7 +119,7 @@ def main():
             compute_fractal(
                 args.sample_data,
                 fractal_output,
-                mask_file=args.mask
+                mask_file=mask_file
             )
             results['fractal'] = fractal_output
             
@@ -120,9 +130,12 @@ def main():
             compute_qm_fft(
                 args.sample_data,
                 qm_fft_output,
-                mask_file=args.mask
+                mask_file=mask_file
             )
             results['qm_fft'] = qm_fft_output
+        
+        if temp_mask:
+            Path(temp_mask).unlink(missing_ok=True)
     
     print("\n=== Test Complete ===")
     print("Outputs:")
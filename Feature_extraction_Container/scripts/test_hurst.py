@@ -3,27 +3,122 @@ import nibabel as nib
 import numpy as np
 import nolds
 import os
-import matplotlib.pyplot as plt
+import argparse
+import csv
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from joblib import Parallel, delayed
 from scipy import signal
 
+try:
+    # Optional compiled batch R/S kernel and single-pass map statistics
+    from hurst_numba import hurst_rs_batch, positive_stats
+except ImportError:
+    hurst_rs_batch = positive_stats = None
+
+
+def _validate_voxel(coords, ts, stored_hurst, recomputed_hurst, output_dir, tol=1e-6, save_csv=False,
+                    plots=True):
+    """
+    Compare the stored and recomputed Hurst exponent of one voxel and, with
+    plots, write its time series plot and binary .npy dump (and a CSV with
+    save_csv). Uses its own Figure and Agg canvas rather than pyplot, so
+    voxels can be handled in parallel threads.
+
+    Returns the report lines, so they are printed in voxel order.
+    """
+    x, y, z = coords
+    lines = [f"\nVoxel at {coords}:", f"  Stored Hurst: {stored_hurst}"]
+    try:
+        lines.append(f"  Recomputed Hurst: {recomputed_hurst}")
+        
+        # Check if values match within tolerance
+        if abs(stored_hurst - recomputed_hurst) < tol:
+            lines.append(f"  MATCH: Values match within tolerance of {tol}")
+        else:
+            lines.append(f"  MISMATCH: Values differ by {abs(stored_hurst - recomputed_hurst)}")
+
+        if not plots:
+            return lines
+
+        # Plot the time series
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        ax.plot(ts)
+        ax.set_title(f"Time Series at {coords}, Hurst={recomputed_hurst:.4f}")
+        ax.set_xlabel("Time Point")
+        ax.set_ylabel("BOLD Signal")
+        ax.grid(True)
+        FigureCanvasAgg(fig).print_png(f"{output_dir}/timeseries_{x}_{y}_{z}.png")
+        
+        # Save time series as float32 .npy, which is much faster to write than text
+        np.save(f"{output_dir}/timeseries_{x}_{y}_{z}.npy", np.asarray(ts, dtype=np.float32))
+        if save_csv:
+            np.savetxt(f"{output_dir}/timeseries_{x}_{y}_{z}.csv", ts, delimiter=',', fmt='%.6g')
+        
+    except Exception as e:
+        lines.append(f"  ERROR: {e}")
+    return lines
+
+
+def _read_voxel_series(fmri_img, coords, max_random_reads=16):
+    """
+    Read the time series of the given voxels from the fMRI data proxy as a
+    float32 array of shape (n_voxels, nt).
+
+    NIfTI stores time as the slowest axis, so one voxel's series is spread
+    over the whole file. A few voxels are read one by one (cheap with
+    indexed_gzip seek points); for more than max_random_reads voxels the file
+    is read once, volume by volume, and the voxels are gathered from each.
+    """
+    if len(coords) <= max_random_reads:
+        return np.stack([np.asarray(fmri_img.dataobj[x, y, z, :], dtype=np.float32) for x, y, z in coords])
+    xs, ys, zs = (np.asarray(c) for c in zip(*coords))
+    nt = fmri_img.shape[3]
+    buf = np.empty((nt, len(coords)), dtype=np.float32)
+    for t in range(nt):
+        buf[t] = np.asarray(fmri_img.dataobj[..., t], dtype=np.float32)[xs, ys, zs]
+    return np.ascontiguousarray(buf.T)
+
+
+parser = argparse.ArgumentParser(description='Validate a computed Hurst map against recomputed voxel values')
+parser.add_argument('--fmri', default='/media/brainlab-uwo/Data1/Results/pipeline_test_3/sub-17017/func/sub-17017_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz',
+                    help='Input fMRI file')
+parser.add_argument('--hurst', default='outputs/sub-17017/metrics/hurst.nii.gz', help='Computed Hurst map')
+parser.add_argument('--output-dir', default='outputs/hurst_analysis', help='Output directory')
+parser.add_argument('--n-voxels', type=int, default=4,
+                    help='Number of voxels to validate: the center and its three offsets, then random '
+                         'voxels with a non-zero Hurst value. Default is 4.')
+parser.add_argument('--no-plots', dest='plots', action='store_false',
+                    help='Batch mode: no figures or per-voxel dumps, only the validation table')
+parser.add_argument('--csv', action='store_true',
+                    help='Also write the voxel time series as CSV next to the .npy files')
+args = parser.parse_args()
+if args.n_voxels < 1:
+    parser.error('--n-voxels must be at least 1')
+
 # File paths
-fmri_file = '/media/brainlab-uwo/Data1/Results/pipeline_test_3/sub-17017/func/sub-17017_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
-hurst_file = 'outputs/sub-17017/metrics/hurst.nii.gz'
-output_dir = 'outputs/hurst_analysis'
+fmri_file = args.fmri
+hurst_file = args.hurst
+output_dir = args.output_dir
+save_csv = args.csv
 
 # Create output directory if it doesn't exist
 os.makedirs(output_dir, exist_ok=True)
 
 # Load the fMRI data and computed Hurst map
 print(f"Loading fMRI data from {fmri_file}")
-fmri_img = nib.load(fmri_file)
-fmri_data = fmri_img.get_fdata()
-nx, ny, nz, nt = fmri_data.shape
+# Only the test voxels' time series are read from the data proxy, never the
+# whole 4D series; the file is kept open between reads (seekable with indexed_gzip)
+fmri_img = nib.load(fmri_file, keep_file_open=True)
+nx, ny, nz, nt = fmri_img.shape
 print(f"fMRI dimensions: {nx} x {ny} x {nz} x {nt}")
 
 print(f"Loading Hurst map from {hurst_file}")
 hurst_img = nib.load(hurst_file)
-hurst_data = hurst_img.get_fdata()
+hurst_data = np.asanyarray(hurst_img.dataobj)
 print(f"Hurst map dimensions: {hurst_data.shape}")
 
 # Check affine transformation matrices
@@ -33,12 +128,23 @@ print("Hurst affine:")
 print(hurst_img.affine)
 
 # Basic statistics of Hurst map
+if positive_stats is not None:
+    # Count, sum and min of the non-zero values and the overall max in one pass
+    n_non_zero, sum_hurst, min_hurst, max_hurst = positive_stats(hurst_data)
+    # A map without positive values has no non-zero statistics
+    min_hurst, mean_hurst = (min_hurst, sum_hurst / n_non_zero) if n_non_zero else (np.nan, np.nan)
+# The non-zero values are copied out only once, for the median (partitioned
+# in place, no second copy) and the histogram, which ignores their order
 non_zero_hurst = hurst_data[hurst_data > 0]
-print(f"Min non-zero Hurst: {np.min(non_zero_hurst)}")
-print(f"Max Hurst: {np.max(hurst_data)}")
-print(f"Mean Hurst (non-zero): {np.mean(non_zero_hurst)}")
-print(f"Median Hurst (non-zero): {np.median(non_zero_hurst)}")
-print(f"Non-zero voxel count: {len(non_zero_hurst)}")
+if positive_stats is None:
+    n_non_zero = len(non_zero_hurst)
+    max_hurst = np.max(hurst_data)
+    min_hurst, mean_hurst = (np.min(non_zero_hurst), np.mean(non_zero_hurst)) if n_non_zero else (np.nan, np.nan)
+print(f"Min non-zero Hurst: {min_hurst}")
+print(f"Max Hurst: {max_hurst}")
+print(f"Mean Hurst (non-zero): {mean_hurst}")
+print(f"Median Hurst (non-zero): {np.median(non_zero_hurst, overwrite_input=True) if n_non_zero else np.nan}")
+print(f"Non-zero voxel count: {n_non_zero}")
 print(f"Total brain voxels: {np.prod(hurst_data.shape)}")
 
 # Select a few voxels for validation
@@ -48,66 +154,72 @@ test_coords = [
     (nx//2+5, ny//2, nz//2),  # Offset
     (nx//2, ny//2+5, nz//2),  # Offset
     (nx//2, ny//2, nz//2+5)   # Offset
-]
+][:args.n_voxels]
+if args.n_voxels > len(test_coords):
+    # Additional voxels drawn (reproducibly) from the non-zero part of the map
+    candidates = np.argwhere(hurst_data > 0)
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(candidates), size=min(args.n_voxels - len(test_coords), len(candidates)), replace=False)
+    test_coords += [tuple(int(c) for c in candidates[i]) for i in np.sort(picks)]
 
-for coords in test_coords:
-    x, y, z = coords
-    ts = fmri_data[x, y, z, :]
-    stored_hurst = hurst_data[x, y, z]
-    
-    # Skip if time series has no variance
-    if np.std(ts) <= 1e-6:
-        print(f"Voxel at {coords} has no variance, skipping")
-        continue
-    
-    print(f"\nVoxel at {coords}:")
-    print(f"  Stored Hurst: {stored_hurst}")
-    
+# Recompute the Hurst exponents of all test voxels with variance in one batch,
+# as nolds.hurst_rs with a least-squares fit does (numba kernel if available)
+test_ts = _read_voxel_series(fmri_img, test_coords)
+has_variance = np.std(test_ts, axis=1) > 1e-6
+recomputed = np.full(len(test_coords), np.nan)
+if np.any(has_variance):
     try:
-        # Recompute Hurst exponent
-        recomputed_hurst = nolds.hurst_rs(ts)
-        print(f"  Recomputed Hurst: {recomputed_hurst}")
-        
-        # Check if values match within tolerance
-        tol = 1e-6
-        if abs(stored_hurst - recomputed_hurst) < tol:
-            print(f"  MATCH: Values match within tolerance of {tol}")
+        if hurst_rs_batch is not None:
+            recomputed[has_variance] = hurst_rs_batch(test_ts[has_variance])
         else:
-            print(f"  MISMATCH: Values differ by {abs(stored_hurst - recomputed_hurst)}")
-            
-        # Plot the time series
-        plt.figure(figsize=(10, 6))
-        plt.plot(ts)
-        plt.title(f"Time Series at {coords}, Hurst={recomputed_hurst:.4f}")
-        plt.xlabel("Time Point")
-        plt.ylabel("BOLD Signal")
-        plt.grid(True)
-        plt.savefig(f"{output_dir}/timeseries_{x}_{y}_{z}.png")
-        plt.close()
-        
-        # Save time series to CSV
-        np.savetxt(f"{output_dir}/timeseries_{x}_{y}_{z}.csv", ts, delimiter=',')
-        
+            recomputed[has_variance] = [nolds.hurst_rs(ts, fit='poly') for ts in test_ts[has_variance]]
     except Exception as e:
-        print(f"  ERROR: {e}")
-
-# Create a histogram of Hurst values
-plt.figure(figsize=(10, 6))
-plt.hist(non_zero_hurst, bins=50)
-plt.title("Distribution of Hurst Exponent Values")
-plt.xlabel("Hurst Exponent")
-plt.ylabel("Count")
-plt.grid(True)
-plt.savefig(f"{output_dir}/hurst_histogram.png")
-plt.close()
-
-# Create a 2D slice showing Hurst values
-slice_z = nz // 2
-plt.figure(figsize=(10, 8))
-plt.imshow(hurst_data[:, :, slice_z], cmap='viridis')
-plt.colorbar(label='Hurst Exponent')
-plt.title(f"Hurst Exponent Map (z={slice_z})")
-plt.savefig(f"{output_dir}/hurst_slice_z{slice_z}.png")
-plt.close()
-
-print("\nAnalysis complete. Results saved to:", output_dir) 
\ No newline at end of file
+        print(f"ERROR recomputing Hurst exponents: {e}")
+
+# Voxels are independent and the plotting, PNG encoding and file writes mostly
+# release the GIL, so they run in one thread each
+for coords, ts_has_variance in zip(test_coords, has_variance):
+    # Skip if time series has no variance
+    if not ts_has_variance:
+        print(f"Voxel at {coords} has no variance, skipping")
+jobs = [delayed(_validate_voxel)(coords, ts, hurst_data[coords], recomputed_hurst, output_dir,
+                                 save_csv=save_csv, plots=args.plots)
+        for coords, ts, ts_has_variance, recomputed_hurst in zip(test_coords, test_ts, has_variance, recomputed)
+        if ts_has_variance]
+n_threads = max(1, min(len(jobs), os.cpu_count() or 1)) if args.plots else 1
+for lines in Parallel(n_jobs=n_threads, prefer='threads')(jobs):
+    print("\n".join(lines))
+
+# All voxels in one table, written at once instead of one file per voxel
+with open(f"{output_dir}/hurst_validation.csv", "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["x", "y", "z", "stored_hurst", "recomputed_hurst", "abs_diff"])
+    for coords, recomputed_hurst in zip(test_coords, recomputed):
+        stored_hurst = float(hurst_data[coords])
+        writer.writerow([*coords, stored_hurst, recomputed_hurst, abs(stored_hurst - recomputed_hurst)])
+
+if args.plots:
+    # Create a histogram of Hurst values (Figure + Agg canvas, no pyplot state);
+    # the bin edges come from the min/max computed above, so the counts take one pass
+    edges = np.linspace(min_hurst, max_hurst, 51) if n_non_zero else 50
+    counts, edges = np.histogram(non_zero_hurst, bins=edges)
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge')
+    ax.set_title("Distribution of Hurst Exponent Values")
+    ax.set_xlabel("Hurst Exponent")
+    ax.set_ylabel("Count")
+    ax.grid(True)
+    FigureCanvasAgg(fig).print_png(f"{output_dir}/hurst_histogram.png")
+
+    # Create a 2D slice showing Hurst values, read on its own from the map's proxy
+    slice_z = hurst_img.shape[2] // 2
+    hurst_slice = np.asarray(hurst_img.dataobj[:, :, slice_z])
+    fig = Figure(figsize=(10, 8))
+    ax = fig.subplots()
+    im = ax.imshow(hurst_slice, cmap='viridis')
+    fig.colorbar(im, ax=ax, label='Hurst Exponent')
+    ax.set_title(f"Hurst Exponent Map (z={slice_z})")
+    FigureCanvasAgg(fig).print_png(f"{output_dir}/hurst_slice_z{slice_z}.png")
+
+print("\nAnalysis complete. Results saved to:", output_dir)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Disk-cached ROI time-series extraction shared by the ROI-wise fractal and Hurst scripts.
+"""
+
+import os
+import tempfile
+import numpy as np
+import nibabel as nib
+from joblib import Memory
+from nilearn.input_data import NiftiLabelsMasker, NiftiMapsMasker
+
+# Cache location, overridable with the ROI_TS_CACHE_DIR environment variable
+CACHE_DIR = os.environ.get("ROI_TS_CACHE_DIR",
+                           os.path.join(tempfile.gettempdir(), "roi_ts_cache"))
+memory = Memory(location=CACHE_DIR, verbose=0)
+# Size limit of the cache in bytes, overridable with the ROI_TS_CACHE_BYTES_LIMIT
+# environment variable; the least recently used extractions are removed first
+CACHE_BYTES_LIMIT = int(os.environ.get("ROI_TS_CACHE_BYTES_LIMIT", 2 * 1024**3))
+
+
+def _file_stamp(path):
+    """Size and modification time of a file, so the cache notices rewritten inputs."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+@memory.cache
+def _extract_roi_ts(fmri_img, atlas_img, use_maps_masker, fmri_stamp, atlas_stamp):
+    if use_maps_masker:
+        masker = NiftiMapsMasker(maps_img=atlas_img, standardize=True)
+        labels = None
+    else:
+        masker = NiftiLabelsMasker(labels_img=atlas_img, standardize=True)
+        atlas = nib.load(atlas_img)
+        labels = np.unique(np.asanyarray(atlas.dataobj).astype(np.int32, copy=False))
+
+    ts_data = np.ascontiguousarray(masker.fit_transform(fmri_img), dtype=np.float32)
+    return ts_data, labels
+
+
+def extract_roi_ts(fmri_img, atlas_img, use_maps_masker=False):
+    """
+    Extract standardized ROI time series, reusing a previous extraction of the
+    same fMRI/atlas pair from the disk cache. The cache is then pruned back to
+    CACHE_BYTES_LIMIT.
+
+    Parameters:
+    -----------
+    fmri_img : str
+        Path to 4D BOLD NIfTI file.
+    atlas_img : str
+        Path to atlas labels/maps NIfTI.
+    use_maps_masker : bool
+        If True use NiftiMapsMasker, else NiftiLabelsMasker.
+
+    Returns:
+    --------
+    tuple
+        (ts_data, labels): ts_data is a C-contiguous float32 array of shape
+        (T, R); labels holds the sorted label ids of the atlas, background
+        included (None with the maps masker).
+    """
+    result = _extract_roi_ts(str(fmri_img), str(atlas_img), bool(use_maps_masker),
+                             _file_stamp(fmri_img), _file_stamp(atlas_img))
+    memory.reduce_size(bytes_limit=CACHE_BYTES_LIMIT)
+    return result
@@ -1,9 +1,19 @@
 # run_combined_pipeline.py
 
 import argparse
+import gzip
+import json
+import struct
 import subprocess
+import os
+import shutil
+import stat
 import sys
+import tempfile
 import logging
+import threading
+import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from bids import BIDSLayout
 
@@ -17,35 +27,77 @@ FEATURE_EXTRACTION_WRAPPER = Path("Feature_extraction_Container/run_container_pi
 # Default location for dcm2bids config if not provided
 DEFAULT_DCM2BIDS_CONFIG_NAME = "dcm2bids_config.json"
 
+# pybids index of the BIDS input, kept under the main output directory.
+# The SQLite database only caches the directory scan and can be deleted at any time.
+BIDS_DATABASE_DIR_NAME = ".bids_db"
+# mtimes of the subject, session and datatype directories the index was built from, kept
+# in the index directory; the index is rebuilt when they change
+BIDS_TREE_FINGERPRINT_NAME = "bids_tree.json"
+
+# Key fMRIPrep outputs of one subject and task (names in sub-<s>/func), as
+# str.format templates, with the minimum size in bytes each file must exceed
+FMRIPREP_FUNC_OUTPUTS = {
+    "sub-{s}_task-{t}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz": 1000000,
+    "sub-{s}_task-{t}_desc-confounds_timeseries.tsv": 0,
+    "sub-{s}_task-{t}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz": 0,
+}
+FMRIPREP_REPORT_TMPL = "sub-{s}.html"
+
+# Size and mtime of the fMRIPrep outputs that passed the last validation, kept in
+# the derivatives directory; disposable, it only saves re-reading the NIfTI headers
+FMRIPREP_INVENTORY_NAME = ".fmriprep_inventory.json"
+
+# Written to the derivatives directory once fMRIPrep has completed for a BIDS input,
+# so later runs can skip the stage without indexing the input and checking the outputs
+FMRIPREP_COMPLETE_NAME = ".pipeline_complete"
+
 # --- Helper Functions ---
 
-def run_command(command, cwd=None):
-    """Executes a shell command and logs output."""
-    logging.info(f"Running command: {' '.join(map(str, command))}")
+def _log_stream(stream, log, prefix=""):
+    """Forwards each line of a child process stream to the given logging function."""
+    for line in iter(stream.readline, ''):
+        log(prefix + line.rstrip('\n'))
+    stream.close()
+
+def run_command(command, cwd=None, label=None):
+    """
+    Executes a shell command and logs its output line by line as it runs.
+    With a label (e.g. the subject of one of several parallel runs), every
+    logged line is prefixed with it, so interleaved output stays attributable.
+    """
+    prefix = f"[{label}] " if label else ""
+    logging.info(f"{prefix}Running command: {' '.join(map(str, command))}")
     try:
-        process = subprocess.run(
+        process = subprocess.Popen(
             command,
-            check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
+            bufsize=1, # Line buffered, so output is logged as soon as it is written
             cwd=cwd # Run command in the specified directory (often project root)
         )
-        logging.info(f"Command stdout:\n{process.stdout}")
-        if process.stderr:
-            logging.warning(f"Command stderr:\n{process.stderr}")
-        logging.info(f"Command completed successfully.")
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed with exit code {e.returncode}")
-        logging.error(f"Command: {' '.join(map(str, command))}")
-        logging.error(f"stdout:\n{e.stdout}")
-        logging.error(f"stderr:\n{e.stderr}")
-        return False
     except FileNotFoundError:
         logging.error(f"Error: Command not found: {command[0]}. Is it installed and in PATH?")
         return False
 
+    # Drain stdout and stderr concurrently so neither pipe can fill up and block the child
+    readers = [
+        threading.Thread(target=_log_stream, args=(process.stdout, logging.info, prefix), daemon=True),
+        threading.Thread(target=_log_stream, args=(process.stderr, logging.warning, prefix), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    process.wait()
+    for reader in readers:
+        reader.join()
+
+    if process.returncode != 0:
+        logging.error(f"{prefix}Command failed with exit code {process.returncode}")
+        logging.error(f"{prefix}Command: {' '.join(map(str, command))}")
+        return False
+    logging.info(f"{prefix}Command completed successfully.")
+    return True
+
 def convert_dicom_to_bids(dicom_dir: Path, bids_output_dir: Path, dcm2bids_config: Path, participant_id: str | None = None, session_id: str | None = None):
     """
     Uses dcm2bids to convert DICOM data to BIDS format.
@@ -86,10 +138,52 @@ def convert_dicom_to_bids(dicom_dir: Path, bids_output_dir: Path, dcm2bids_confi
     logging.info(f"DICOM to BIDS conversion completed. Output in: {bids_output_dir}")
     return True
 
+def _chmod_tree(directory: Path):
+    """
+    Adds u+rw (u+rwx on directories) to everything below directory in-process.
+
+    Every entry is stat'ed on each call: a chmod or chown of an existing file
+    does not change its directory's mtime, so nothing is skipped based on an
+    earlier walk.
+
+    Raises:
+        OSError: If the tree cannot be walked or a mode cannot be changed by the
+                 current user (PermissionError).
+    """
+    mode = os.stat(directory).st_mode
+    if mode & stat.S_IRWXU != stat.S_IRWXU:
+        os.chmod(directory, stat.S_IMODE(mode) | stat.S_IRWXU)
+
+    # Top-down: subdirectories are fixed before they are listed
+    pending = [os.fspath(directory)]
+    while pending:
+        root = pending.pop()
+
+        # Entries are stat'ed and changed relative to the open directory,
+        # instead of resolving their full path again
+        subdirs = []
+        root_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with os.scandir(root_fd) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        continue
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    wanted = stat.S_IRWXU if is_dir else stat.S_IRUSR | stat.S_IWUSR
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_mode & wanted != wanted:
+                        os.chmod(entry.name, stat.S_IMODE(st.st_mode) | wanted, dir_fd=root_fd)
+                    if is_dir:
+                        subdirs.append(os.path.join(root, entry.name))
+        finally:
+            os.close(root_fd)
+        pending.extend(subdirs)
+
 def fix_permissions(directory: Path):
     """
     Fix permissions on a directory and its contents to ensure they are readable and writable.
-    Uses multiple approaches, trying without sudo first, then with sudo if necessary.
+    Changes the modes in-process first, and only falls back to chmod/chown with sudo
+    if the current user is not allowed to change them.
     
     Args:
         directory: Path to the directory to fix permissions for.
@@ -99,11 +193,15 @@ def fix_permissions(directory: Path):
     """
     logging.info(f"Fixing permissions for {directory}...")
 
-    # Make multiple attempts with different strategies
+    try:
+        _chmod_tree(directory)
+        logging.info(f"Fixed permissions for {directory}")
+        return True
+    except OSError as e:
+        logging.debug(f"In-process permission fix failed: {e}")
+
+    # Fall back to the external tools, with sudo
     strategies = [
-        # Try regular chmod first (no sudo)
-        ["chmod", "-R", "u+rw", str(directory)],
-        # If that fails, try with sudo
         ["sudo", "chmod", "-R", "u+rw", str(directory)],
         # More aggressive approach with group permissions as well
         ["sudo", "chmod", "-R", "775", str(directory)],
@@ -135,6 +233,123 @@ def fix_permissions(directory: Path):
     logging.warning(f"All permission fixing strategies failed for {directory}")
     return False
 
+def _nifti_complete(path: str, size: int) -> bool:
+    """
+    Check that a NIfTI-1 file (.nii or .nii.gz) has a valid header and is not truncated.
+
+    The header is read (for .nii.gz only the first block is decompressed) and
+    the data size it implies is compared with the file size, or for gzip files
+    with the uncompressed size stored in the last 4 bytes of the stream.
+
+    Args:
+        path: Path of the file
+        size: Size of the file in bytes
+
+    Returns:
+        True if the header is valid and the file holds all of its data, False otherwise
+    """
+    try:
+        with open(path, "rb") as f:
+            if path.endswith(".gz"):
+                with gzip.GzipFile(fileobj=f) as gz:
+                    header = gz.read(348)
+                # ISIZE: uncompressed size modulo 2**32
+                stored_size = struct.unpack("<I", os.pread(f.fileno(), 4, size - 4))[0]
+                modulo = 2 ** 32
+            else:
+                header = os.pread(f.fileno(), 348, 0)
+                stored_size, modulo = size, None
+    except (OSError, EOFError, struct.error):
+        return False
+
+    if len(header) < 348 or header[344:348] not in (b"n+1\0", b"ni1\0"):
+        return False
+    # The header size field tells the byte order
+    for endian in "<>":
+        if struct.unpack(endian + "i", header[:4])[0] == 348:
+            break
+    else:
+        return False
+
+    dim = struct.unpack(endian + "8h", header[40:56])
+    bitpix = struct.unpack(endian + "h", header[72:74])[0]
+    vox_offset = struct.unpack(endian + "f", header[108:112])[0]
+    if not 1 <= dim[0] <= 7:
+        return False
+    n_voxels = 1
+    for d in dim[1:dim[0] + 1]:
+        n_voxels *= max(d, 1)
+    expected_size = int(vox_offset) + n_voxels * bitpix // 8
+
+    if modulo is not None:
+        return expected_size % modulo == stored_size
+    return stored_size >= expected_size
+
+def _output_ok(entry: os.DirEntry | None, min_size: int, inventory: dict | None = None, validated: dict | None = None) -> bool:
+    """
+    Check one fMRIPrep output file from its directory entry.
+
+    Args:
+        entry: Directory entry of the file, or None if it is missing
+        min_size: The file must be larger than this many bytes
+        inventory: Optional {path: [size, mtime_ns]} of files validated before
+        validated: Optional dict that receives {path: [size, mtime_ns]} if the file passes
+
+    Returns:
+        True if the file exists, is large enough and, for NIfTI files, holds all of its data
+    """
+    if entry is None:
+        return False
+    try:
+        st = entry.stat()
+    except OSError:
+        return False
+    fingerprint = [st.st_size, st.st_mtime_ns]
+    if st.st_size <= min_size:
+        return False
+    if (entry.name.endswith((".nii", ".nii.gz")) and (inventory or {}).get(entry.path) != fingerprint
+            and not _nifti_complete(entry.path, st.st_size)):
+        return False
+    if validated is not None:
+        validated[entry.path] = fingerprint
+    return True
+
+def _subject_outputs_complete(fmriprep_output_dir: Path, subject: str, tasks: list[str], inventory: dict | None = None, validated: dict | None = None) -> bool:
+    """
+    Check the fMRIPrep outputs of one subject for all tasks.
+
+    The func directory is listed once and the expected files are looked up in
+    the listing, so only files that are present are stat'ed (for their size).
+    The NIfTI outputs must also have a valid header and hold all of their data,
+    unless their size and mtime match the inventory of the last validation.
+
+    Args:
+        fmriprep_output_dir: The directory where fMRIPrep outputs are stored
+        subject: Subject ID to check
+        tasks: List of task names to check
+        inventory: Optional {path: [size, mtime_ns]} of files validated before
+        validated: Optional dict that receives {path: [size, mtime_ns]} of the files that passed
+
+    Returns:
+        True if all expected outputs of the subject exist and have reasonable sizes, False otherwise
+    """
+    try:
+        with os.scandir(fmriprep_output_dir / f"sub-{subject}" / "func") as it:
+            entries = {entry.name: entry for entry in it}
+    except OSError:
+        logging.info(f"Missing or invalid fMRIPrep outputs for sub-{subject}")
+        return False
+
+    for task in tasks:
+        # Key output files with their minimum sizes
+        complete = all(_output_ok(entries.get(tmpl.format(s=subject, t=task)), min_size, inventory, validated)
+                       for tmpl, min_size in FMRIPREP_FUNC_OUTPUTS.items())
+        if not complete:
+            logging.info(f"Missing or invalid fMRIPrep outputs for sub-{subject} task-{task}")
+            return False
+        logging.info(f"Found existing fMRIPrep outputs for sub-{subject} task-{task}")
+    return True
+
 def check_fmriprep_outputs_exist(fmriprep_output_dir: Path, subjects: list[str], tasks: list[str]) -> bool:
     """
     Check if fMRIPrep outputs already exist and have reasonable sizes for all subjects and tasks.
@@ -148,143 +363,521 @@ def check_fmriprep_outputs_exist(fmriprep_output_dir: Path, subjects: list[str],
         True if all expected outputs exist and have reasonable sizes, False otherwise
     """
     logging.info("Checking for existing fMRIPrep outputs...")
+    inventory_file = fmriprep_output_dir / FMRIPREP_INVENTORY_NAME
+    try:
+        with open(inventory_file) as f:
+            inventory = json.load(f)
+    except (OSError, ValueError):
+        inventory = {}
+    validated = {}
+
     all_outputs_exist = True
-    
-    for subject in subjects:
-        for task in tasks:
-            # Check if the key output files exist
-            bold_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
-            confounds_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_desc-confounds_timeseries.tsv"
-            mask_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
-            
-            # Check if files exist and have reasonable sizes
-            if (bold_out.exists() and bold_out.stat().st_size > 1000000 and 
-                confounds_out.exists() and confounds_out.stat().st_size > 0 and
-                mask_out.exists() and mask_out.stat().st_size > 0):
-                logging.info(f"Found existing fMRIPrep outputs for sub-{subject} task-{task}")
-            else:
-                logging.info(f"Missing or invalid fMRIPrep outputs for sub-{subject} task-{task}")
-                all_outputs_exist = False
-                break
-                
-        if not all_outputs_exist:
-            break
+    if subjects:
+        # Subjects are checked concurrently, since the directory listings and stats are
+        # latency bound on network file systems; all() stops at the first subject with
+        # missing outputs and the checks that have not started yet are cancelled
+        with ThreadPoolExecutor(max_workers=min(32, len(subjects))) as executor:
+            futures = [executor.submit(_subject_outputs_complete, fmriprep_output_dir, subject, tasks,
+                                       inventory, validated)
+                       for subject in subjects]
+            all_outputs_exist = all(future.result() for future in as_completed(futures))
+            if not all_outputs_exist:
+                for pending in futures:
+                    pending.cancel()
     
     if all_outputs_exist:
         logging.info("All fMRIPrep outputs exist and appear valid. Can skip fMRIPrep stage.")
+        if validated != inventory:
+            # Remember the validated outputs, so the next check only has to stat them
+            try:
+                tmp_file = inventory_file.with_name(f"{inventory_file.name}.{os.getpid()}.tmp")
+                with open(tmp_file, "w") as f:
+                    json.dump(validated, f)
+                os.replace(tmp_file, inventory_file)
+            except OSError as e:
+                logging.debug(f"Could not write fMRIPrep output inventory {inventory_file}: {e}")
     else:
         logging.info("Not all fMRIPrep outputs exist or are valid. fMRIPrep stage is needed.")
         
     return all_outputs_exist
 
+def _fmriprep_stamp(bids_dir: Path, participant_label: list[str] | None = None) -> dict | None:
+    """
+    Identifies the fMRIPrep input for the completion sentinel: the BIDS directory,
+    the mtimes of its subject, session and datatype directories (see
+    _bids_tree_fingerprint), which change when subjects, sessions or runs are
+    added or removed, and the subjects selected.
+
+    Args:
+        bids_dir: Path to the BIDS input dataset.
+        participant_label: Optional list of selected subjects; None means all.
+
+    Returns:
+        The stamp as a JSON-serializable dict, or None if no subject directory can be listed.
+    """
+    tree = _bids_tree_fingerprint(bids_dir)
+    if not tree:
+        return None
+    return {
+        "bids_dir": os.path.abspath(bids_dir),
+        "tree": tree,
+        "participant_label": sorted(participant_label) if participant_label else None,
+    }
+
+def fmriprep_marked_complete(fmriprep_output_dir: Path, stamp: dict | None) -> bool:
+    """
+    Check the completion sentinel in the fMRIPrep derivatives directory.
+
+    The sentinel must have been written for the same input, and the key outputs
+    of all its subjects and tasks must still have the size and mtime recorded in
+    the output inventory when they were validated. This takes one stat per
+    output, without reading the BIDS layout or the NIfTI headers.
+
+    Args:
+        fmriprep_output_dir: The directory where fMRIPrep outputs are stored
+        stamp: Stamp of the current input (see _fmriprep_stamp)
+
+    Returns:
+        True if the sentinel matches the input and the outputs are unchanged, False otherwise
+    """
+    if stamp is None:
+        return False
+    try:
+        with open(fmriprep_output_dir / FMRIPREP_COMPLETE_NAME) as f:
+            sentinel = json.load(f)
+        with open(fmriprep_output_dir / FMRIPREP_INVENTORY_NAME) as f:
+            inventory = json.load(f)
+        if {key: sentinel.get(key) for key in stamp} != stamp or not sentinel["subjects"] or not sentinel["tasks"]:
+            return False
+        for subject in sentinel["subjects"]:
+            func_dir = os.path.join(fmriprep_output_dir, f"sub-{subject}", "func")
+            for task in sentinel["tasks"]:
+                for tmpl in FMRIPREP_FUNC_OUTPUTS:
+                    path = os.path.join(func_dir, tmpl.format(s=subject, t=task))
+                    st = os.stat(path)
+                    if inventory.get(path) != [st.st_size, st.st_mtime_ns]:
+                        return False
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return True
+
+def mark_fmriprep_complete(fmriprep_output_dir: Path, stamp: dict | None, subjects: list[str] | None = None, tasks: list[str] | None = None):
+    """
+    Write the completion sentinel for the given input, or remove it if stamp is None.
+
+    Args:
+        fmriprep_output_dir: The directory where fMRIPrep outputs are stored
+        stamp: Stamp of the input the outputs are complete for (see _fmriprep_stamp)
+        subjects: Subjects whose outputs were validated (by check_fmriprep_outputs_exist)
+        tasks: Tasks whose outputs were validated
+    """
+    sentinel = fmriprep_output_dir / FMRIPREP_COMPLETE_NAME
+    try:
+        if stamp is None or not subjects or not tasks:
+            sentinel.unlink(missing_ok=True)
+            return
+        tmp_file = sentinel.with_name(f"{sentinel.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({**stamp, "subjects": sorted(subjects), "tasks": sorted(tasks)}, f)
+        os.replace(tmp_file, sentinel)
+    except OSError as e:
+        logging.debug(f"Could not update fMRIPrep completion sentinel {sentinel}: {e}")
+
+def _bids_tree_fingerprint(bids_dir: Path) -> dict:
+    """
+    Cheap fingerprint of the layout of a BIDS dataset, without listing any data files.
+
+    Adding or removing a subject, session or data file changes the mtime of the
+    directory it is (un)linked in, so the mtimes of all sub-*, sub-*/ses-* and
+    datatype (func, anat, ...) directories change whenever the index would.
+
+    Args:
+        bids_dir: Path to the BIDS dataset.
+
+    Returns:
+        {directory relative to bids_dir: mtime_ns}, empty if bids_dir cannot be listed.
+    """
+    fingerprint = {}
+    # (relative path, depth): subjects are at depth 0, sessions or datatypes at depth 1
+    pending = [("", -1)]
+    while pending:
+        rel, depth = pending.pop()
+        try:
+            with os.scandir(os.path.join(bids_dir, rel)) as it:
+                for entry in it:
+                    if depth == -1 and not entry.name.startswith("sub-"):
+                        continue
+                    if not entry.is_dir():
+                        continue
+                    child = os.path.join(rel, entry.name) if rel else entry.name
+                    fingerprint[child] = entry.stat().st_mtime_ns
+                    # Datatype directories of sessions are the deepest level looked at
+                    if depth == -1 or (depth == 0 and entry.name.startswith("ses-")):
+                        pending.append((child, depth + 1))
+        except OSError:
+            continue
+    return fingerprint
+
+def load_bids_layout(bids_dir: Path, database_path: Path | None = None, reset_database: bool = False, validate: bool = True):
+    """
+    Loads the BIDSLayout of a dataset, reusing the pybids SQLite index when available.
+
+    Args:
+        bids_dir: Path to the BIDS dataset.
+        database_path: Optional directory holding the pybids SQLite index. When it already
+                       contains an index and the subject, session and datatype directories
+                       are unchanged since it was built, the dataset is not rescanned.
+        reset_database: If True, rescans the dataset and rebuilds the index.
+        validate: If False, indexes the files without checking them against the BIDS
+                  specification. Only matters when the dataset is (re)scanned.
+
+    Returns:
+        The BIDSLayout.
+    """
+    if database_path is None:
+        return BIDSLayout(str(bids_dir), validate=validate)
+
+    fingerprint = _bids_tree_fingerprint(bids_dir)
+    fingerprint_file = Path(database_path) / BIDS_TREE_FINGERPRINT_NAME
+    if not reset_database:
+        try:
+            with open(fingerprint_file) as f:
+                stale = json.load(f) != fingerprint
+        except (OSError, ValueError):
+            stale = True
+        if stale and Path(database_path).exists():
+            logging.info(f"BIDS input {bids_dir} changed since it was indexed, rebuilding the pybids index.")
+            reset_database = True
+
+    layout = BIDSLayout(str(bids_dir), validate=validate, database_path=str(database_path),
+                        reset_database=reset_database)
+    try:
+        tmp_file = fingerprint_file.with_name(f"{fingerprint_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(fingerprint, f)
+        os.replace(tmp_file, fingerprint_file)
+    except OSError as e:
+        logging.debug(f"Could not write BIDS tree fingerprint {fingerprint_file}: {e}")
+    return layout
+
 # --- Pipeline Stages ---
 
-def run_fmriprep_pipeline(bids_input_dir: Path, fmriprep_output_dir: Path, cores: int, participant_label: list[str] | None = None, memory_mb_override: int | None = None, force: bool = False):
+def _fmriprep_targets(out_root: str, subject: str, tasks: list[str]) -> list[str]:
+    """
+    Builds the Snakemake target files of the run_fmriprep rule for one subject.
+
+    Args:
+        out_root: Resolved fmriprep derivatives directory, as a string.
+        subject: Subject label (without the 'sub-' prefix).
+        tasks: List of task names.
+
+    Returns:
+        List of target file paths as strings.
+    """
+    func_dir = f"{out_root}/sub-{subject}/func"
+    # Expected outputs of the run_fmriprep rule per task, with the 'sub-' prefix
+    # of the Docker container's output format
+    targets = [
+        f"{func_dir}/{tmpl.format(s=subject, t=task)}"
+        for task in tasks
+        for tmpl in FMRIPREP_FUNC_OUTPUTS
+    ]
+    if tasks:
+        # The subject's report (check_fmriprep_reports rule), once rather than per task
+        targets.append(f"{out_root}/{FMRIPREP_REPORT_TMPL.format(s=subject)}")
+    # Add the permissions marker file without task dependency, after all task outputs
+    targets.append(f"{func_dir}/.permissions_fixed")
+    return targets
+
+def _missing_targets(targets: list[str]) -> list[str]:
+    """
+    Returns the targets that do not exist yet, or are empty. Empty marker files
+    (such as .permissions_fixed) only need to exist. NIfTI targets must also have
+    a valid header and hold all of their data, so outputs truncated by a killed
+    run are handed to snakemake again.
+
+    The stat calls are run in a thread pool, since on network file systems
+    they are bound by latency rather than CPU.
+    """
+    def _is_missing(target):
+        try:
+            size = os.stat(target).st_size
+        except FileNotFoundError:
+            return True
+        if target.endswith((".nii", ".nii.gz")):
+            return not _nifti_complete(target, size)
+        return size == 0 and not Path(target).name.startswith(".")
+
+    with ThreadPoolExecutor(max_workers=min(32, len(targets))) as executor:
+        flags = list(executor.map(_is_missing, targets))
+    return [target for target, missing in zip(targets, flags) if missing]
+
+def _config_mem_mb(snakefile: Path) -> int | None:
+    """
+    Reads the default fMRIPrep memory limit (preprocessing.mem_mb) from the
+    config file next to the fmriprep Snakefile.
+
+    Args:
+        snakefile: Absolute path to the fmriprep Snakefile.
+
+    Returns:
+        The memory limit in MB, or None if the config cannot be read.
+    """
+    try:
+        with open(snakefile.parent / "config" / "pipeline_config.yaml") as f:
+            return int(yaml.safe_load(f)["preprocessing"]["mem_mb"])
+    except (OSError, yaml.YAMLError, KeyError, TypeError, ValueError) as e:
+        logging.warning(f"Could not read preprocessing.mem_mb from the fMRIPrep config: {e}")
+        return None
+
+def _write_snakemake_config(bids_input_dir: Path, fmriprep_output_dir: Path, memory_mb: int | None = None, work_dir: str | None = None) -> str:
+    """
+    Writes the config overrides for the fmriprep Snakefile to a temporary JSON file.
+    Snakemake merges it over the Snakefile's own config file, like --config would,
+    but the values keep their JSON types and the command line stays short.
+
+    Args:
+        bids_input_dir: Absolute path to the BIDS input dataset.
+        fmriprep_output_dir: Absolute path where fmriprep derivatives should be saved.
+        memory_mb: Optional memory limit in MB to pass directly to fmriprep.
+        work_dir: Optional fMRIPrep work directory, as seen inside the container
+                  (the derivatives directory is mounted at /out).
+
+    Returns:
+        Path of the config file; the caller removes it when Snakemake is done.
+    """
+    config = {
+        "bids_input_dir": str(bids_input_dir),
+        "derivatives_output_dir": str(fmriprep_output_dir),
+    }
+    if memory_mb is not None:
+        config["cmd_mem_mb"] = memory_mb
+    if work_dir is not None:
+        config["work_dir"] = work_dir
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", prefix="fmriprep_config_", delete=False) as f:
+        json.dump(config, f)
+    return f.name
+
+
+def _snakemake_command(snakefile: Path, configfile: str, cores: int, targets: list[str], force: bool = False, nolock: bool = False, deployment_args: list[str] | None = None) -> list[str]:
+    """
+    Builds the Snakemake command line for the fmriprep pipeline.
+    The paths must already be absolute; they are used as given.
+
+    Args:
+        snakefile: Absolute path to the fmriprep Snakefile.
+        configfile: Config overrides written by _write_snakemake_config.
+        cores: Number of cores for this Snakemake invocation.
+        targets: Target files to build.
+        force: If True, forces re-execution of all jobs regardless of existing outputs.
+        nolock: If True, does not lock the working directory, so several
+                invocations with disjoint targets can run side by side.
+        deployment_args: Software deployment flags (see _deployment_args);
+                         defaults to plain --use-conda.
+
+    Returns:
+        The command as a list of strings.
+    """
+    # Define Snakemake command
+    cmd = [
+        "snakemake",
+        "--snakefile", str(snakefile),
+        "--directory", str(snakefile.parent),
+    ]
+    # Add config overrides
+    cmd.extend(["--configfile", configfile])
+
+    # Add other flags
+    cmd.extend(["--cores", str(cores)])
+    cmd.extend(deployment_args if deployment_args is not None else ["--use-conda"])
+    cmd.extend([
+        "--rerun-incomplete",
+        "--keep-going",
+        "--latency-wait", "60",  # Wait up to 60 seconds for output files to appear
+        "-p" # Print shell commands
+    ])
+    if nolock:
+        cmd.append("--nolock")
+
+    # If forcing execution, add the -F flag
+    if force:
+        cmd.append("-F")  # Force re-execution of all jobs
+
+    # Add the specific target files to the command
+    cmd.extend(targets)
+    return cmd
+
+def _deployment_args(conda_frontend: str | None = None, conda_prefix: Path | None = None, use_singularity: bool = False) -> list[str]:
+    """
+    Builds the Snakemake software deployment flags.
+
+    Args:
+        conda_frontend: 'mamba' or 'conda'. If None, mamba is used when it is installed,
+                        since its solver is much faster than the classic conda one.
+        conda_prefix: Optional directory where the conda environments are kept, so they
+                      are created and solved once and reused by later runs.
+        use_singularity: If True, also run the rules that name a container image in singularity.
+
+    Returns:
+        The flags as a list of strings.
+    """
+    if conda_frontend is None:
+        conda_frontend = "mamba" if shutil.which("mamba") else "conda"
+    logging.info(f"Using conda frontend: {conda_frontend}")
+
+    args = ["--use-conda", "--conda-frontend", conda_frontend]
+    if conda_prefix is not None:
+        args.extend(["--conda-prefix", str(conda_prefix.resolve())])
+    if use_singularity:
+        args.append("--use-singularity")
+    return args
+
+def run_fmriprep_pipeline(bids_input_dir: Path, fmriprep_output_dir: Path, cores: int, participant_label: list[str] | None = None, memory_mb_override: int | None = None, force: bool = False, cores_per_subject: int = 4, bids_database_path: Path | None = None, reset_bids_database: bool = False, conda_frontend: str | None = None, conda_prefix: Path | None = None, use_singularity: bool = False, subjects_to_process: list[str] | None = None, tasks: list[str] | None = None, validate_bids: bool = True):
     """
     Runs the fmriprep Snakemake pipeline.
 
+    fMRIPrep does not parallelize well across subjects on its own, so when
+    there are enough cores the subjects are split over parallel Snakemake
+    invocations, one per subject, each with cores // parallel cores, its own
+    fMRIPrep work directory and 1/parallel of the memory limit (memory_mb_override,
+    or else the config's preprocessing.mem_mb).
+
     Args:
         bids_input_dir: Path to the BIDS input dataset.
         fmriprep_output_dir: Path where fmriprep derivatives should be saved.
-        cores: Number of cores to use for Snakemake.
+        cores: Total number of cores to use for Snakemake.
         participant_label: Optional list of specific participant labels to process.
-        memory_mb_override: Optional memory limit in MB to pass directly to fmriprep.
+        memory_mb_override: Optional total memory limit in MB to pass directly to fmriprep.
         force: If True, forces re-execution of all jobs regardless of existing outputs.
+        cores_per_subject: Minimum number of cores for each subject run (default 4).
+        bids_database_path: Optional directory of the pybids SQLite index to reuse.
+        reset_bids_database: If True, rebuilds the pybids index instead of reusing it.
+        conda_frontend: Optional conda frontend for Snakemake ('mamba' or 'conda'; default:
+                        mamba if installed).
+        conda_prefix: Optional directory to keep the Snakemake conda environments in across runs.
+        use_singularity: If True, passes --use-singularity to Snakemake.
+        subjects_to_process: Optional subjects already read from the BIDS layout (participant_label
+                             applied). Together with tasks, the dataset is then not indexed again.
+        tasks: Optional task names already read from the BIDS layout.
+        validate_bids: If False, the BIDS input is indexed without validation (see load_bids_layout).
 
     Returns:
         True if successful, False otherwise.
     """
     logging.info("--- Starting fMRIPrep Pipeline Stage (Skipping Denoising) ---")
-    
+
+    # Resolve the paths once, the snakemake command lines reuse them as they are
+    snakefile = FMRIREP_SNAKEFILE.resolve()
+    bids_input_dir = bids_input_dir.resolve()
+    fmriprep_output_dir = fmriprep_output_dir.resolve()
+
     # Create output directory if it doesn't exist
     fmriprep_output_dir.mkdir(parents=True, exist_ok=True)
     
     # Fix permissions on the output directory before we start
     # This ensures any existing files from previous runs are writable
-    if fmriprep_output_dir.exists():
-        logging.info("Pre-emptively fixing permissions on output directory...")
-        fix_permissions(fmriprep_output_dir)
+    logging.info("Pre-emptively fixing permissions on output directory...")
+    fix_permissions(fmriprep_output_dir)
 
-    # Use pybids to find subjects and tasks to potentially build specific targets
-    try:
-        layout = BIDSLayout(str(bids_input_dir), validate=True)
-        # Use participant_label if provided, otherwise get all subjects
-        subjects_to_process = participant_label if participant_label else layout.get_subjects()
-        tasks = layout.get_tasks()
-        if not subjects_to_process:
-            logging.error(f"No subjects found or specified in BIDS directory: {bids_input_dir}")
+    # Use pybids to find subjects and tasks to potentially build specific targets,
+    # unless the caller already read them from the layout
+    if subjects_to_process is None or tasks is None:
+        try:
+            layout = load_bids_layout(bids_input_dir, bids_database_path, reset_bids_database, validate_bids)
+            # Use participant_label if provided, otherwise get all subjects
+            subjects_to_process = participant_label if participant_label else layout.get_subjects()
+            tasks = layout.get_tasks()
+        except Exception as e:
+            logging.error(f"PyBIDS error reading {bids_input_dir}: {e}")
             return False
-        logging.info(f"Processing subjects: {subjects_to_process}")
-        logging.info(f"Found tasks: {tasks}")
-    except Exception as e:
-        logging.error(f"PyBIDS error reading {bids_input_dir}: {e}")
+    if not subjects_to_process:
+        logging.error(f"No subjects found or specified in BIDS directory: {bids_input_dir}")
         return False
+    logging.info(f"Processing subjects: {subjects_to_process}")
+    logging.info(f"Found tasks: {tasks}")
 
     # --- Generate target file paths for the run_fmriprep rule --- 
     # This ensures snakemake only runs fmriprep and its dependencies
-    fmriprep_targets = []
-    for subject in subjects_to_process:
-        # Add the permissions marker file without task dependency
-        perm_marker = fmriprep_output_dir / f"sub-{subject}/func/.permissions_fixed"
-        
-        for task in tasks:
-            # Construct expected output paths based on the run_fmriprep rule
-            # Add 'sub-' prefix to match the Docker container's output format
-            bold_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
-            confounds_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_desc-confounds_timeseries.tsv"
-            mask_out = fmriprep_output_dir / f"sub-{subject}/func/sub-{subject}_task-{task}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
-            # Add report target as well, if the check_fmriprep_reports rule is desired
-            report_out = fmriprep_output_dir / f"sub-{subject}.html"
-            
-            fmriprep_targets.extend([str(bold_out), str(confounds_out), str(mask_out), str(report_out)])
-        
-        # Add the permissions marker file after all task outputs
-        fmriprep_targets.append(str(perm_marker))
+    # Target strings are built on the resolved root string, without a Path per file
+    out_root = os.fspath(fmriprep_output_dir)
+    subject_targets = {subject: _fmriprep_targets(out_root, subject, tasks)
+                       for subject in subjects_to_process}
+    fmriprep_targets = [target for targets in subject_targets.values() for target in targets]
 
     if not fmriprep_targets:
         logging.error("Could not generate any target files for Snakemake.")
         return False
 
-    # Define Snakemake command
-    cmd = [
-        "snakemake",
-        "--snakefile", str(FMRIREP_SNAKEFILE.resolve()),
-        "--directory", str(FMRIREP_SNAKEFILE.parent.resolve()),
-    ]
-    # Add config overrides
-    config_opts = [
-        f"bids_input_dir={str(bids_input_dir.resolve())}",
-        f"derivatives_output_dir={str(fmriprep_output_dir.resolve())}",
-    ]
+    if not force:
+        # Only pass the targets that still have to be built, so snakemake does not
+        # stat (and build a DAG for) outputs that are already complete
+        missing = set(_missing_targets(fmriprep_targets))
+        subject_targets = {subject: [target for target in targets if target in missing]
+                           for subject, targets in subject_targets.items()}
+        subject_targets = {subject: targets for subject, targets in subject_targets.items() if targets}
+        fmriprep_targets = [target for targets in subject_targets.values() for target in targets]
+        if not fmriprep_targets:
+            logging.info("All fMRIPrep targets present, skipping snakemake.")
+            return True
+        logging.info(f"{len(fmriprep_targets)} fMRIPrep targets missing for subjects: {list(subject_targets)}")
+
     if memory_mb_override is not None:
-        # Use a simple key for command-line config
-        config_opts.append(f"cmd_mem_mb={memory_mb_override}") 
         logging.info(f"Passing memory override to Snakemake: cmd_mem_mb={memory_mb_override} MB")
-    
-    cmd.extend(["--config"] + config_opts)
-    
-    # Add other flags
-    cmd.extend([
-        "--cores", str(cores),
-        "--use-conda",
-        "--rerun-incomplete",
-        "--keep-going",
-        "--latency-wait", "60",  # Wait up to 60 seconds for output files to appear
-        "-p" # Print shell commands
-    ])
-    
-    # If forcing execution, add the -F flag
     if force:
-        cmd.append("-F")  # Force re-execution of all jobs
         logging.info("Forcing re-execution of all jobs (ignoring existing outputs)")
 
-    # Add the specific target files to the command
-    cmd.extend(fmriprep_targets)
+    deployment_args = _deployment_args(conda_frontend, conda_prefix, use_singularity)
 
-    logging.info(f"Targeting specific outputs: {fmriprep_targets}")
+    # Number of subjects run side by side, each with at least cores_per_subject cores
+    parallel = min(len(subject_targets), max(1, cores // max(1, cores_per_subject)))
 
-    # Run the command from the project root
-    if not run_command(cmd, cwd=None):
+    if parallel == 1:
+        configfile = _write_snakemake_config(bids_input_dir, fmriprep_output_dir, memory_mb_override)
+        try:
+            cmd = _snakemake_command(snakefile, configfile, cores, fmriprep_targets, force,
+                                     deployment_args=deployment_args)
+            logging.info(f"Targeting specific outputs: {fmriprep_targets}")
+
+            # Run the command from the project root
+            success = run_command(cmd, cwd=None)
+        finally:
+            os.unlink(configfile)
+    else:
+        subject_cores = cores // parallel
+        # The memory limit (the override, or else the config's default) is shared by all running subjects
+        total_mem_mb = memory_mb_override if memory_mb_override is not None else _config_mem_mb(snakefile)
+        subject_mem_mb = total_mem_mb // parallel if total_mem_mb is not None else None
+        logging.info(f"Running {parallel} subjects in parallel with {subject_cores} cores each"
+                     + (f" and {subject_mem_mb} MB each" if subject_mem_mb is not None else ""))
+
+        # Each invocation builds only its own subject's targets, so the working
+        # directory lock is not needed and would make the others fail.
+        # The workers only wait on their snakemake child, so threads are enough.
+        # Each subject gets its own config file with its own fMRIPrep work directory,
+        # so the concurrent fMRIPrep instances do not share intermediate files.
+        configfiles = {}
+        try:
+            for subject in subject_targets:
+                configfiles[subject] = _write_snakemake_config(bids_input_dir, fmriprep_output_dir, subject_mem_mb,
+                                                               work_dir=f"/out/work/sub-{subject}")
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = {
+                    executor.submit(run_command,
+                                    _snakemake_command(snakefile, configfiles[subject], subject_cores, targets, force,
+                                                       nolock=True, deployment_args=deployment_args),
+                                    None, f"sub-{subject}"): subject
+                    for subject, targets in subject_targets.items()
+                }
+                failed = [futures[future] for future in as_completed(futures) if not future.result()]
+        finally:
+            for configfile in configfiles.values():
+                os.unlink(configfile)
+        if failed:
+            logging.error(f"fMRIPrep failed for subjects: {sorted(failed)}")
+        success = not failed
+
+    if not success:
         logging.error("fMRIPrep pipeline stage failed.")
         return False
 
@@ -385,7 +978,28 @@ def main():
     parser.add_argument("--cores", type=int, default=4,
                         help="Number of CPU cores to use for pipeline stages.")
     parser.add_argument("--memory_mb", type=int, default=None,
-                        help="Memory limit in MB for fMRIPrep stage (overrides config).")
+                        help="Memory limit in MB for fMRIPrep stage (overrides config). "
+                             "This limit, or the config's, is split evenly between subjects run in parallel.")
+    parser.add_argument("--cores_per_subject", type=int, default=4,
+                        help="Minimum number of cores per subject; with --cores of at least twice this, "
+                             "several subjects are run by fMRIPrep in parallel.")
+    parser.add_argument("--conda_frontend", choices=["mamba", "conda"], default=None,
+                        help="Conda frontend Snakemake uses to create environments. "
+                             "Defaults to mamba if it is installed (much faster solves), conda otherwise.")
+    parser.add_argument("--conda_prefix", type=Path, default=None,
+                        help="Directory to keep the Snakemake conda environments in, so they are "
+                             "reused across runs instead of being created and solved again.")
+    parser.add_argument("--singularity", action="store_true",
+                        help="Pass --use-singularity to Snakemake, to run rules in pre-built images.")
+    parser.add_argument("--reset_bids_db", action="store_true",
+                        help=f"Rescan the BIDS input and rebuild the pybids index cached in "
+                             f"'{BIDS_DATABASE_DIR_NAME}' under the output directory. Files added, removed or "
+                             "renamed in the input are detected and rebuild it automatically; this is only "
+                             "needed after editing files in place. The index is disposable and can also just be deleted.")
+    parser.add_argument("--skip_bids_validation", action="store_true",
+                        help="Do not check the BIDS input against the BIDS specification while indexing it "
+                             "(for datasets known to be valid). The index is reused between runs, so this "
+                             "only matters when it is built or rebuilt.")
     parser.add_argument("--skip_fmriprep", action="store_true",
                         help="Skip the fMRIPrep stage (assumes outputs already exist).")
     parser.add_argument("--skip_feature_extraction", action="store_true",
@@ -398,29 +1012,28 @@ def main():
     args = parser.parse_args()
 
     # --- Input Handling ---
+    # Resolve the input and output locations once; all other paths are derived from them
     input_dir = args.input_dir.resolve()
     main_output_dir = args.output_dir.resolve()
+    converted_bids_path = main_output_dir / "bids_converted"
+    # Define the primary output directory for fmriprep derivatives
+    fmriprep_output_base = main_output_dir / "derivatives"
     main_output_dir.mkdir(parents=True, exist_ok=True)
 
     bids_dir = input_dir
     if args.is_dicom:
         logging.info("Input identified as DICOM, attempting conversion...")
-        converted_bids_path = main_output_dir / "bids_converted"
         config_path = args.dcm2bids_config
 
         if not config_path:
-             # Try finding default config in input or script dir
-             potential_config = input_dir / DEFAULT_DCM2BIDS_CONFIG_NAME
-             if potential_config.is_file():
-                  config_path = potential_config
-             else:
-                  script_dir_config = Path(__file__).parent / DEFAULT_DCM2BIDS_CONFIG_NAME
-                  if script_dir_config.is_file():
-                       config_path = script_dir_config
-                  else:
-                       logging.error(f"dcm2bids config file not specified with --dcm2bids_config and default '{DEFAULT_DCM2BIDS_CONFIG_NAME}' not found.")
-                       sys.exit(1)
-        elif not args.dcm2bids_config.is_file():
+             # Try finding default config in input or script dir, first match wins
+             candidates = (input_dir / DEFAULT_DCM2BIDS_CONFIG_NAME,
+                           Path(__file__).parent / DEFAULT_DCM2BIDS_CONFIG_NAME)
+             config_path = next((candidate for candidate in candidates if os.path.isfile(candidate)), None)
+             if config_path is None:
+                  logging.error(f"dcm2bids config file not specified with --dcm2bids_config and default '{DEFAULT_DCM2BIDS_CONFIG_NAME}' not found.")
+                  sys.exit(1)
+        elif not os.path.isfile(config_path):
             logging.error(f"Specified dcm2bids config file not found: {args.dcm2bids_config}")
             sys.exit(1)
 
@@ -434,37 +1047,68 @@ def main():
     else:
         logging.info(f"Input identified as BIDS: {bids_dir}")
         # Basic check if it looks like a BIDS directory
-        if not (bids_dir / "dataset_description.json").exists():
-             logging.warning(f"Warning: {bids_dir / 'dataset_description.json'} not found. Input might not be a valid BIDS dataset.")
+        description_file = os.path.join(bids_dir, "dataset_description.json")
+        if not os.path.isfile(description_file):
+             logging.warning(f"Warning: {description_file} not found. Input might not be a valid BIDS dataset.")
 
 
-    # Define the primary output directory for fmriprep derivatives
-    fmriprep_output_base = main_output_dir / "derivatives"
-    
+    # pybids index of the input dataset, rebuilt when asked to or when the
+    # DICOM conversion may just have added subjects
+    bids_database_path = main_output_dir / BIDS_DATABASE_DIR_NAME
+    reset_bids_database = args.reset_bids_db or args.is_dicom
+
+    # Subjects and tasks are read from the BIDS layout once and handed to the fMRIPrep stage
+    subjects_to_process = tasks = None
+
     # Check for existing fMRIPrep outputs and automatically skip if they exist
-    try:
-        # First get the subject list and task list
-        layout = BIDSLayout(str(bids_dir), validate=True)
-        subjects_to_process = args.participant_label if args.participant_label else layout.get_subjects()
-        tasks = layout.get_tasks()
+    auto_skip = args.auto_skip_fmriprep and not args.force and not args.skip_fmriprep
+    fmriprep_stamp = _fmriprep_stamp(bids_dir, args.participant_label)
+    # The sentinel is not trusted when the input may just have changed (DICOM
+    # conversion) or the index is rebuilt on request
+    fast_skip = auto_skip and not args.reset_bids_db and not args.is_dicom
+    if fast_skip and fmriprep_marked_complete(fmriprep_output_base, fmriprep_stamp):
+        # Completed before for the same input: decided without indexing the input
+        logging.info(f"Automatically skipping fMRIPrep stage, {fmriprep_output_base / FMRIPREP_COMPLETE_NAME} "
+                     "marks it complete for this input.")
+        args.skip_fmriprep = True
+    else:
+        try:
+            # First get the subject list and task list
+            layout = load_bids_layout(bids_dir, bids_database_path, reset_bids_database,
+                                      validate=not args.skip_bids_validation)
+            # The index is up to date now, should the fMRIPrep stage have to read it again
+            reset_bids_database = False
+            subjects_to_process = args.participant_label if args.participant_label else layout.get_subjects()
+            tasks = layout.get_tasks()
         
-        # If auto_skip_fmriprep is enabled and not forcing execution
-        if args.auto_skip_fmriprep and not args.force and not args.skip_fmriprep:
-            # Check if outputs already exist
-            if fmriprep_output_base.exists() and check_fmriprep_outputs_exist(fmriprep_output_base, subjects_to_process, tasks):
-                logging.info("Automatically skipping fMRIPrep stage since all outputs already exist.")
-                args.skip_fmriprep = True
-    except Exception as e:
-        logging.warning(f"Error checking for existing fMRIPrep outputs: {e}")
-        logging.warning("Will proceed with normal pipeline execution.")
+            # If auto_skip_fmriprep is enabled and not forcing execution
+            if auto_skip:
+                # Check if outputs already exist
+                if fmriprep_output_base.exists() and check_fmriprep_outputs_exist(fmriprep_output_base, subjects_to_process, tasks):
+                    logging.info("Automatically skipping fMRIPrep stage since all outputs already exist.")
+                    args.skip_fmriprep = True
+                    mark_fmriprep_complete(fmriprep_output_base, fmriprep_stamp, subjects_to_process, tasks)
+        except Exception as e:
+            logging.warning(f"Error checking for existing fMRIPrep outputs: {e}")
+            logging.warning("Will proceed with normal pipeline execution.")
 
     # --- Run Pipeline Stages ---
     fmriprep_success = True
     if not args.skip_fmriprep:
-        fmriprep_success = run_fmriprep_pipeline(bids_dir, fmriprep_output_base, args.cores, args.participant_label, args.memory_mb, args.force)
+        # Outputs are about to change, the sentinel is only valid again after a successful run
+        mark_fmriprep_complete(fmriprep_output_base, None)
+        fmriprep_success = run_fmriprep_pipeline(bids_dir, fmriprep_output_base, args.cores, args.participant_label, args.memory_mb, args.force, args.cores_per_subject,
+                                                 bids_database_path, reset_bids_database,
+                                                 args.conda_frontend, args.conda_prefix, args.singularity,
+                                                 subjects_to_process, tasks,
+                                                 validate_bids=not args.skip_bids_validation)
         if not fmriprep_success:
             logging.error("fMRIPrep stage failed. Aborting.")
             sys.exit(1)
+        # Validating the new outputs also records them in the inventory the sentinel check relies on
+        if (subjects_to_process and tasks
+                and check_fmriprep_outputs_exist(fmriprep_output_base, subjects_to_process, tasks)):
+            mark_fmriprep_complete(fmriprep_output_base, fmriprep_stamp, subjects_to_process, tasks)
     else:
         logging.info("Skipping fMRIPrep stage as requested.")
         if not fmriprep_output_base.exists():